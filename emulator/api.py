@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""MikroTik RouterOS API stand-in server
+
+Speaks enough of the RouterOS API protocol (8728, or TLS with --ssl_cert)
+to run modules with transport 'api' without a router: login (plain and
+pre 6.43 challenge with --legacy_login), tagged and pipelined requests
+answered concurrently, print/getall with ?key=value queries, .proplist
+and count-only, set/add/remove/enable/disable, package (un)scheduling
+and reboot. Menus are loaded from a json file ({"/ip/address": [{...}]},
+see DEFAULT_MENUS), --latency (seconds per round trip) and --bandwidth
+(bytes/s) imitate a remote router (see link.py). Use it from python
+(ApiEmulator) to hook into reboots and read the stats counters.
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import socket
+import hashlib
+import binascii
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             os.pardir, 'module_utils'))
+from mikrotik_api import encode_sentence, decode_length
+from link import Link, new_stats
+
+EMULATORDEFS = {
+    'port': 8728,
+    'menus': None,
+    'latency': 0.0,
+    'bandwidth': 0,
+    'ssl_cert': None,
+    'legacy_login': False,
+    'username': 'admin',
+    'password': '',
+    'reboot_time': 3.0
+}
+USAGE = """
+api.py [--port=<port>] [--menus=<file.json>] [--latency=<seconds>]
+       [--bandwidth=<bytes/s>]
+       [--ssl_cert=<cert+key.pem>] [--legacy_login] [--reboot_time=<seconds>]
+       [--username=<username>] [--password=<password>]
+"""
+# the same CHR as the ssh.py fixtures (fixtures/chr-6.40.3.json)
+DEFAULT_MENUS = {
+    '/system/identity': [{'name': 'R1'}],
+    '/system/resource': [{
+        'uptime': '1d2h3m4s', 'version': '6.40.3 (stable)',
+        'build-time': 'Jul/28/2017 10:00:00', 'free-memory': '104857600',
+        'total-memory': '134217728', 'cpu': 'QEMU', 'cpu-count': '1',
+        'architecture-name': 'x86_64', 'board-name': 'CHR', 'platform': 'MikroTik'}],
+    '/system/routerboard': [{'routerboard': 'false'}],
+    '/system/health': [],
+    '/system/license': [{'software-id': 'ABCD-1234', 'level': 'free'}],
+    '/system/history': [],
+    '/system/clock': [{'time': '10:00:00', 'date': 'aug/01/2017',
+                       'time-zone-name': 'manual'}],
+    '/system/logging/action': [
+        {'.id': '*0', 'name': 'memory', 'target': 'memory'},
+        {'.id': '*3', 'name': 'remote', 'target': 'remote', 'remote': '10.0.0.5',
+         'remote-port': '514'}],
+    '/system/package': [
+        {'.id': '*1', 'name': 'routeros-x86', 'version': '6.40.3',
+         'disabled': 'false', 'scheduled': ''},
+        {'.id': '*2', 'name': 'system', 'version': '6.40.3',
+         'disabled': 'false', 'scheduled': ''},
+        {'.id': '*3', 'name': 'ipv6', 'version': '6.40.3',
+         'disabled': 'false', 'scheduled': ''},
+        {'.id': '*4', 'name': 'security', 'version': '6.40.3',
+         'disabled': 'false', 'scheduled': ''},
+        {'.id': '*5', 'name': 'wireless', 'version': '6.40.3',
+         'disabled': 'true', 'scheduled': 'scheduled for enable'}],
+    '/interface': [
+        {'.id': '*1', 'name': 'ether1', 'type': 'ether', 'mac-address': '08:00:27:4E:F2:9B',
+         'disabled': 'false', 'running': 'true'},
+        {'.id': '*2', 'name': 'ether2', 'type': 'ether', 'mac-address': '08:00:27:4E:F2:9C',
+         'disabled': 'false', 'running': 'true'},
+        {'.id': '*3', 'name': 'ether3', 'type': 'ether', 'mac-address': '08:00:27:4E:F2:9D',
+         'disabled': 'true', 'running': 'false', 'comment': 'uplink "A" side'}],
+    '/interface/ethernet': [{'.id': '*1', 'name': 'ether1'}],
+    '/interface/ethernet/switch': [],
+    '/interface/bridge': [],
+    '/interface/bridge/settings': [{'use-ip-firewall': 'false'}],
+    '/ip/address': [
+        {'.id': '*1', 'address': '192.168.88.101/24', 'network': '192.168.88.0',
+         'interface': 'ether1', 'disabled': 'false'}],
+    '/ip/cloud': [{'ddns-enabled': 'false', 'status': 'unknown'}],
+    '/ip/service': [{'.id': '*1', 'name': 'ssh', 'port': '22', 'disabled': 'false'},
+                    {'.id': '*2', 'name': 'winbox', 'port': '8291', 'disabled': 'false'},
+                    {'.id': '*3', 'name': 'api', 'port': '8728', 'disabled': 'true'}],
+    '/ip/ssh': [{'forwarding-enabled': 'false', 'strong-crypto': 'false'}],
+    '/ip/settings': [{'ip-forward': 'true', 'rp-filter': 'no'}],
+    '/ip/firewall/connection/tracking': [{'enabled': 'auto',
+                                          'tcp-established-timeout': '1d'}],
+    '/ip/neighbor/discovery': [{'.id': '*1', 'name': 'ether1', 'disabled': 'false'}],
+    '/ipv6/address': [{'.id': '*1', 'address': 'fe80::a00:27ff:fe4e:f29b/64',
+                       'interface': 'ether1', 'disabled': 'false'}],
+    '/ipv6/settings': [{'forward': 'true',
+                        'accept-redirects': 'yes-if-forwarding-disabled'}],
+    '/snmp': [{'enabled': 'false', 'contact': ''}],
+    '/system/ntp/client': [{'enabled': 'false', 'mode': 'broadcast'}],
+    '/tool/e-mail': [{'address': '10.0.0.25', 'port': '25'}],
+    '/tool/mac-server': [{'.id': '*1', 'interface': 'all', 'disabled': 'false'}],
+    '/tool/mac-server/mac-winbox': [{'.id': '*1', 'interface': 'all', 'disabled': 'false'}],
+    '/user': [{'.id': '*1', 'name': 'admin', 'group': 'full', 'disabled': 'false'}],
+    '/user/active': [],
+    '/user/ssh-keys': [],
+}
+
+class ApiEmulator(object):
+    """RouterOS API stand-in serving menus on a local port"""
+
+    def __init__(self, port=8728, menus=None, latency=0.0, ssl_cert=None,
+                 legacy_login=False, username='admin', password='',
+                 reboot_time=3.0, bandwidth=0):
+        self.port = port
+        self.menus = json.loads(json.dumps(menus or DEFAULT_MENUS))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ssl_cert = ssl_cert
+        self.legacy_login = legacy_login
+        self.username = username
+        self.password = password
+        self.reboot_time = reboot_time
+        self.on_reboot = None # called with emulator when it comes back up
+        self.next_id = 100
+        self.lock = threading.Lock()
+        self.clients = []
+        self.listener = None
+        self.stats = new_stats()
+
+    def start(self):
+        """starts serving in a daemon thread"""
+        self.listen()
+        server = threading.Thread(target=self.serve)
+        server.daemon = True
+        server.start()
+        return self
+
+    def listen(self):
+        """opens listening socket (again after reboot)"""
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(50)
+        self.port = listener.getsockname()[1]
+        self.listener = listener
+
+    def serve(self):
+        """accepts connections, the port is closed while rebooting"""
+        while True:
+            try:
+                conn, _addr = self.listener.accept()
+            except socket.error:
+                time.sleep(0.05) # listener closed by reboot
+                continue
+            client = threading.Thread(target=self.handle, args=(conn,))
+            client.daemon = True
+            client.start()
+
+    def handle(self, conn):
+        """reads sentences of one connection, answers each in its own thread"""
+        if self.ssl_cert:
+            try:
+                conn = ssl.wrap_socket(conn, certfile=self.ssl_cert, server_side=True)
+            except (ssl.SSLError, socket.error):
+                conn.close()
+                return
+        conn = Link(conn, self.latency, self.bandwidth, self.stats)
+        self.clients.append(conn)
+        session = {'conn': conn, 'write': threading.Lock(), 'login': False}
+        def read(size):
+            data = ''
+            while len(data) < size:
+                chunk = conn.recv(size - len(data))
+                if not chunk:
+                    raise EOFError
+                data += chunk
+            return data
+        try:
+            while True:
+                words = []
+                while True:
+                    length = decode_length(read)
+                    if not length:
+                        break
+                    words.append(read(length))
+                if not words:
+                    continue
+                worker = threading.Thread(target=self.answer, args=(session, words))
+                worker.daemon = True
+                worker.start()
+        except (EOFError, socket.error, ssl.SSLError, TypeError):
+            pass
+        finally:
+            if conn in self.clients:
+                self.clients.remove(conn)
+            with self.lock:
+                if session.get('active') in self.menus.get('/user/active', []):
+                    self.menus['/user/active'].remove(session['active'])
+            conn.close()
+
+    def answer(self, session, words):
+        """runs one request and writes its replies"""
+        tag = [word for word in words if word.startswith('.tag=')]
+        attrs = dict(word[1:].split('=', 1) for word in words[1:]
+                     if word.startswith('=') and '=' in word[1:])
+        query = [word[1:] for word in words[1:] if word.startswith('?')]
+        with self.lock:
+            self.stats['commands'] += 1
+            if words[0] != '/login' and not session['login']:
+                replies = trap('=message=not logged in')
+            else:
+                replies = self.run(session, words[0], attrs, query)
+        data = ''.join(encode_sentence(reply + tag) for reply in replies)
+        with session['write']:
+            try:
+                session['conn'].sendall(data)
+            except socket.error:
+                pass
+
+    def run(self, session, path, attrs, query):
+        """returns reply sentences (lists of words) for command"""
+        if path == '/login':
+            return self.login(session, attrs)
+        if path == '/system/reboot':
+            threading.Thread(target=self.reboot).start()
+            return [['!done']]
+        if path == '/quit':
+            return [['!fatal', '=message=session terminated on request']]
+        menu, _sep, action = path.rpartition('/')
+        if menu not in self.menus:
+            return trap('=message=no such command prefix')
+        records = self.menus[menu]
+        if action in ('print', 'getall'):
+            found = [record for record in records if matches(record, query)]
+            if 'count-only' in attrs:
+                return [['!done', '=ret=%d' % len(found)]]
+            proplist = attrs.get('.proplist')
+            replies = []
+            for record in found:
+                keys = proplist.split(',') if proplist else sorted(record)
+                replies.append(['!re'] + ['=%s=%s' % (key, record[key])
+                                          for key in keys if key in record])
+            return replies + [['!done']]
+        if action == 'add':
+            self.next_id += 1
+            record = dict(attrs, **{'.id': '*%X' % self.next_id})
+            records.append(record)
+            return [['!done', '=ret=%s' % record['.id']]]
+        targets = [record for record in records
+                   if record.get('.id') in attrs.get('numbers', attrs.get('.id', '')).split(',')
+                   or (not record.get('.id') and action == 'set')]
+        if action == 'set':
+            for record in targets:
+                record.update((key, val) for key, val in attrs.items()
+                              if key not in ('numbers', '.id'))
+        elif action == 'remove':
+            for record in targets:
+                records.remove(record)
+        elif action in ('enable', 'disable') and menu == '/system/package':
+            for record in targets:
+                record['scheduled'] = 'scheduled for %s' % action
+        elif action in ('enable', 'disable'):
+            for record in targets:
+                record['disabled'] = 'true' if action == 'disable' else 'false'
+        elif action == 'unschedule' and menu == '/system/package':
+            for record in records:
+                record['scheduled'] = ''
+        else:
+            return trap('=message=no such command')
+        return [['!done']]
+
+    def login(self, session, attrs):
+        """plain login, or challenge-response with legacy_login"""
+        if self.legacy_login and 'response' not in attrs:
+            session['challenge'] = os.urandom(16)
+            return [['!done', '=ret=' + binascii.hexlify(session['challenge'])]]
+        if self.legacy_login:
+            expected = '00' + hashlib.md5('\x00' + self.password +
+                                          session['challenge']).hexdigest()
+            valid = attrs.get('response') == expected
+        else:
+            valid = attrs.get('password', '') == self.password
+        if attrs.get('name') != self.username or not valid:
+            return trap('=message=invalid user name or password (6)')
+        session['login'] = True
+        self.next_id += 1
+        session['active'] = {'.id': '*%X' % self.next_id, 'name': self.username,
+                             'via': 'api', 'address': session['conn'].getpeername()[0]}
+        self.menus.setdefault('/user/active', []).append(session['active'])
+        return [['!done']]
+
+    def reboot(self):
+        """drops all connections, applies scheduled package changes"""
+        time.sleep(0.2)
+        try: # wakes up accept() in serve
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        for conn in list(self.clients):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        with self.lock:
+            for record in self.menus.get('/system/package', []):
+                if record.get('scheduled') == 'scheduled for disable':
+                    record['disabled'] = 'true'
+                elif record.get('scheduled') == 'scheduled for enable':
+                    record['disabled'] = 'false'
+                record['scheduled'] = ''
+            for record in self.menus.get('/system/resource', []):
+                record['uptime'] = '0s'
+        time.sleep(self.reboot_time)
+        if self.on_reboot:
+            with self.lock:
+                self.on_reboot(self)
+        self.listen()
+
+def trap(message):
+    """returns error reply, RouterOS ends it with !done as well"""
+    return [['!trap', message], ['!done']]
+
+def matches(record, query):
+    """checks record against ?key=value, ?key and ?-key query words"""
+    for cond in query:
+        if cond.startswith('-'):
+            if cond[1:] in record:
+                return False
+        elif '=' in cond:
+            key, val = cond.split('=', 1)
+            if record.get(key) != val:
+                return False
+        elif cond not in record:
+            return False
+    return True
+
+def parse_opts(cmdline):
+    """returns command line options as dict"""
+    options = dict(EMULATORDEFS)
+    for opt in cmdline:
+        arg, _eq, val = opt.partition('=')
+        arg = arg[2:]
+        if not opt.startswith('--') or arg not in options:
+            print USAGE
+            sys.exit("Unknown option: %s" % opt)
+        if isinstance(options[arg], bool):
+            val = val.lower() not in ('no', 'false')
+        elif isinstance(options[arg], (int, float)):
+            val = type(options[arg])(val)
+        options[arg] = val
+    return options
+
+def main():
+    options = parse_opts(sys.argv[1:])
+    menus = None
+    if options['menus']:
+        with open(options['menus']) as menufile:
+            menus = json.load(menufile)
+    emulator = ApiEmulator(options['port'], menus, options['latency'],
+                           options['ssl_cert'], options['legacy_login'],
+                           options['username'], options['password'],
+                           options['reboot_time'], options['bandwidth']).start()
+    print "RouterOS API emulator listening on 127.0.0.1:%d%s" % (
+        emulator.port, ' (TLS)' if options['ssl_cert'] else '')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""ansible-mikrotik module benchmark against emulated routers
+
+Runs every module scenario (SCENARIOS) in shell mode against the SSH/SFTP
+stand-in (ssh.py) and, for transport api, the API stand-in (api.py), with
+--latency seconds per round trip and --bandwidth bytes/s. For every
+scenario it reports connections, round trips on the wire, ssh commands
+or API sentences, sftp requests, bytes in both directions and the median
+wall time of --repeat runs (including interpreter start). Everything runs
+locally in a temporary folder, no router or network is needed.
+
+--json writes the results, --baseline compares them with earlier results:
+more connections, commands or sftp requests, 10% more bytes or a wall
+time more than --tolerance (fraction) above the baseline is reported as a
+regression and the exit status is non-zero, as it is for failed runs.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             os.pardir, 'module_utils'))
+from ssh import SshEmulator
+from api import ApiEmulator
+from mikrotik_repo import build_index
+
+BENCHDEFS = {
+    'latency': 0.02,
+    'bandwidth': 0,
+    'repeat': 3,
+    'scenarios': None,
+    'json': None,
+    'baseline': None,
+    'tolerance': 0.5,
+    'verbose': False
+}
+USAGE = """
+bench.py [--latency=<seconds>] [--bandwidth=<bytes/s>] [--repeat=<n>]
+         [--scenarios=<name1,name2...>] [--json=<file>]
+         [--baseline=<file>] [--tolerance=<fraction>] [--verbose]
+"""
+LIBRARY = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       os.pardir, 'library')
+# module runs: args are formatted with tmp (work folder) and api_port,
+# 'warmup' runs once untimed first (caches, uploads), 'clean' is removed
+# before every run: 'backup' local backups, 'sftp' files on the router
+SCENARIOS = [
+    {'name': 'facts', 'module': 'mikrotik_facts.py', 'args': []},
+    {'name': 'facts-verbose', 'module': 'mikrotik_facts.py',
+     'args': ['--verbose']},
+    {'name': 'facts-batch', 'module': 'mikrotik_facts.py',
+     'args': ['--verbose', '--batch']},
+    {'name': 'facts-workers', 'module': 'mikrotik_facts.py',
+     'args': ['--verbose', '--workers=4']},
+    {'name': 'facts-cache', 'module': 'mikrotik_facts.py', 'warmup': True,
+     'args': ['--verbose', '--cache=use', '--cache_dir=%(tmp)s/facts']},
+    {'name': 'facts-api', 'module': 'mikrotik_facts.py',
+     'args': ['--verbose', '--transport=api', '--api_port=%(api_port)d']},
+    {'name': 'export', 'module': 'mikrotik_export.py',
+     'args': ['--export_dir=%(tmp)s/export']},
+    {'name': 'export-backup', 'module': 'mikrotik_export.py', 'clean': 'backup',
+     'args': ['--export_dir=%(tmp)s/export', '--backup_dir=%(tmp)s/backup']},
+    {'name': 'command', 'module': 'mikrotik_command.py',
+     'args': ['--command=ip address print']},
+    {'name': 'command-change', 'module': 'mikrotik_command.py',
+     'args': ['--command=ip dns set servers=192.168.88.254']},
+    {'name': 'command-pipeline', 'module': 'mikrotik_command.py',
+     'args': ['--execute_file=%(tmp)s/script.rsc']},
+    {'name': 'command-sequential', 'module': 'mikrotik_command.py',
+     'args': ['--execute_file=%(tmp)s/script.rsc', '--pipeline=no']},
+    {'name': 'package-upload', 'module': 'mikrotik_package.py', 'clean': 'sftp',
+     'args': ['--repository=%(tmp)s/repo', '--version=6.40.4',
+              '--packages=system,security,ppp']},
+    {'name': 'package-cached', 'module': 'mikrotik_package.py', 'warmup': True,
+     'args': ['--repository=%(tmp)s/repo', '--version=6.40.4',
+              '--packages=system,security,ppp']},
+    {'name': 'package-api', 'module': 'mikrotik_package.py', 'warmup': True,
+     'args': ['--repository=%(tmp)s/repo', '--version=6.40.4',
+              '--packages=system,security,ppp', '--transport=api',
+              '--api_port=%(api_port)d']},
+]
+# package sizes of the generated 6.40.4 repository and the router backup
+PACKAGE_SIZES = {'system': 2500000, 'security': 500000, 'ppp': 300000}
+BACKUP_SIZE = 1000000
+SCRIPT = """# benchmark script
+ip dns set servers=192.168.88.254
+ip dns print
+ip route print terse without-paging
+"""
+CONNECTION_QUERY = ('ip firewall connection print terse where tcp-state=established'
+                    ' and src-address~"127.0.0.1" and dst-address~".*:%d"')
+CONNECTION_OUTPUT = (' 0  SAC  protocol=tcp src-address=127.0.0.1:51000'
+                     ' dst-address=127.0.0.1:%d tcp-state=established \r\n')
+COUNTERS = ('connections', 'round_trips', 'commands', 'sftp_ops',
+            'bytes_in', 'bytes_out')
+
+def parse_opts(cmdline):
+    """returns command line options as dict"""
+    options = dict(BENCHDEFS)
+    for opt in cmdline:
+        arg, _eq, val = opt.partition('=')
+        arg = arg[2:]
+        if not opt.startswith('--') or arg not in options:
+            print USAGE
+            sys.exit("Unknown option: %s" % opt)
+        if isinstance(options[arg], bool):
+            val = val.lower() not in ('no', 'false')
+        elif isinstance(options[arg], (int, float)):
+            val = type(options[arg])(val)
+        options[arg] = val
+    return options
+
+def prepare(tmp, ssh):
+    """creates package repository, script, router backup file and fixture
+    of the management connection query (it contains emulator's port)"""
+    ssh.fixtures[CONNECTION_QUERY % ssh.port] = CONNECTION_OUTPUT % ssh.port
+    for pkg, size in PACKAGE_SIZES.items():
+        folder = os.path.join(tmp, 'repo', '6.40.4', 'x86')
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, '%s-6.40.4.npk' % pkg), 'wb') as npk:
+            npk.write(os.urandom(size))
+    build_index(os.path.join(tmp, 'repo'))
+    with open(os.path.join(tmp, 'script.rsc'), 'w') as script:
+        script.write(SCRIPT)
+    with open(os.path.join(ssh.sftp_root, 'auto.backup'), 'wb') as backup:
+        backup.write(os.urandom(BACKUP_SIZE))
+    os.mkdir(os.path.join(tmp, 'export'))
+
+def clean(what, tmp, sftp_root):
+    """removes state left by the previous run of a scenario"""
+    if what == 'backup':
+        shutil.rmtree(os.path.join(tmp, 'backup'), True)
+    elif what == 'sftp':
+        for name in os.listdir(sftp_root):
+            if name.endswith('.npk') or name == 'ansible-packages.json':
+                os.unlink(os.path.join(sftp_root, name))
+
+def run_module(scenario, ssh, params):
+    """runs module once, returns (returncode, output, seconds)"""
+    cmd = [sys.executable, os.path.join(LIBRARY, scenario['module']),
+           '--hostname=127.0.0.1', '--port=%d' % ssh.port,
+           '--username=admin', '--password=']
+    cmd += [arg % params for arg in scenario['args']]
+    started = time.time()
+    proc = subprocess.Popen(cmd, stdin=open(os.devnull), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True)
+    output = proc.communicate()[0]
+    return proc.returncode, output, time.time() - started
+
+def bench(scenario, ssh, api, params, options):
+    """runs scenario repeat times, returns result dict"""
+    if scenario.get('warmup'):
+        run_module(scenario, ssh, params)
+    times = []
+    for _run in range(max(1, options['repeat'])):
+        if scenario.get('clean'):
+            clean(scenario['clean'], params['tmp'], ssh.sftp_root)
+        ssh.reset_stats()
+        api.stats.update(dict((counter, 0) for counter in COUNTERS))
+        returncode, output, seconds = run_module(scenario, ssh, params)
+        if returncode:
+            return {'failed': True, 'output': output}
+        times.append(round(seconds, 3))
+    result = dict((counter, ssh.stats[counter] + api.stats[counter])
+                  for counter in COUNTERS)
+    result['time'] = sorted(times)[len(times) // 2]
+    result['times'] = times
+    result['unknown'] = sorted(set(ssh.stats['unknown']))
+    return result
+
+def regressions(results, baseline, tolerance):
+    """returns list of regression messages against baseline results"""
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or result.get('failed') or base.get('failed'):
+            continue
+        for counter in ('connections', 'commands', 'sftp_ops'):
+            if result[counter] > base[counter]:
+                found.append("%s: %s %d -> %d" % (name, counter, base[counter],
+                                                  result[counter]))
+        size = result['bytes_in'] + result['bytes_out']
+        base_size = base['bytes_in'] + base['bytes_out']
+        if size > base_size * 1.1:
+            found.append("%s: bytes %d -> %d" % (name, base_size, size))
+        if result['time'] > base['time'] * (1 + tolerance):
+            found.append("%s: time %.2fs -> %.2fs" % (name, base['time'], result['time']))
+    return found
+
+def main():
+    options = parse_opts(sys.argv[1:])
+    scenarios = SCENARIOS
+    if options['scenarios']:
+        names = options['scenarios'].split(',')
+        scenarios = [scenario for scenario in SCENARIOS
+                     if any(scenario['name'].startswith(name) for name in names)]
+    tmp = tempfile.mkdtemp(prefix='mtbench-')
+    try:
+        ssh = SshEmulator(0, sftp_root=os.path.join(tmp, 'router'),
+                          latency=options['latency'],
+                          bandwidth=options['bandwidth'])
+        os.mkdir(ssh.sftp_root)
+        ssh.start()
+        api = ApiEmulator(0, latency=options['latency'],
+                          bandwidth=options['bandwidth']).start()
+        prepare(tmp, ssh)
+        params = {'tmp': tmp, 'api_port': api.port}
+        print "latency %.3fs, bandwidth %s, %d run(s) per scenario" % (
+            options['latency'], "%d B/s" % options['bandwidth']
+            if options['bandwidth'] else 'unlimited', options['repeat'])
+        print "%-20s %5s %6s %5s %5s %9s %9s %8s" % (
+            'scenario', 'conns', 'trips', 'cmds', 'sftp', 'kB in', 'kB out', 'time')
+        results = {}
+        for scenario in scenarios:
+            result = bench(scenario, ssh, api, params, options)
+            results[scenario['name']] = result
+            if result.get('failed'):
+                print "%-20s FAILED" % scenario['name']
+                if options['verbose']:
+                    print result['output']
+                continue
+            print "%-20s %5d %6d %5d %5d %9.1f %9.1f %7.2fs" % (
+                scenario['name'], result['connections'], result['round_trips'],
+                result['commands'], result['sftp_ops'], result['bytes_in'] / 1024.0,
+                result['bytes_out'] / 1024.0, result['time'])
+            if options['verbose'] and result['unknown']:
+                print "    unknown commands: " + '; '.join(result['unknown'])
+    finally:
+        # disconnects reach the emulators one latency later, let them finish
+        time.sleep(options['latency'] * 2 + 0.2)
+        shutil.rmtree(tmp, True)
+    if options['json']:
+        with open(options['json'], 'w') as output:
+            json.dump({'latency': options['latency'], 'bandwidth': options['bandwidth'],
+                       'results': results}, output, indent=1, sort_keys=True)
+    failed = [name for name, result in results.items() if result.get('failed')]
+    found = []
+    if options['baseline']:
+        with open(options['baseline']) as baseline:
+            found = regressions(results, json.load(baseline)['results'],
+                                options['tolerance'])
+        for regression in found:
+            print "REGRESSION " + regression
+    if failed or found:
+        sys.exit("%d scenario(s) failed, %d regression(s)" % (len(failed), len(found)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""Emulated network link for the RouterOS stand-in servers
+
+Link wraps an accepted socket: a reader thread timestamps everything the
+client sends and recv() hands it over only after latency seconds (plus
+transfer time at bandwidth bytes/s), send() is throttled to bandwidth.
+So every exchange of requests and replies costs one latency, pipelined
+requests share it, like on a real remote link. Byte counters and the
+number of round trips (turns from sending replies to receiving requests)
+are added to the stats dict given by the server.
+"""
+
+import time
+import socket
+import threading
+import Queue
+
+LINK_CHUNK = 65536
+
+def new_stats():
+    """returns zeroed link/server counters"""
+    return {'connections': 0, 'round_trips': 0, 'commands': 0, 'sftp_ops': 0,
+            'bytes_in': 0, 'bytes_out': 0}
+
+class Link(object):
+    """socket wrapper adding latency and bandwidth limit, counts traffic"""
+
+    def __init__(self, sock, latency=0.0, bandwidth=0, stats=None):
+        self.sock = sock
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = stats if stats is not None else new_stats()
+        self.timeout = None
+        self.inbound = Queue.Queue()
+        self.buffer = ''
+        self.eof = False
+        self.replied = True # next request starts a round trip
+        self.send_lock = threading.Lock()
+        self.send_free = 0.0
+        self.stats['connections'] += 1
+        reader = threading.Thread(target=self.pump)
+        reader.daemon = True
+        reader.start()
+
+    def pump(self):
+        """reads from the client as fast as it sends, stamps arrival time"""
+        ready = 0.0
+        while True:
+            try:
+                data = self.sock.recv(LINK_CHUNK)
+            except (socket.error, IOError):
+                data = ''
+            ready = max(time.time(), ready)
+            if data and self.bandwidth:
+                ready += len(data) / float(self.bandwidth)
+            self.inbound.put((ready + self.latency, data))
+            if not data:
+                break
+
+    def recv(self, size):
+        """returns delayed client data, socket.timeout as set by settimeout"""
+        if not self.buffer:
+            if self.eof:
+                return ''
+            try:
+                when, data = self.inbound.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise socket.timeout('timed out')
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                self.eof = True
+                return ''
+            if self.replied:
+                self.stats['round_trips'] += 1
+                self.replied = False
+            self.buffer = data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.stats['bytes_in'] += len(data)
+        return data
+
+    def send(self, data):
+        """sends at most LINK_CHUNK bytes at bandwidth, returns bytes sent"""
+        data = data[:LINK_CHUNK]
+        if self.bandwidth:
+            with self.send_lock:
+                self.send_free = max(time.time(), self.send_free) + \
+                                 len(data) / float(self.bandwidth)
+                delay = self.send_free - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent = self.sock.send(data)
+        self.stats['bytes_out'] += sent
+        self.replied = True
+        return sent
+
+    def sendall(self, data):
+        """sends all data"""
+        while data:
+            data = data[self.send(data):]
+
+    def settimeout(self, timeout):
+        """recv() timeout, the real socket stays blocking for the reader"""
+        self.timeout = timeout
+
+    def gettimeout(self):
+        """returns recv() timeout"""
+        return self.timeout
+
+    def close(self):
+        """closes the connection, wakes up the reader thread"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""MikroTik RouterOS SSH/SFTP stand-in server
+
+Paramiko based server replaying recorded RouterOS command outputs, to run
+the modules (and emulator/bench.py) without a router. Every exec request
+is looked up in a fixtures file ({"command": "output"}, see fixtures/),
+scripts of ':put "text"', ':do {command} on-error={}' and plain commands
+separated by ';' (facts batch mode, command pipelining) are answered part
+by part. Like RouterOS, which parses a whole script before running it, a
+script using a --missing menu (of a package that is not installed) fails
+as a whole with 'bad command name', unless that command is compiled at
+run time with ':do {:local cmd [:parse "..."]; $cmd} on-error={}'.
+Unknown commands return nothing (or RouterOS 'bad command name' with
+--strict) and are listed in stats['unknown'], with --record they are run
+on a real router instead and added to the fixtures file.
+
+SFTP serves a local folder (--sftp_root) as router's file system. After
+'system reboot' (or 'system package downgrade') the port is closed for
+--reboot_time seconds and uploaded .npk files are "installed": their
+version replaces the current one in all fixture outputs. --latency
+(seconds per round trip) and --bandwidth (bytes/s) imitate a remote
+router (see link.py), traffic and requests are counted in stats.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+
+import paramiko
+from paramiko import SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from link import Link, new_stats
+
+EMULATORDEFS = {
+    'port': 2222,
+    'fixtures': None,
+    'sftp_root': None,
+    'latency': 0.0,
+    'bandwidth': 0,
+    'username': 'admin',
+    'password': '',
+    'reboot_time': 3.0,
+    'strict': False,
+    'missing': 'interface wireless,system ntp server',
+    'record': None,
+    'record_port': 22,
+    'record_username': 'admin',
+    'record_password': ''
+}
+USAGE = """
+ssh.py [--port=<port>] [--fixtures=<file.json>] [--sftp_root=<path>]
+       [--latency=<seconds>] [--bandwidth=<bytes/s>] [--reboot_time=<seconds>]
+       [--username=<username>] [--password=<password>] [--strict]
+       [--missing=<menu1,menu2...>]
+       [--record=<router> [--record_port=<port>] [--record_username=<username>]
+                          [--record_password=<password>]]
+"""
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'fixtures', 'chr-6.40.3.json')
+VERSION_QUERY = ':put [/system resource get version]'
+REBOOT_COMMANDS = ('system reboot', '/system reboot',
+                   'system package downgrade', '/system package downgrade')
+PARSED_COMMAND = re.compile(r'^:local (\w+) \[:parse "((?:[^"\\]|\\.)*)"\]$')
+NPK_VERSION = re.compile(r'-(\d+\.\d+(?:\.\d+)?(?:(?:rc|beta)\d+)?)(?:-[\w]+)?\.npk$')
+OUTPUT_CHUNK = 32768
+
+def split_script(script):
+    """returns top level ';' separated parts of RouterOS script"""
+    parts = []
+    part = ''
+    depth = 0
+    quoted = False
+    escaped = False
+    for char in script:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif not quoted and char in '{[':
+            depth += 1
+        elif not quoted and char in '}]':
+            depth -= 1
+        elif not quoted and not depth and char in ';\n':
+            parts.append(part.strip())
+            part = ''
+            continue
+        part += char
+    parts.append(part.strip())
+    return [part for part in parts if part]
+
+def do_body(part):
+    """returns body of ':do {body} on-error=...' part or None"""
+    if part.startswith(':do {') and '} on-error=' in part:
+        return part[5:part.rindex('} on-error=')]
+    return None
+
+def bad_command(menu, column):
+    """returns RouterOS syntax error for missing menu at column"""
+    return 'bad command name %s (line 1 column %d)\r\n' % (menu.split()[-1], column)
+
+class SshEmulator(object):
+    """RouterOS SSH/SFTP stand-in serving fixtures on a local port"""
+
+    def __init__(self, port=2222, fixtures=None, sftp_root=None, latency=0.0,
+                 bandwidth=0, username='admin', password='', reboot_time=3.0,
+                 strict=False, missing=EMULATORDEFS['missing']):
+        self.port = port
+        self.fixtures_file = fixtures or DEFAULT_FIXTURES
+        with open(self.fixtures_file) as outputs:
+            self.fixtures = json.load(outputs)
+        self.sftp_root = sftp_root or tempfile.mkdtemp(prefix='mtemu-')
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.username = username
+        self.password = password
+        self.reboot_time = reboot_time
+        self.strict = strict
+        self.missing = [menu.strip() for menu in missing.split(',') if menu.strip()]
+        self.on_reboot = None # called with emulator when it comes back up
+        self.upstream = None # paramiko client of router to record from
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.lock = threading.Lock()
+        self.transports = []
+        self.listener = None
+        self.stats = new_stats()
+        self.stats['unknown'] = []
+
+    def reset_stats(self):
+        """zeroes traffic and request counters"""
+        self.stats.update(new_stats(), unknown=[])
+
+    def start(self):
+        """starts serving in a daemon thread"""
+        self.listen()
+        server = threading.Thread(target=self.serve)
+        server.daemon = True
+        server.start()
+        return self
+
+    def listen(self):
+        """opens listening socket (again after reboot)"""
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(50)
+        self.port = listener.getsockname()[1]
+        self.listener = listener
+
+    def serve(self):
+        """accepts connections, the port is closed while rebooting"""
+        while True:
+            try:
+                conn, _addr = self.listener.accept()
+            except socket.error:
+                time.sleep(0.05) # listener closed by reboot
+                continue
+            client = threading.Thread(target=self.handle, args=(conn,))
+            client.daemon = True
+            client.start()
+
+    def handle(self, conn):
+        """runs ssh server side of one connection (handshake and auth)"""
+        link = Link(conn, self.latency, self.bandwidth, self.stats)
+        transport = paramiko.Transport(link)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, SftpEmulator)
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=SshServer(self))
+        except (paramiko.SSHException, EOFError, socket.error):
+            link.close()
+            self.transports.remove(transport)
+
+    def output(self, command):
+        """returns output of command or script"""
+        command = command.strip()
+        for key in (command, command.lstrip('/')):
+            if key in self.fixtures:
+                return self.fixtures[key]
+        parts = split_script(command)
+        if len(parts) > 1 or command.startswith(':put "') or do_body(command):
+            error = self.parse_error(command, parts)
+            if error:
+                return error
+            return ''.join(self.run_part(part) for part in parts)
+        menu = self.missing_menu(command)
+        if menu:
+            return bad_command(menu, 1)
+        if self.upstream:
+            _stdin, stdout, _stderr = self.upstream.exec_command(command)
+            with self.lock:
+                self.fixtures[command] = stdout.read()
+                self.save_fixtures()
+            return self.fixtures[command]
+        self.stats['unknown'].append(command)
+        if self.strict:
+            return 'bad command name %s (line 1 column 1)\r\n' % command.split()[0]
+        return ''
+
+    def missing_menu(self, command):
+        """returns missing menu used by command or None"""
+        words = command.lstrip('/').split()
+        for menu in self.missing:
+            if words[:len(menu.split())] == menu.split():
+                return menu
+        return None
+
+    def parse_error(self, script, parts):
+        """returns 'bad command name' if script uses a missing menu outside
+        of :parse strings (RouterOS parses the whole script first)"""
+        for part in parts:
+            body = do_body(part)
+            if body is not None:
+                error = self.parse_error(script, split_script(body))
+                if error:
+                    return error
+                continue
+            if part.startswith(':') or part.startswith('$'):
+                continue
+            menu = self.missing_menu(part)
+            if menu:
+                return bad_command(menu, script.find(part) + 1)
+            if self.strict and not self.upstream and not self.known(part):
+                self.stats['unknown'].append(part)
+                return bad_command(part.lstrip('/').split()[0], script.find(part) + 1)
+        return None
+
+    def known(self, command):
+        """returns True if command has a fixture"""
+        return command in self.fixtures or command.lstrip('/') in self.fixtures
+
+    def run_part(self, part):
+        """returns output of one script part"""
+        if part.startswith(':put "') and part.endswith('"'):
+            return part[6:-1] + '\r\n'
+        body = do_body(part)
+        if body is None:
+            return self.output(part)
+        parts = split_script(body)
+        parsed = PARSED_COMMAND.match(parts[0]) if len(parts) == 2 else None
+        if not parsed or parts[1] != '$' + parsed.group(1):
+            return self.output(body)
+        command = re.sub(r'\\(.)', r'\1', parsed.group(2))
+        if self.missing_menu(command):
+            return '' # :parse error caught by on-error
+        return self.output(command)
+
+    def save_fixtures(self):
+        """writes recorded fixtures atomically"""
+        folder = os.path.dirname(os.path.abspath(self.fixtures_file))
+        tmpfd, tmppath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(tmpfd, 'w') as tmp:
+            json.dump(self.fixtures, tmp, indent=1, sort_keys=True)
+        os.rename(tmppath, self.fixtures_file)
+
+    def execute(self, channel, command):
+        """answers one exec request"""
+        if command.strip() in REBOOT_COMMANDS:
+            threading.Thread(target=self.reboot).start()
+            output = ''
+        else:
+            output = self.output(command)
+        try:
+            for start in range(0, len(output), OUTPUT_CHUNK):
+                channel.sendall(output[start:start + OUTPUT_CHUNK])
+            channel.send_exit_status(0)
+            channel.shutdown_write() # EOF ends client's read
+        except (socket.error, EOFError):
+            pass
+        # the client (or transport) closes the channel, closing it here
+        # could overtake paramiko's reply to the exec request
+
+    def reboot(self):
+        """drops all connections, installs uploaded packages"""
+        time.sleep(0.2)
+        try: # wakes up accept() in serve
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        for transport in list(self.transports):
+            transport.close()
+        del self.transports[:]
+        time.sleep(self.reboot_time)
+        with self.lock:
+            self.install_packages()
+            if self.on_reboot:
+                self.on_reboot(self)
+        self.listen()
+
+    def install_packages(self):
+        """replaces running version in fixtures with version of uploaded npks"""
+        current = self.fixtures.get(VERSION_QUERY, '').split(' ')[0].strip()
+        version = None
+        for name in os.listdir(self.sftp_root):
+            found = NPK_VERSION.search(name)
+            if found:
+                version = found.group(1)
+                os.unlink(os.path.join(self.sftp_root, name))
+        if current and version and version != current:
+            for command, output in self.fixtures.items():
+                self.fixtures[command] = output.replace(current, version)
+
+class SshServer(paramiko.ServerInterface):
+    """password authentication and exec requests of one connection"""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def check_auth_password(self, username, password):
+        if username == self.emulator.username and password == self.emulator.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.emulator.stats['commands'] += 1
+        worker = threading.Thread(target=self.emulator.execute,
+                                  args=(channel, command))
+        worker.daemon = True
+        worker.start()
+        return True
+
+class SftpHandle(SFTPHandle):
+    """open file on emulated router, counts requests"""
+
+    def __init__(self, stats, flags=0):
+        SFTPHandle.__init__(self, flags)
+        self.stats = stats
+
+    def read(self, offset, length):
+        self.stats['sftp_ops'] += 1
+        return SFTPHandle.read(self, offset, length)
+
+    def write(self, offset, data):
+        self.stats['sftp_ops'] += 1
+        return SFTPHandle.write(self, offset, data)
+
+    def stat(self):
+        self.stats['sftp_ops'] += 1
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as stat_error:
+            return SFTPServer.convert_errno(stat_error.errno)
+
+    def close(self):
+        self.stats['sftp_ops'] += 1
+        SFTPHandle.close(self)
+
+class SftpEmulator(SFTPServerInterface):
+    """router's file system in emulator's sftp_root folder"""
+
+    def __init__(self, server, *args, **kwargs):
+        SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.root = server.emulator.sftp_root
+        self.stats = server.emulator.stats
+
+    def local(self, path):
+        """returns local path of router file"""
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def list_folder(self, path):
+        self.stats['sftp_ops'] += 1
+        try:
+            files = []
+            for name in os.listdir(self.local(path)):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(self.local(path), name)))
+                attr.filename = name
+                files.append(attr)
+            return files
+        except OSError as list_error:
+            return SFTPServer.convert_errno(list_error.errno)
+
+    def stat(self, path):
+        self.stats['sftp_ops'] += 1
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as stat_error:
+            return SFTPServer.convert_errno(stat_error.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        self.stats['sftp_ops'] += 1
+        try:
+            fdesc = os.open(self.local(path), flags, 0644)
+        except OSError as open_error:
+            return SFTPServer.convert_errno(open_error.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+        handle = SftpHandle(self.stats, flags)
+        handle.filename = self.local(path)
+        handle.readfile = handle.writefile = os.fdopen(fdesc, mode)
+        return handle
+
+    def remove(self, path):
+        self.stats['sftp_ops'] += 1
+        try:
+            os.remove(self.local(path))
+        except OSError as remove_error:
+            return SFTPServer.convert_errno(remove_error.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.stats['sftp_ops'] += 1
+        try:
+            os.rename(self.local(oldpath), self.local(newpath))
+        except OSError as rename_error:
+            return SFTPServer.convert_errno(rename_error.errno)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+def parse_opts(cmdline):
+    """returns command line options as dict"""
+    options = dict(EMULATORDEFS)
+    for opt in cmdline:
+        arg, _eq, val = opt.partition('=')
+        arg = arg[2:]
+        if not opt.startswith('--') or arg not in options:
+            print USAGE
+            sys.exit("Unknown option: %s" % opt)
+        if isinstance(options[arg], bool):
+            val = val.lower() not in ('no', 'false')
+        elif isinstance(options[arg], (int, float)):
+            val = type(options[arg])(val)
+        options[arg] = val
+    return options
+
+def main():
+    options = parse_opts(sys.argv[1:])
+    emulator = SshEmulator(options['port'], options['fixtures'], options['sftp_root'],
+                           options['latency'], options['bandwidth'],
+                           options['username'], options['password'],
+                           options['reboot_time'], options['strict'],
+                           options['missing'])
+    if options['record']:
+        emulator.upstream = paramiko.SSHClient()
+        emulator.upstream.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        emulator.upstream.connect(options['record'], port=options['record_port'],
+                                  username=options['record_username'],
+                                  password=options['record_password'],
+                                  allow_agent=False, look_for_keys=False)
+    emulator.start()
+    print "RouterOS SSH emulator listening on 127.0.0.1:%d, sftp root %s" % (
+        emulator.port, emulator.sftp_root)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    if emulator.stats['unknown']:
+        print "Unknown commands:\n" + '\n'.join(sorted(set(emulator.stats['unknown'])))
+
+if __name__ == '__main__':
+    main()
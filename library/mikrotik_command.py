@@ -3,8 +3,12 @@
 """MikroTik RouterOS CLI ansible module"""
 
 import os
+import re
 import sys
 import socket
+import hashlib
+from StringIO import StringIO
+from collections import OrderedDict, Counter
 
 try:
     HAS_SSHCLIENT = True
@@ -20,19 +24,47 @@ else:
     if sys.stdin.isatty():
         SHELLMODE = True
 
+try:
+    from ansible.module_utils.mikrotik_persist import ssh_client
+    from ansible.module_utils.mikrotik_timing import Timings, resolve
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 os.pardir, 'module_utils'))
+    from mikrotik_persist import ssh_client
+    from mikrotik_timing import Timings, resolve
+
 SHELLDEFS = {
     'username': 'admin',
-    'password': '',
+    'password': os.environ.get('MIKROTIK_PASSWORD', ''),
     'key_filename': None,
     'timeout': 30,
     'port': 22,
+    'persistent': False,
+    'persist_timeout': 60,
+    'persist_max': 64,
+    'timings': False,
     'test_change': True,
     'command': None,
     'execute_file': None,
+    'pipeline': True,
     'upload_script': None,
-    'upload_file': None
+    'upload_mode': 'auto',
+    'upload_file': None,
+    'diff': False
 }
 MIKROTIK_MODULE = '[github.com/nekitamo/ansible-mikrotik] v17.07'
+CHANGE_VERBS = ('add', 'set', 'remove', 'enable', 'disable', 'comment', 'move',
+                'unset', 'reset', 'edit', 'import')
+READONLY_VERBS = ('print', 'get', 'export', 'find', 'monitor')
+EXPORT_TIMESTAMP = re.compile(r'^# .+ by RouterOS ')
+ITEM_FIND = re.compile(r'^set \[ (find[^\]]*?) \]')
+EXPORT_ERROR = re.compile(r'^(bad command name |syntax error |expected |failure: )')
+CMD_MARK = '#mtcmd#'
+SCRIPT_CHUNK = 4000
+INLINE_MAX = 4096
+CMD_ERRORS = ('bad command name ', 'syntax error ', 'failure: ')
+ERROR_POSITION = re.compile(r'\(line \d+ column (\d+)\)')
+ITEM_NAME = re.compile(r'\sname=("(?:[^"\\]|\\.)*"|\S+)')
 DOCUMENTATION = """
 ---
 module: mikrotik_command
@@ -45,6 +77,7 @@ return_data:
     - changed
     - stdout
     - stdout_lines
+    - diff
 options:
     command:
         description:
@@ -62,21 +95,69 @@ options:
         required: no
         choices: true, false
         default: false
+    pipeline:
+        description:
+            - Run execute_file commands as scripts of up to 4096 characters, each
+              in a single ssh channel (one round trip), output and errors are
+              still attributed to file lines
+            - Menu commands always run from the root menu, a bare menu line
+              (e.g. /ip address) only sets the menu of following scripting
+              commands (e.g. :foreach i in=[find] do={...})
+            - Execution stops at the first failing line, as with pipeline disabled
+        required: no
+        default: true
     upload_script:
         description:
             - Upload commands from file specified in command and save as a script
+            - The script's sha256 is kept in its comment, unchanged scripts are not uploaded again
         required: no
         default: false
+    upload_mode:
+        description:
+            - How upload_script creates the script, inline sends the source in a single
+              command (limited command length), import uploads an .rsc via sftp which
+              builds the source in chunks and runs it with /import
+            - auto uses import for scripts larger than 4 KB
+        required: no
+        choices: auto, inline, import
+        default: auto
     test_change:
         description:
-            - Test for configuration changes after command execution (slow)
+            - Test for configuration changes after command execution
+            - Only menus touched by plain menu commands (/menu path verb ...) are exported
+              and compared by sha256, scripting (:cmd, [..], ;) falls back to full export
+            - Read-only commands (print, get, export, find, monitor) skip the test
+            - With ansible --diff (or --diff in shell mode) changes are returned per menu
+              section as added, removed and modified items
         required: no
-        default: false
+        default: true
     upload_file:
         description:
             - Upload specified file before command/script execution
         required: no
         default: null
+    timings:
+        description:
+            - Return timings of name lookup, tcp connect, ssh handshake with
+              authentication, every command (seconds and bytes received) and
+              sftp transfers, shell mode prints the slowest commands
+        required: no
+        default: false
+    persistent:
+        description:
+            - Keep the ssh connection open in background and reuse it in later tasks
+        required: no
+        default: false
+    persist_timeout:
+        description:
+            - Seconds an unused persistent connection is kept open
+        required: no
+        default: 60
+    persist_max:
+        description:
+            - Maximum number of open persistent connections, least recently used are closed
+        required: no
+        default: 64
     port:
         description:
             - SSH listening port of the MikroTik device
@@ -115,11 +196,27 @@ stdout_lines:
     description: Returns router response as a list of strings
     returned: always
     type: list
+diff:
+    description: Returns configuration changes, 'prepared' text for ansible --diff output
+                 and 'sections' dict of {menu: {added: [], removed: [], modified: []}}
+    returned: when test_change found changes in diff mode
+    type: dict
+timings:
+    description: seconds of dns, tcp_connect, ssh_connect (handshake), ssh_auth
+                 (or api_connect) and total run, commands list of {command,
+                 seconds, bytes} and sftp list of {operation, path, bytes,
+                 seconds, rate}
+    returned: if timings option was used
+    type: dict
 """
 SHELL_USAGE = """
 mikrotik_command.py --hostname=<hostname> --command=<command>
-        [--run_block] [--upload_script] [--upload_file=<file>]
+        [--execute_file=<file>] [--pipeline=no] [--upload_script=<file>]
+        [--upload_mode=auto|inline|import]
+        [--upload_file=<file>] [--timings]
         [--port=<port>] [--username=<username>] [--password=<password>]
+        [--test_change=no] [--diff]
+(password defaults to MIKROTIK_PASSWORD environment variable)
 """
 
 def safe_fail(module, device=None, **kwargs):
@@ -202,24 +299,320 @@ def sshcmd(module, device, timeout, command):
     if SHELLMODE:
         print "Command: " + str(command)
         sys.exit("Error: " + str(response))
-    safe_fail(module, device, msg=str(ssh_error),
+    safe_fail(module, device, msg=response.strip(),
               description='bad command name or syntax error')
 
+def script_commands(script):
+    """returns (lineno, command) list of script lines, blank and comment
+    lines (also indented ones) left out"""
+    return [(lineno + 1, cmd) for lineno, cmd in enumerate(script)
+            if cmd.strip() and not cmd.lstrip().startswith('#')]
+
+def pipeline_scripts(commands):
+    """returns (script, starts) list of pipelined (lineno, command) list
+
+    Each command is preceded by a :put marker with its file line number,
+    so the output (and an error, which stops the rest) can be attributed.
+    Scripts are kept below INLINE_MAX characters (a longer command gets a
+    script of its own) and menu commands are made absolute, so a bare menu
+    line does not change the menu of the following ones (they run from the
+    root menu, as with pipeline disabled). Scripting commands (':' or '{')
+    are left as they are and do run in the menu of a bare menu line before
+    them, e.g. ':foreach i in=[find] do={...}' after '/ip address'.
+    """
+    scripts = []
+    script = ''
+    starts = []
+    for lineno, command in commands:
+        command = command.strip().rstrip(';')
+        if not command or command.startswith('#'):
+            continue
+        absolute = command
+        if not command.startswith(('/', ':', '{')):
+            absolute = '/' + command
+        part = ':put "%s%d"; ' % (CMD_MARK, lineno)
+        if script and len(script) + len(part) + len(absolute) + 2 > INLINE_MAX:
+            scripts.append((script, starts))
+            script = ''
+            starts = []
+        script += part
+        starts.append((len(script) + 1, lineno, command))
+        script += absolute + '; '
+    if script:
+        scripts.append((script, starts))
+    return scripts
+
+def pipeline_commands(module, device, timeout, commands):
+    """executes (lineno, command) list in as few channels as possible,
+    returns output"""
+    output = []
+    for script, starts in pipeline_scripts(commands):
+        try:
+            _stdin, stdout, _stderr = device.exec_command(script, timeout=timeout)
+            response = stdout.read()
+        except Exception as ssh_error:
+            if SHELLMODE:
+                device.close()
+                sys.exit("SSH command error: " + str(ssh_error))
+            safe_fail(module, device, msg=str(ssh_error),
+                      description='SSH error while executing commands')
+        current = starts[0]
+        for line in response.splitlines():
+            if line.startswith(CMD_MARK):
+                lineno = int(line[len(CMD_MARK):])
+                current = [start for start in starts if start[1] == lineno][0]
+                continue
+            if any(error in line for error in CMD_ERRORS):
+                position = ERROR_POSITION.search(line)
+                if position: # parse error, nothing of this script was executed
+                    column = int(position.group(1))
+                    current = ([start for start in starts if start[0] <= column]
+                               or starts[:1])[-1]
+                if SHELLMODE:
+                    device.close()
+                    if output:
+                        print '\r\n'.join(output)
+                    print "Line %d: %s" % (current[1], current[2])
+                    sys.exit("Error: " + line.strip())
+                safe_fail(module, device, msg=line.strip(),
+                          stdout='\r\n'.join(output), line=current[1],
+                          command=current[2],
+                          description='error in line %d of execute_file' % current[1])
+            if line:
+                output.append(line)
+    return '\r\n'.join(output) + '\r\n' if output else ''
+
+def script_source(script):
+    """returns list of escaped RouterOS string lines of script"""
+    source = []
+    for line in script:
+        line = line.rstrip()
+        line = line.replace("\\", "\\\\")
+        line = line.replace("\"", "\\\"")
+        line = line.replace("$", "\\$")
+        source.append(line + "\\r\\n")
+    return source
+
+def script_import(scriptname, source, comment):
+    """returns .rsc import text which creates script from source in chunks"""
+    find = '[/system script find name="%s"]' % scriptname
+    rsc = '/system script remove %s\n' % find
+    rsc += '/system script add name="%s" comment="%s" source=""\n' % (scriptname,
+                                                                   comment)
+    chunk = ''
+    for line in source + [None]:
+        if line is None or len(chunk) + len(line) > SCRIPT_CHUNK:
+            if chunk:
+                rsc += ('/system script set %s source=([/system script get %s source]'
+                        ' . "%s")\n' % (find, find, chunk))
+            chunk = ''
+        if line is not None:
+            chunk += line
+    return rsc
+
+def upload_import(module, device, timeout, scriptname, rsc):
+    """uploads rsc via sftp and imports it, returns import output"""
+    rscname = scriptname + '.upload.rsc'
+    try:
+        sftp = device.open_sftp()
+        sftp.putfo(StringIO(rsc), rscname)
+        sftp.close()
+    except Exception as sftp_error:
+        if SHELLMODE:
+            device.close()
+            sys.exit("Script upload error: " + str(sftp_error))
+        safe_fail(module, device, msg=str(sftp_error),
+                  description='error uploading script import file')
+    try: # not sshcmd, the file is removed even if the import fails
+        _stdin, stdout, _stderr = device.exec_command(
+            '/import file-name="%s"' % rscname, timeout=timeout)
+        response = stdout.read().strip()
+    except Exception as ssh_error:
+        response = "SSH command error: " + str(ssh_error)
+    sshcmd(module, device, timeout, '/file remove [find name="%s"]' % rscname)
+    if 'successfully' not in response:
+        if SHELLMODE:
+            device.close()
+            sys.exit("Script import error: " + response)
+        safe_fail(module, device, msg=response,
+                  description='error importing script ' + scriptname)
+    return response
+
+def command_menu(command):
+    """returns menu path touched by command, () if read-only, None if unknown
+
+    A change verb outside of any menu (e.g. '/import file.rsc') can touch
+    every menu, so it is unknown as well.
+    """
+    command = command.strip()
+    if not command or command[0] in ':[' or ';' in command:
+        return None
+    path = []
+    for word in re.split(r'[\s/]+', command):
+        if not word:
+            continue
+        if '=' in word or '[' in word or '"' in word:
+            break
+        if word in CHANGE_VERBS:
+            return tuple(path) or None
+        if word in READONLY_VERBS:
+            return ()
+        path.append(word)
+    return None
+
+def change_scope(commands):
+    """returns list of menus to export for commands, None for full export"""
+    menus = set()
+    for command in commands:
+        menu = command_menu(command)
+        if menu is None:
+            return None
+        if menu:
+            menus.add(menu)
+    scope = []
+    for menu in sorted(menus):
+        if not any(menu[:len(parent)] == parent for parent in scope):
+            scope.append(menu)
+    return scope
+
+def export_digest(module, device, timeout, scope, sections=None):
+    """streams export of scope menus (None: everything), returns sha256
+
+    If sections dict is given it is filled with {menu: [item lines]}, with
+    continuation lines joined and comments left out. An error printed by
+    the export fails the module, as its text says nothing about the config.
+    """
+    if scope is None:
+        command = "/export"
+    else:
+        command = "; ".join("/%s export" % " ".join(menu) for menu in scope)
+    try:
+        _stdin, stdout, _stderr = device.exec_command(command, timeout=timeout)
+        digest = hashlib.sha256()
+        menu = None
+        item = ''
+        error = None
+        for line in stdout:
+            if EXPORT_TIMESTAMP.match(line):
+                continue
+            digest.update(line)
+            line = line.rstrip('\r\n')
+            if not item and EXPORT_ERROR.match(line):
+                error = line
+                break
+            if item:
+                line = item + line.lstrip()
+                item = ''
+            if line.endswith('\\'):
+                item = line[:-1]
+            elif sections is None:
+                continue
+            elif line.startswith('/'):
+                menu = line
+                sections.setdefault(menu, [])
+            elif line.strip() and not line.startswith('#'):
+                sections.setdefault(menu, []).append(line)
+    except Exception as ssh_error:
+        if SHELLMODE:
+            device.close()
+            sys.exit("SSH command error: " + str(ssh_error))
+        safe_fail(module, device, msg=str(ssh_error),
+                  description='SSH error while exporting configuration')
+    if error:
+        if SHELLMODE:
+            device.close()
+            print "Command: " + command
+            sys.exit("Export error: " + error)
+        safe_fail(module, device, msg=error,
+                  description='error exporting configuration: ' + command)
+    return digest.hexdigest()
+
+def item_key(line):
+    """returns key identifying a config item: its find selector, name or line"""
+    found = ITEM_FIND.match(line)
+    if found:
+        return found.group(1)
+    if line.startswith('set ') or line == 'set':
+        return 'set'
+    named = ITEM_NAME.search(line)
+    if named:
+        return 'name=' + named.group(1)
+    return line
+
+def lines_only(lines, other):
+    """returns lines not found in other, duplicates are counted"""
+    rest = Counter(other)
+    only = []
+    for line in lines:
+        if rest[line]:
+            rest[line] -= 1
+        else:
+            only.append(line)
+    return only
+
+def config_diff(before, after):
+    """returns {menu: {added, removed, modified}} for changed menu sections"""
+    changes = OrderedDict()
+    for menu in sorted(set(before) | set(after)):
+        old = OrderedDict()
+        new = OrderedDict()
+        for items, lines in ((old, before.get(menu, [])), (new, after.get(menu, []))):
+            for line in lines:
+                items.setdefault(item_key(line), []).append(line)
+        section = {'added': [], 'removed': [], 'modified': []}
+        for key, lines in old.items():
+            if key not in new:
+                section['removed'] += lines
+            elif lines != new[key]:
+                if len(lines) == len(new[key]) == 1:
+                    section['modified'].append({'before': lines[0],
+                                                'after': new[key][0]})
+                else:
+                    section['removed'] += lines_only(lines, new[key])
+                    section['added'] += lines_only(new[key], lines)
+        for key, lines in new.items():
+            if key not in old:
+                section['added'] += lines
+        if section['added'] or section['removed'] or section['modified']:
+            changes[menu] = section
+    return changes
+
+def diff_text(changes):
+    """returns config changes as diff-like text"""
+    text = ''
+    for menu, section in changes.items():
+        text += "%s\n" % menu
+        for line in section['removed']:
+            text += "- %s\n" % line
+        for item in section['modified']:
+            text += "- %s\n+ %s\n" % (item['before'], item['after'])
+        for line in section['added']:
+            text += "+ %s\n" % line
+    return text
+
 def main():
     """RouterOS command line interface main"""
     rosdev = {}
     cmd_timeout = 30
     changed = True
+    diff = None
+    before_sections = after_sections = None
     if not SHELLMODE:
         module = AnsibleModule(
             argument_spec=dict(
                 command=dict(default=None, type='str'),
                 execute_file=dict(default=None, type='path'),
+                pipeline=dict(default=True, type='bool'),
                 upload_script=dict(default=None, type='path'),
+                upload_mode=dict(default='auto', choices=['auto', 'inline', 'import']),
                 test_change=dict(default=True, type='bool'),
                 upload_file=dict(default=None, type='path'),
                 key_filename=dict(default=None, type='path'),
                 port=dict(default=22, type='int'),
+                persistent=dict(default=False, type='bool'),
+                persist_timeout=dict(default=60, type='int'),
+                persist_max=dict(default=64, type='int'),
+                timings=dict(default=False, type='bool'),
                 timeout=dict(default=30, type='float'),
                 hostname=dict(required=True, type='str'),
                 username=dict(default='ansible', type='str'),
@@ -230,50 +623,107 @@ def main():
             safe_fail(module, msg='There was a problem loading module: ',
                       error=str(import_error))
         command = module.params['command']
-        execute_file = module.params['run_block']
+        execute_file = module.params['execute_file']
+        pipeline = module.params['pipeline']
         upload_script = module.params['upload_script']
+        upload_mode = module.params['upload_mode']
         test_change = module.params['test_change']
         upload_file = module.params['upload_file']
+        diff_mode = module._diff
         rosdev['key_filename'] = module.params['key_filename']
         rosdev['hostname'] = module.params['hostname']
         rosdev['username'] = module.params['username']
         rosdev['password'] = module.params['password']
         rosdev['port'] = module.params['port']
+        rosdev['persistent'] = module.params['persistent']
+        rosdev['persist_timeout'] = module.params['persist_timeout']
+        rosdev['persist_max'] = module.params['persist_max']
+        timings = module.params['timings']
         rosdev['timeout'] = module.params['timeout']
 
     else:
         if not HAS_SSHCLIENT:
             sys.exit("SSH client error: " + str(import_error))
-        if not SHELLOPTS['command']:
+        if not (SHELLOPTS['command'] or SHELLOPTS['execute_file']
+                or SHELLOPTS['upload_script']):
             print SHELL_USAGE
             sys.exit("command required, specify with --command=<cmd>")
         rosdev['hostname'] = SHELLOPTS['hostname']
         rosdev['username'] = SHELLOPTS['username']
         rosdev['password'] = SHELLOPTS['password']
         rosdev['port'] = SHELLOPTS['port']
+        rosdev['persistent'] = SHELLOPTS['persistent']
+        rosdev['persist_timeout'] = SHELLOPTS['persist_timeout']
+        rosdev['persist_max'] = SHELLOPTS['persist_max']
+        timings = SHELLOPTS['timings']
         rosdev['timeout'] = SHELLOPTS['timeout']
         rosdev['key_filename'] = SHELLOPTS['key_filename']
         command = SHELLOPTS['command']
         execute_file = SHELLOPTS['execute_file']
+        pipeline = SHELLOPTS['pipeline']
         upload_script = SHELLOPTS['upload_script']
+        upload_mode = SHELLOPTS['upload_mode']
         test_change = SHELLOPTS['test_change']
         upload_file = SHELLOPTS['upload_file']
+        diff_mode = SHELLOPTS['diff']
         module = None
 
+    rosdev['timings'] = Timings() if timings else None
     try:
-        rosdev['ipaddress'] = socket.gethostbyname(rosdev['hostname'])
+        rosdev['ipaddress'] = resolve(rosdev['hostname'], rosdev['timings'])
     except socket.gaierror as dns_error:
         if SHELLMODE:
             sys.exit("Hostname error: " + str(dns_error))
         safe_fail(module, msg=str(dns_error),
                   description='error getting device address from hostname')
 
-    device = paramiko.SSHClient()
-    device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    device = ssh_client(rosdev)
     device_connect(module, device, rosdev)
 
+    script = None
+    script_current = False
+    cmdfile = upload_script or execute_file
+    if cmdfile and os.path.isfile(cmdfile):
+        try:
+            with open(cmdfile) as scriptfile:
+                script = scriptfile.readlines()
+                scriptfile.close()
+        except Exception as cmd_error:
+            if SHELLMODE:
+                device.close()
+                sys.exit("Script file error: " + str(cmd_error))
+            safe_fail(module, device, msg=str(cmd_error),
+                      description='error opening script file')
+
+    if script is not None and upload_script:
+        scriptname = os.path.basename(upload_script)
+        comment = "sha256=" + hashlib.sha256(''.join(script)).hexdigest()
+        current = sshcmd(module, device, cmd_timeout,
+                         ':foreach s in=[/system script find name="%s"] do={'
+                         ':put [/system script get $s comment]}' % scriptname)
+        if current.strip() == comment:
+            script_current = True
+            test_change = False
+            changed = False
+
     if test_change:
-        before = sshcmd(module, device, cmd_timeout, "export")
+        if script is not None and upload_script:
+            scope = [('system', 'script')]
+        elif script is not None:
+            scope = change_scope([cmd for _lineno, cmd in script_commands(script)])
+        elif upload_file and command == 'user ssh-keys import':
+            scope = [('user', 'ssh-keys')]
+        else:
+            scope = change_scope([command or ''])
+        if scope == []:
+            test_change = False
+            changed = False
+        else:
+            if diff_mode:
+                before_sections = OrderedDict()
+                after_sections = OrderedDict()
+            before = export_digest(module, device, cmd_timeout, scope,
+                                   before_sections)
 
     if upload_file and os.path.isfile(upload_file):
         uploaded = os.path.basename(upload_file)
@@ -290,36 +740,31 @@ def main():
             safe_fail(module, device, msg="upload failed!",
                       description='error uploading file: ' + uploaded)
 
-    if upload_script and os.path.isfile(upload_script):
+    if script is not None:
         response = ''
-        try:
-            with open(upload_script) as scriptfile:
-                script = scriptfile.readlines()
-                scriptfile.close()
-        except Exception as cmd_error:
-            if SHELLMODE:
-                device.close()
-                sys.exit("Script file error: " + str(cmd_error))
-            safe_fail(module, device, msg=str(cmd_error),
-                      description='error opening script file')
-        scriptname = os.path.basename(upload_script)
-        response += sshcmd(module, device, cmd_timeout,
-                           '/system script remove [ find name="'
-                           + scriptname + '" ]')
-        cmd = '/system script add name="' + scriptname + '" source="'
-        for line in script:
-            line = line.rstrip()
-            line = line.replace("\\", "\\\\")
-            line = line.replace("\"", "\\\"")
-            line = line.replace("$", "\\$")
-            cmd += line + "\\r\\n"
-        response += sshcmd(module, device, cmd_timeout, cmd + '"')
-        elif run_block:
-            for cmd in script:
-                if cmd[0] != "#":
-                    rsp = sshcmd(module, device, cmd_timeout, cmd)
-                    if rsp:
-                        response += rsp + '\r\n'
+        if upload_script and script_current:
+            response = 'script %s unchanged' % scriptname
+        elif upload_script:
+            source = script_source(script)
+            if upload_mode == 'import' or (upload_mode == 'auto' and
+                                           len(''.join(source)) > INLINE_MAX):
+                response += upload_import(module, device, cmd_timeout, scriptname,
+                                          script_import(scriptname, source, comment))
+            else:
+                response += sshcmd(module, device, cmd_timeout,
+                                   '/system script remove [ find name="'
+                                   + scriptname + '" ]')
+                cmd = ('/system script add name="' + scriptname + '" comment="' +
+                       comment + '" source="' + ''.join(source))
+                response += sshcmd(module, device, cmd_timeout, cmd + '"')
+        elif pipeline:
+            response = pipeline_commands(module, device, cmd_timeout,
+                                         script_commands(script))
+        else:
+            for _lineno, cmd in script_commands(script):
+                rsp = sshcmd(module, device, cmd_timeout, cmd)
+                if rsp:
+                    response += rsp + '\r\n'
     else:
         if upload_file and command == 'user ssh-keys import':
             response = sshcmd(module, device, cmd_timeout,
@@ -331,19 +776,22 @@ def main():
             response += '\r\n'
 
     if test_change:
-        after = sshcmd(module, device, cmd_timeout, "/export")
-        before = before.splitlines(1)[1:]
-        after = after.splitlines(1)[1:]
-        if len(before) == len(after):
-            for bef, aft in zip(before, after):
-                if aft != bef:
-                    break
-            else:
-                changed = False
+        after = export_digest(module, device, cmd_timeout, scope,
+                              after_sections)
+        if after == before:
+            changed = False
+        elif diff_mode:
+            sections = config_diff(before_sections, after_sections)
+            diff = {'prepared': diff_text(sections) or "# item order changed\n",
+                    'sections': sections}
 
     if SHELLMODE:
         device.close()
         print str(response)
+        if diff:
+            print diff['prepared'].rstrip()
+        if timings:
+            print '\n'.join(rosdev['timings'].report())
         sys.exit(0)
 
     stdout_lines = []
@@ -351,8 +799,14 @@ def main():
         if line:
             stdout_lines.append(line.strip())
 
+    extra = {}
+    if timings:
+        extra['timings'] = rosdev['timings'].result()
+    if diff:
+        safe_exit(module, device, stdout=response, stdout_lines=stdout_lines,
+                  changed=changed, diff=diff, **extra)
     safe_exit(module, device, stdout=response, stdout_lines=stdout_lines,
-              changed=changed)
+              changed=changed, **extra)
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 or SHELLMODE:
@@ -6,22 +6,41 @@ import sys
 import re
 import socket
 import os
+import tempfile
+import hashlib
+import fcntl
+import json
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 
 HAS_SSHCLIENT = True
 SHELLMODE = False
+FLEETMODE = False
 SHELLDEFS = {
     'username': 'admin',
-    'password': '',
+    'password': os.environ.get('MIKROTIK_PASSWORD', ''),
     'timeout': 30,
     'port': 22,
+    'persistent': False,
+    'persist_timeout': 60,
+    'persist_max': 64,
+    'timings': False,
     'export_dir': None,
     'export_file' : None,
     'backup_dir': None,
+    'backup_workers': 4,
     'timestamp': False,
     'hide_sensitive': True,
     'local_file': False,
-    'verbose': False
+    'verbose': False,
+    'inventory': None,
+    'workers': 8,
+    'host_timeout': 300
 }
+EXPORT_CHUNK = 65536
+EXPORT_INDEX = '.export_hashes.json'
+BACKUP_CHUNK = 32768
 MIKROTIK_MODULE = '[github.com/nekitamo/ansible-mikrotik] v2017.03.28'
 DOCUMENTATION = """
 ---
@@ -37,8 +56,11 @@ return_data:
     - software_id
     - export_dir
     - export_file
+    - export_digest
+    - previous_digest
     - backup_dir
     - backup_files
+    - backup_downloads
 options:
     export_dir:
         description:
@@ -47,14 +69,23 @@ options:
         default: null
     export_file:
         description:
-            - The name of the exported file, existing files are overwritten
+            - The name of the exported file, existing files are overwritten only if export changed
+            - Export hashes are kept in .export_hashes.json in export_dir to detect changes
         required: false
         default: <identity>_<software_id>.rsc
     backup_dir:
         description:
-            - Directory where all backups are downloaded, existing files are not overwritten
+            - Directory where all backups are downloaded, existing files are only downloaded
+              again if their size or modification time differ from the router's copy
+            - Interrupted downloads are kept as <file>.<mtime>.part and resumed in the next run
+            - With --inventory (shell mode) backups of each router go to backup_dir/<inventory host>
         required: false
         default: null
+    backup_workers:
+        description:
+            - Number of backup files downloaded at once, each over its own sftp session
+        required: false
+        default: 4
     timestamp:
         description:
             - Leave default timestamp in export file (first line), disabled for version tracking
@@ -76,6 +107,28 @@ options:
             - Export verbose config including default option values (large export file)
         required: false
         default: false
+    timings:
+        description:
+            - Return timings of name lookup, tcp connect, ssh handshake with
+              authentication, every command (seconds and bytes received) and
+              sftp transfers, shell mode prints the slowest commands
+        required: no
+        default: false
+    persistent:
+        description:
+            - Keep the ssh connection open in background and reuse it in later tasks
+        required: false
+        default: false
+    persist_timeout:
+        description:
+            - Seconds an unused persistent connection is kept open
+        required: false
+        default: 60
+    persist_max:
+        description:
+            - Maximum number of open persistent connections, least recently used are closed
+        required: false
+        default: 64
     port:
         description:
             - SSH listening port of the MikroTik device
@@ -133,21 +186,44 @@ export_file:
     description: Returns filename of exported configuration
     returned: always
     type: string
+export_digest:
+    description: Returns sha256 of export (header and config without timestamp line)
+    returned: unless local_file option was used
+    type: string
+previous_digest:
+    description: Returns sha256 of previous export with the same export_file
+    returned: unless local_file option was used, null on first export
+    type: string
 backup_dir:
     description: Returns full os path where backups were downloaded
     returned: if backup_dir option was used
     type: string
 backup_files:
-    description: Returns list of downloaded backups
+    description: Returns list of all backups found on the router
     returned: if backup_dir option was used
     type: list
+backup_downloads:
+    description: Returns list of backups (re)downloaded in this run
+    returned: if backup_dir option was used
+    type: list
+timings:
+    description: seconds of dns, tcp_connect, ssh_connect (handshake), ssh_auth
+                 (or api_connect) and total run, commands list of {command,
+                 seconds, bytes} and sftp list of {operation, path, bytes,
+                 seconds, rate}
+    returned: if timings option was used
+    type: dict
 """
 SHELL_USAGE = """
 mikrotik_export.py --hostname=<hostname> --export_dir=<path>
                   [--export_file=<filename>] [--backup_dir=<path>]
+                  [--backup_workers=<n>] [--timings]
                   [--timestamp] [--hide_sensitive=no] [--verbose]
                   [--local_file] [--timeout=<timeout>] [--port=<port>]
                   [--username=<username>] [--password=<password>]
+mikrotik_export.py --inventory=<file> --export_dir=<path>
+                  [--workers=<n>] [--host_timeout=<seconds>] [...]
+(password defaults to MIKROTIK_PASSWORD environment variable)
 """
 
 try:
@@ -155,6 +231,17 @@ try:
 except ImportError as import_error:
     HAS_SSHCLIENT = False
 
+try:
+    from ansible.module_utils.mikrotik_persist import ssh_client
+    from ansible.module_utils.mikrotik_timing import Timings, resolve
+    from ansible.module_utils.mikrotik_inventory import parse_inventory
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 os.pardir, 'module_utils'))
+    from mikrotik_persist import ssh_client
+    from mikrotik_timing import Timings, resolve
+    from mikrotik_inventory import parse_inventory
+
 try:
     from ansible.module_utils.basic import AnsibleModule
 except ImportError:
@@ -192,12 +279,19 @@ def parse_opts(cmdline):
                 elif val.lower() in ('yes', 'true', '1'):
                     val = True
             arg = arg[2:]
+            if arg in ('port', 'timeout', 'workers', 'host_timeout',
+                       'backup_workers') and \
+                    val not in (True, False):
+                try:
+                    val = float(val) if '.' in val else int(val)
+                except ValueError:
+                    sys.exit("Numeric value required: --%s=%s" % (arg, val))
             if arg in options or arg == 'hostname':
                 options[arg] = val
             else:
                 print SHELL_USAGE
                 sys.exit("Unknown option: --%s" % arg)
-    if 'hostname' not in options:
+    if 'hostname' not in options and not options['inventory']:
         print SHELL_USAGE
         sys.exit("Hostname is required, specify with --hostname=<hostname>")
     return options
@@ -205,13 +299,13 @@ def parse_opts(cmdline):
 def device_connect(module, device, rosdev):
     """open ssh connection with or without ssh keys"""
     try:
-        rosdev['hostname'] = socket.gethostbyname(rosdev['hostname'])
+        rosdev['hostname'] = resolve(rosdev['hostname'], rosdev['timings'])
     except socket.gaierror as dns_error:
         if SHELLMODE:
             sys.exit("Hostname error: " + str(dns_error))
         safe_fail(module, device, msg=str(dns_error),
                   description='error getting device address from hostname')
-    if SHELLMODE:
+    if SHELLMODE and not FLEETMODE:
         sys.stdout.write("Opening SSH connection to %s:%s... "
                          % (rosdev['hostname'], rosdev['port']))
         sys.stdout.flush()
@@ -230,7 +324,7 @@ def device_connect(module, device, rosdev):
                 sys.exit("failed!\nSSH error: " + str(ssh_error))
             safe_fail(module, device, msg=str(ssh_error),
                       description='error opening ssh connection to %s' % rosdev['hostname'])
-    if SHELLMODE:
+    if SHELLMODE and not FLEETMODE:
         print "succes."
 
 def sshcmd(module, device, timeout, command):
@@ -248,6 +342,8 @@ def sshcmd(module, device, timeout, command):
             if 'failure: ' not in response:
                 return response.rstrip()
     if SHELLMODE:
+        if FLEETMODE:
+            sys.exit("Command: %s, error: %s" % (command, response.strip()))
         print "Command: " + str(command)
         sys.exit("Error: " + str(response))
     safe_fail(module, device, msg=str(ssh_error),
@@ -263,6 +359,104 @@ def parse_terse(device, key, command):
             vals.append(val.split(' ')[0])
     return vals
 
+def load_digest(index, export_file):
+    """returns stored index entry for export_file or None"""
+    try:
+        with open(index, 'r') as idx:
+            fcntl.flock(idx, fcntl.LOCK_SH)
+            return json.load(idx).get(export_file)
+    except (IOError, ValueError):
+        return None
+
+def save_digest(index, export_file, entry):
+    """stores index entry for export_file, other entries are kept"""
+    with open(index, 'a+') as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        idx.seek(0)
+        try:
+            digests = json.load(idx)
+        except ValueError:
+            digests = {}
+        digests[export_file] = entry
+        idx.seek(0)
+        idx.truncate()
+        json.dump(digests, idx, indent=1, sort_keys=True)
+
+def export_write(module, device, timeout, command, header, path, timestamp,
+                 previous=None):
+    """streams command output through a temp file to path, returns index
+    entry and whether path was (re)written
+
+    Digest covers the header and the export without its timestamp line, the
+    existing file is kept untouched if it matches previous index entry.
+    """
+    try:
+        _stdin, stdout, _stderr = device.exec_command(command, timeout=timeout)
+    except Exception as ssh_error:
+        if SHELLMODE:
+            sys.exit("SSH command error: " + str(ssh_error))
+        safe_fail(module, device, msg=str(ssh_error),
+                  description='SSH error while executing command')
+    head = ''
+    size = written = len(header)
+    skip = True
+    digest = hashlib.sha256(header)
+    tmpfd, tmppath = tempfile.mkstemp(prefix='.' + os.path.basename(path),
+                                      suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        try:
+            with os.fdopen(tmpfd, 'w') as exp:
+                exp.write(header)
+                while True:
+                    chunk = stdout.read(EXPORT_CHUNK)
+                    if not chunk:
+                        break
+                    if len(head) < EXPORT_CHUNK:
+                        head += chunk[:EXPORT_CHUNK - len(head)]
+                    if skip: # timestamp line, it may span chunks
+                        newline = chunk.find('\n')
+                        if timestamp:
+                            stamp = chunk if newline < 0 else chunk[:newline + 1]
+                            exp.write(stamp)
+                            written += len(stamp)
+                        if newline < 0:
+                            continue
+                        chunk = chunk[newline + 1:]
+                        skip = False
+                    digest.update(chunk)
+                    exp.write(chunk)
+                    size += len(chunk)
+                    written += len(chunk)
+            for error in ('bad command name ', 'syntax error ', 'failure: '):
+                if error in head:
+                    if SHELLMODE:
+                        device.close()
+                        if FLEETMODE:
+                            sys.exit("Command: %s, error: %s" % (command, head.strip()))
+                        print "Command: " + str(command)
+                        sys.exit("Error: " + head.rstrip())
+                    safe_fail(module, device, msg=head.rstrip(),
+                              description='bad command name or syntax error')
+            entry = {'sha256': digest.hexdigest(), 'size': size,
+                     'timestamp': bool(timestamp)}
+            if entry == previous and os.path.exists(path) and \
+                    (timestamp or os.path.getsize(path) == written):
+                return entry, False
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmppath, 0666 & ~umask)
+            os.rename(tmppath, path)
+            return entry, True
+        except (IOError, OSError, socket.error) as export_error:
+            if SHELLMODE:
+                device.close()
+                sys.exit("Export file error: " + str(export_error))
+            safe_fail(module, device, msg=str(export_error),
+                      description='error writing to export file')
+    finally:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+
 def parse_facts(device, command, pfx=""):
     """executes a command and returns dict"""
     _stdin, stdout, _stderr = device.exec_command(command)
@@ -283,17 +477,139 @@ def vercmp(ver1, ver2):
         return [int(x) for x in re.sub(r'(\.0+)*$', '', ver).split(".")]
     return cmp(normalize(ver1), normalize(ver2))
 
-def main():
+def backup_current(attr, backup_dir):
+    """checks if local backup matches remote size and modification time"""
+    try:
+        local = os.stat(os.path.join(backup_dir, attr.filename))
+    except OSError:
+        return False
+    return local.st_size == attr.st_size and int(local.st_mtime) == attr.st_mtime
+
+def backup_cleanup(backup_dir, filename, keep=None):
+    """removes partial downloads of filename except keep"""
+    for part in os.listdir(backup_dir):
+        if part.startswith(filename + '.') and part.endswith('.part') \
+                and part != keep:
+            os.unlink(os.path.join(backup_dir, part))
+
+def backup_download(device, attr, backup_dir):
+    """downloads one backup over its own sftp session, resumes .part files"""
+    bkp = os.path.join(backup_dir, attr.filename)
+    part = "%s.%d.part" % (bkp, attr.st_mtime)
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        if offset > attr.st_size:
+            offset = 0
+    backup_cleanup(backup_dir, attr.filename, os.path.basename(part))
+    sftp = device.open_sftp()
+    try:
+        with sftp.open(attr.filename, 'rb') as remote:
+            remote.seek(offset)
+            remote.prefetch(attr.st_size)
+            with open(part, 'ab' if offset else 'wb') as local:
+                while True:
+                    data = remote.read(BACKUP_CHUNK)
+                    if not data:
+                        break
+                    local.write(data)
+    finally:
+        sftp.close()
+    if os.path.getsize(part) != attr.st_size:
+        raise IOError("%s: got %d of %d bytes" % (attr.filename,
+                                                  os.path.getsize(part), attr.st_size))
+    os.utime(part, (attr.st_atime or attr.st_mtime, attr.st_mtime))
+    os.rename(part, bkp)
+    return attr.filename
+
+def fleet_export(host, options, host_timeout):
+    """runs main() for one inventory host in a thread, returns result dict"""
+    result = {'host': host, 'error': None}
+    def export():
+        try:
+            main(options, result)
+        except SystemExit as exit_error:
+            result['error'] = ' '.join(str(exit_error.code).split())
+        except Exception as export_error:
+            result['error'] = str(export_error) or repr(export_error)
+    started = time.time()
+    worker = threading.Thread(target=export)
+    worker.daemon = True
+    worker.start()
+    worker.join(host_timeout)
+    device = result.pop('device', None)
+    timed_out = worker.is_alive()
+    summary = dict(result)
+    if timed_out:
+        summary['error'] = "timeout after %ss" % host_timeout
+    if device: # also unblocks a timed out worker
+        device.close()
+    summary['duration'] = time.time() - started
+    return summary
+
+def fleet(options):
+    """exports all inventory hosts with bounded parallelism, prints summary"""
+    if options['export_file']:
+        sys.exit("export_file can not be used with --inventory")
+    if not options['export_dir']:
+        print SHELL_USAGE
+        sys.exit("export_dir required, specify with --export_dir=<path>")
+    try:
+        hosts = parse_inventory(options['inventory'])
+    except IOError as inventory_error:
+        sys.exit("Inventory error: " + str(inventory_error))
+    for directory in (options['export_dir'], options['backup_dir']):
+        if directory and not os.path.exists(os.path.expanduser(directory)):
+            try:
+                os.mkdir(os.path.expanduser(directory), 0775)
+            except OSError as mkdir_error:
+                sys.exit("Directory error: " + str(mkdir_error))
+    host_timeout = float(options['host_timeout'])
+    pool = ThreadPool(max(1, min(int(options['workers']), len(hosts) or 1)))
+    jobs = []
+    for host, opts in hosts:
+        host_options = dict(options, **opts)
+        if options['backup_dir']: # backup names are often the same on every router
+            host_options['backup_dir'] = os.path.join(options['backup_dir'], host)
+        jobs.append(pool.apply_async(fleet_export, (host, host_options, host_timeout)))
+    pool.close()
+    failed = 0
+    print "%-24s %-7s %9s %12s %-7s %s" % ('host', 'status', 'seconds', 'bytes',
+                                         'changed', 'export_file / error')
+    for job in jobs:
+        result = job.get()
+        if result['error']:
+            failed += 1
+            print "%-24s %-7s %9.2f %12s %-7s %s" % (result['host'], 'FAILED',
+                                                     result['duration'], '-', '-',
+                                                     result['error'])
+        else:
+            print "%-24s %-7s %9.2f %12d %-7s %s" % (result['host'], 'ok',
+                                                     result['duration'], result['bytes'],
+                                                     result['changed'],
+                                                     result['export_file'])
+            for line in result.get('timings', []):
+                print "    " + line
+    pool.join()
+    print "%d hosts, %d ok, %d failed" % (len(jobs), len(jobs) - failed, failed)
+    sys.exit(1 if failed else 0)
+
+def main(options=None, result=None):
     rosdev = {}
     backup_files = []
+    backup_downloads = []
     cmd_timeout = 30
     changed = False
+    export_digest = None
+    previous_digest = None
+    export_size = None
     if not SHELLMODE:
         module = AnsibleModule(
             argument_spec=dict(
                 export_dir=dict(required=True, type='path'),
                 export_file=dict(required=False, type='str'),
                 backup_dir=dict(required=False, type='path'),
+                backup_workers=dict(default=4, type='int'),
                 timestamp=dict(default=False, type='bool'),
                 hide_sensitive=dict(default=True, type='bool'),
                 local_file=dict(default=False, type='bool'),
@@ -302,6 +618,10 @@ def main():
                 username=dict(default='ansible', type='str'),
                 password=dict(default='', type='str', no_log=True),
                 port=dict(default=22, type='int'),
+                persistent=dict(default=False, type='bool'),
+                persist_timeout=dict(default=60, type='int'),
+                persist_max=dict(default=64, type='int'),
+                timings=dict(default=False, type='bool'),
                 timeout=dict(default=30, type='float')
             ), supports_check_mode=False
         )
@@ -311,6 +631,7 @@ def main():
         export_dir = os.path.expanduser(module.params['export_dir'])
         export_file = module.params['export_file']
         backup_dir = module.params['backup_dir']
+        backup_workers = module.params['backup_workers']
         timestamp = module.params['timestamp']
         hide_sensitive = module.params['hide_sensitive']
         local_file = module.params['local_file']
@@ -319,26 +640,37 @@ def main():
         rosdev['username'] = module.params['username']
         rosdev['password'] = module.params['password']
         rosdev['port'] = module.params['port']
+        rosdev['persistent'] = module.params['persistent']
+        rosdev['persist_timeout'] = module.params['persist_timeout']
+        rosdev['persist_max'] = module.params['persist_max']
+        timings = module.params['timings']
         rosdev['timeout'] = module.params['timeout']
 
     else:
+        if not options:
+            options = SHELLOPTS
         if not HAS_SSHCLIENT:
             sys.exit("SSH client error: " + str(import_error))
-        if not SHELLOPTS['export_dir']:
+        if not options['export_dir']:
             print SHELL_USAGE
             sys.exit("export_dir required, specify with --export_dir=<path>")
-        export_dir = os.path.expanduser(SHELLOPTS['export_dir'])
-        rosdev['hostname'] = SHELLOPTS['hostname']
-        rosdev['username'] = SHELLOPTS['username']
-        rosdev['password'] = SHELLOPTS['password']
-        rosdev['port'] = SHELLOPTS['port']
-        rosdev['timeout'] = SHELLOPTS['timeout']
-        hide_sensitive = SHELLOPTS['hide_sensitive']
-        export_file = SHELLOPTS['export_file']
-        backup_dir = SHELLOPTS['backup_dir']
-        timestamp = SHELLOPTS['timestamp']
-        local_file = SHELLOPTS['local_file']
-        verbose = SHELLOPTS['verbose']
+        export_dir = os.path.expanduser(options['export_dir'])
+        rosdev['hostname'] = options['hostname']
+        rosdev['username'] = options['username']
+        rosdev['password'] = options['password']
+        rosdev['port'] = options['port']
+        rosdev['persistent'] = options['persistent']
+        rosdev['persist_timeout'] = options['persist_timeout']
+        rosdev['persist_max'] = options['persist_max']
+        timings = options['timings']
+        rosdev['timeout'] = options['timeout']
+        hide_sensitive = options['hide_sensitive']
+        export_file = options['export_file']
+        backup_dir = options['backup_dir']
+        backup_workers = options['backup_workers']
+        timestamp = options['timestamp']
+        local_file = options['local_file']
+        verbose = options['verbose']
         module = None
 
     export_dir = os.path.realpath(export_dir)
@@ -351,8 +683,10 @@ def main():
             safe_fail(module, msg=str(mkdir_error),
                       description='error creating export directory')
 
-    device = paramiko.SSHClient()
-    device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    rosdev['timings'] = Timings() if timings else None
+    device = ssh_client(rosdev)
+    if result is not None:
+        result['device'] = device
     device_connect(module, device, rosdev)
 
     version = sshcmd(module, device, cmd_timeout,
@@ -375,28 +709,32 @@ def main():
     if local_file:
         exportcmd += " file=ansible-export"
         changed = True
-    response = sshcmd(module, device, cmd_timeout, exportcmd)
+    header = ("# " + rosdev['username'] + "@" + identity +
+              ", RouterOS " + version + ": " + exportcmd + "\n")
     if local_file:
+        sshcmd(module, device, cmd_timeout, exportcmd)
         sftp = device.open_sftp()
         sftp.get("/ansible-export.rsc", exportfull)
         sftp.close()
+        export_size = os.path.getsize(exportfull)
     else:
-        try:
-            with open(exportfull, 'w') as exp:
-                exp.write("# " + rosdev['username'] + "@" + identity +
-                          ", RouterOS " + version +": " + exportcmd + "\n")
-                if timestamp:
-                    exp.write(response)
-                else:
-                    no_ts = response.splitlines(1)[1:]
-                    exp.writelines(no_ts)
-                exp.close()
-        except Exception as export_error:
-            if SHELLMODE:
-                device.close()
-                sys.exit("Export file error: " + str(export_error))
-            safe_fail(module, device, msg=str(export_error),
-                      description='error writing to export file')
+        index = os.path.join(export_dir, EXPORT_INDEX)
+        previous = load_digest(index, export_file)
+        entry, changed = export_write(module, device, cmd_timeout, exportcmd,
+                                      header, exportfull, timestamp, previous)
+        export_digest = entry['sha256']
+        export_size = entry['size']
+        if previous:
+            previous_digest = previous['sha256']
+        if entry != previous:
+            try:
+                save_digest(index, export_file, entry)
+            except IOError as index_error:
+                if SHELLMODE:
+                    device.close()
+                    sys.exit("Export index error: " + str(index_error))
+                safe_fail(module, device, msg=str(index_error),
+                          description='error writing export hash index')
     if backup_dir:
         backup_dir = os.path.expanduser(backup_dir)
         backup_dir = os.path.realpath(backup_dir)
@@ -410,32 +748,72 @@ def main():
                 safe_fail(module, device, msg=str(mkdir_error),
                           description='error creating backup directory')
         sftp = device.open_sftp()
-        listdir = sftp.listdir()
-        for item in listdir:
-            if item.endswith('.backup'):
-                bkp = os.path.join(backup_dir, item)
-                if not os.path.exists(bkp):
-                    sftp.get(item, bkp)
-                backup_files.append(item)
+        listdir = sftp.listdir_attr()
         sftp.close()
+        downloads = []
+        for attr in listdir:
+            if attr.filename.endswith('.backup'):
+                backup_files.append(attr.filename)
+                if backup_current(attr, backup_dir):
+                    backup_cleanup(backup_dir, attr.filename)
+                else:
+                    downloads.append(attr)
+        if downloads:
+            pool = ThreadPool(max(1, min(int(backup_workers), len(downloads))))
+            jobs = [pool.apply_async(backup_download, (device, attr, backup_dir))
+                    for attr in downloads]
+            pool.close()
+            try:
+                for job in jobs:
+                    backup_downloads.append(job.get())
+            except Exception as backup_error:
+                pool.join()
+                if SHELLMODE:
+                    device.close()
+                    sys.exit("Backup download error: " + str(backup_error))
+                safe_fail(module, device, msg=str(backup_error),
+                          description='error downloading backup files')
+            pool.join()
+
+    if result is not None:
+        device.close()
+        result.update(export_file=export_file, bytes=export_size,
+                      changed=changed, export_digest=export_digest)
+        if timings:
+            result['timings'] = rosdev['timings'].report()
+        return
 
     if SHELLMODE:
         device.close()
         print "export_dir: %s" % export_dir
         print "export_file: %s" % export_file
+        if export_digest:
+            print "export_digest: %s" % export_digest
+            print "changed: %s" % changed
         if backup_dir:
             print "backup_dir: %s" % backup_dir
             print "backup_files: %s" % ', '.join(backup_files)
+            print "backup_downloads: %s" % ', '.join(backup_downloads)
+        if timings:
+            print '\n'.join(rosdev['timings'].report())
         sys.exit(0)
 
+    extra = {}
+    if timings:
+        extra['timings'] = rosdev['timings'].result()
     safe_exit(module, device, changed=changed,
               export_file=export_file, export_dir=export_dir,
+              export_digest=export_digest, previous_digest=previous_digest,
               backup_files=backup_files, backup_dir=backup_dir,
-              identity=identity, software_id=software_id)
+              backup_downloads=backup_downloads,
+              identity=identity, software_id=software_id, **extra)
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 or SHELLMODE:
         print "Ansible MikroTik Library %s" % MIKROTIK_MODULE
         SHELLOPTS = parse_opts(sys.argv)
         SHELLMODE = True
+        if SHELLOPTS['inventory']:
+            FLEETMODE = True
+            fleet(SHELLOPTS)
     main()
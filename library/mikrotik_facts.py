@@ -2,19 +2,36 @@
 # coding: utf-8
 """MikroTik RouterOS ansible facts gathering module"""
 
+import os
 import sys
 import re
+import json
+import time
 import socket
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 HAS_SSHCLIENT = True
 SHELLMODE = False
 SHELLDEFS = {
     'username': 'admin',
-    'password': '',
+    'password': os.environ.get('MIKROTIK_PASSWORD', ''),
     'key_filename': None,
     'timeout': 30,
     'port': 22,
-    'verbose': False
+    'persistent': False,
+    'persist_timeout': 60,
+    'persist_max': 64,
+    'timings': False,
+    'verbose': False,
+    'gather_subset': 'all',
+    'batch': False,
+    'workers': 1,
+    'cache': 'bypass',
+    'cache_dir': '~/.ansible/mikrotik_facts',
+    'transport': 'ssh',
+    'api_port': 0,
+    'api_ssl': False
 }
 MIKROTIK_MODULE = '[github.com/nekitamo/ansible-mikrotik] v2017.07'
 DOCUMENTATION = """
@@ -43,6 +60,82 @@ options:
             - Gather even more device facts (slower)
         required: no
         default: false
+    gather_subset:
+        description:
+            - Fact groups to collect, 'all' or a list of hardware, interfaces,
+              addressing, packages, services, ntp, snmp, wireless, ipv6 and
+              management, prefix a group with '!' to exclude it ('!all' gathers
+              only the always collected system facts)
+            - wireless and ipv6 facts depend on enabled packages, so selecting
+              them also gathers the packages group
+            - Groups named here (e.g. ntp, not all) are gathered with their
+              verbose facts too, as if verbose was set for them
+        required: no
+        default: all
+    batch:
+        description:
+            - Send all fact queries to the device as a single script (one round trip)
+        required: no
+        default: false
+    workers:
+        description:
+            - Number of fact queries executed concurrently over separate ssh channels
+        required: no
+        default: 1
+    cache:
+        description:
+            - Local fact cache usage, 'use' returns still valid cached fact groups
+              and queries only the rest, 'refresh' queries everything and updates
+              the cache, 'bypass' does not touch the cache at all
+        required: no
+        choices: ['use', 'refresh', 'bypass']
+        default: bypass
+    cache_dir:
+        description:
+            - Directory with cached facts (<identity>_<software_id>.json files)
+        required: no
+        default: ~/.ansible/mikrotik_facts
+    transport:
+        description:
+            - Query the device over ssh (CLI output parsing) or over RouterOS
+              API service, which returns structured records and answers all
+              fact queries pipelined over one connection (one round trip);
+              cache probe and management detection also use the API
+        required: no
+        choices: ['ssh', 'api']
+        default: ssh
+    api_port:
+        description:
+            - RouterOS API listening port (default 8728, or 8729 with api_ssl)
+        required: no
+        default: 0
+    api_ssl:
+        description:
+            - Use TLS (api-ssl service) for API transport
+        required: no
+        default: false
+    timings:
+        description:
+            - Return timings of name lookup, tcp connect, ssh handshake with
+              authentication, every command (seconds and bytes received) and
+              sftp transfers, shell mode prints the slowest commands
+        required: no
+        default: false
+    persistent:
+        description:
+            - Keep the ssh connection open in background and reuse it in later tasks
+        required: no
+        default: false
+    persist_timeout:
+        description:
+            - Seconds an unused persistent connection is kept open
+        required: no
+        default: 60
+    persist_max:
+        description:
+            - Maximum number of open persistent connections, least recently used are closed
+        required: no
+        default: 64
     port:
         description:
             - SSH listening port of the MikroTik device
@@ -70,23 +163,172 @@ EXAMPLES = """
     mikrotik_facts:
         hostname: "{{ inventory_hostname }}"
         username: admin
+
+- name: Gather only RouterOS version and packages
+    mikrotik_facts:
+        hostname: "{{ inventory_hostname }}"
+        gather_subset: packages
 """
 RETURN = """
 ansible_facts:
     description: Returns facts collected from the device
     returned: always
     type: dict
+cached_groups:
+    description: Fact groups returned from local cache
+    returned: always
+    type: list
+timings:
+    description: seconds of dns, tcp_connect, ssh_connect (handshake), ssh_auth
+                 (or api_connect) and total run, commands list of {command,
+                 seconds, bytes} and sftp list of {operation, path, bytes,
+                 seconds, rate}
+    returned: if timings option was used
+    type: dict
 """
 SHELL_USAGE = """
-mikrotik_facts.py --hostname=<hostname> [--verbose] [--port=<port>]
-                 [--username=<username>] [--password=<password>]
+mikrotik_facts.py --hostname=<hostname> [--verbose] [--gather_subset=<groups>]
+                 [--batch] [--workers=<n>] [--timings]
+                 [--cache=use|refresh|bypass] [--cache_dir=<path>]
+                 [--transport=ssh|api] [--api_port=<port>] [--api_ssl]
+                 [--port=<port>] [--username=<username>] [--password=<password>]
+(password defaults to MIKROTIK_PASSWORD environment variable)
 """
+# fact queries: terse queries store list of 'key' values of (optionally
+# 'match'ing) records as 'fact', others add all "name: value" lines (with
+# optional 'prefix'), 'package' queries run only if that package is enabled,
+# 'optional' facts are omitted when empty; each distinct command is
+# executed only once per run and shared by all queries using it
+FACT_QUERIES = [
+    {'group': 'management', 'fact': 'user_ssh_keys', 'key': 'key-owner',
+     'optional': True,
+     'command': "user ssh-keys print terse where user=%(username)s"},
+    {'group': 'system',
+     'command': "system resource print without-paging"},
+    {'group': 'hardware',
+     'command': "system routerboard print without-paging"},
+    {'group': 'system', 'prefix': "health_",
+     'command': "system health print without-paging"},
+    {'group': 'hardware', 'prefix': "license_",
+     'command': "system license print without-paging"},
+    {'group': 'services', 'prefix': "cloud_",
+     'command': "ip cloud print without-paging"},
+    {'group': 'packages', 'fact': 'enabled_packages', 'key': 'name',
+     'match': 'enabled',
+     'command': "system package print terse without-paging"},
+    {'group': 'interfaces', 'fact': 'enabled_interfaces', 'key': 'name',
+     'match': 'enabled',
+     'command': "interface print terse without-paging"},
+    {'group': 'addressing', 'fact': 'ip_addresses', 'key': 'address',
+     'command': "ip address print terse without-paging where disabled=no"},
+    {'group': 'interfaces', 'fact': 'mac_addresses', 'key': 'mac-address',
+     'match': 'enabled',
+     'command': "interface print terse without-paging"},
+    {'group': 'services', 'fact': 'remote_syslog', 'key': 'remote',
+     'command': "system logging action print terse without-paging"},
+    {'group': 'services', 'fact': 'email_server', 'key': 'address',
+     'optional': True,
+     'command': "tool e-mail export hide-sensitive"},
+    {'group': 'wireless', 'fact': 'wireless_interfaces', 'key': 'name',
+     'optional': True, 'package': 'wireless',
+     'command': "interface wireless print terse without-paging"},
+    {'group': 'ipv6', 'fact': 'ipv6_addresses', 'key': 'address',
+     'package': 'ipv6',
+     'command': "ipv6 address print terse without-paging where disabled=no"},
+    {'group': 'services', 'prefix': "ssh_", 'verbose': True,
+     'command': "ip ssh print without-paging"},
+    {'group': 'addressing', 'prefix': "ipv4_", 'verbose': True,
+     'command': "ip settings print without-paging"},
+    {'group': 'system', 'prefix': "clock_", 'verbose': True,
+     'command': "system clock print without-paging"},
+    {'group': 'snmp', 'prefix': "snmp_", 'verbose': True,
+     'command': "snmp print without-paging"},
+    {'group': 'packages', 'fact': 'disabled_packages', 'key': 'name',
+     'match': 'disabled', 'verbose': True,
+     'command': "system package print terse without-paging"},
+    {'group': 'packages', 'fact': 'scheduled_packages', 'key': 'name',
+     'match': 'scheduled', 'verbose': True,
+     'command': "system package print terse without-paging"},
+    {'group': 'interfaces', 'fact': 'disabled_interfaces', 'key': 'name',
+     'match': 'disabled', 'verbose': True,
+     'command': "interface print terse without-paging"},
+    {'group': 'interfaces', 'prefix': "bridge_", 'verbose': True,
+     'command': "interface bridge settings print without-paging"},
+    {'group': 'services', 'prefix': "conntrack_", 'verbose': True,
+     'command': "ip firewall connection tracking print without-paging"},
+    {'group': 'management', 'fact': 'users', 'key': 'name', 'verbose': True,
+     'command': "user print terse without-paging where disabled=no"},
+    {'group': 'management', 'fact': 'mac_server_interfaces', 'key': 'interface',
+     'verbose': True,
+     'command': "tool mac-server print terse without-paging where disabled=no"},
+    {'group': 'management', 'fact': 'mac_winbox_interfaces', 'key': 'interface',
+     'verbose': True,
+     'command': "tool mac-server mac-winbox print terse without-paging where disabled=no"},
+    {'group': 'services', 'fact': 'ip_services', 'key': 'name', 'verbose': True,
+     'command': "ip service print terse without-paging where disabled=no"},
+    {'group': 'management', 'fact': 'neighbor_discovery_interfaces', 'key': 'name',
+     'verbose': True,
+     'command': "ip neighbor discovery print terse without-paging where disabled=no"},
+    {'group': 'interfaces', 'fact': 'ethernet_interfaces', 'key': 'name',
+     'verbose': True,
+     'command': "interface ethernet print terse without-paging"},
+    {'group': 'interfaces', 'fact': 'ethernet_switch_types', 'key': 'type',
+     'verbose': True,
+     'command': "interface ethernet switch print terse without-paging"},
+    {'group': 'interfaces', 'fact': 'bridge_interfaces', 'key': 'name',
+     'verbose': True,
+     'command': "interface bridge print terse without-paging"},
+    {'group': 'ntp', 'prefix': "ntp_client_", 'verbose': True,
+     'command': "system ntp client print without-paging"},
+    {'group': 'ntp', 'prefix': "ntp_server_", 'verbose': True, 'package': 'ntp',
+     'command': "system ntp server print without-paging"},
+    {'group': 'ipv6', 'prefix': "ipv6_", 'verbose': True, 'package': 'ipv6',
+     'command': "ipv6 settings print without-paging"},
+]
+FACT_GROUPS = ['system', 'hardware', 'interfaces', 'addressing', 'packages',
+               'services', 'ntp', 'snmp', 'wireless', 'ipv6', 'management']
+# seconds cached facts of each group stay valid (0 - never cached), cache
+# entries are also dropped after reboot and, except for hardware, after any
+# configuration change (system history)
+CACHE_TTL = {
+    'system': 0,
+    'management': 0,
+    'hardware': 86400,
+    'packages': 86400,
+    'interfaces': 3600,
+    'addressing': 3600,
+    'services': 3600,
+    'ntp': 3600,
+    'snmp': 3600,
+    'wireless': 3600,
+    'ipv6': 3600,
+}
+CACHE_PROBE = (':put [/system identity get name]; '
+               ':do {:put [/system license get software-id]} on-error={:put ""}; '
+               ':put [/system resource get uptime]; '
+               ':put [:len [/system history find]]')
+BATCH_MARK = '#mtfacts#'
 
 try:
     import paramiko
 except ImportError as import_error:
     HAS_SSHCLIENT = False
 
+try:
+    from ansible.module_utils.mikrotik_persist import ssh_client
+    from ansible.module_utils.mikrotik_timing import Timings, resolve, timed_client
+    from ansible.module_utils.mikrotik_api import ApiClient, ApiError, \
+        cli_sentence, cli_value, api_records
+    from ansible.module_utils.mikrotik_terse import terse_records
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 os.pardir, 'module_utils'))
+    from mikrotik_persist import ssh_client
+    from mikrotik_timing import Timings, resolve, timed_client
+    from mikrotik_api import ApiClient, ApiError, cli_sentence, cli_value, \
+        api_records
+    from mikrotik_terse import terse_records
+
 try:
     from ansible.module_utils.basic import AnsibleModule
 except ImportError:
@@ -158,6 +400,36 @@ def device_connect(module, device, rosdev):
     if SHELLMODE:
         print "succes."
 
+def api_connect(module, device, rosdev):
+    """open RouterOS API (api-ssl) connection"""
+    if SHELLMODE:
+        sys.stdout.write("Opening API%s connection to %s(%s:%s)... "
+                         % (' TLS' if rosdev['api_ssl'] else '', rosdev['hostname'],
+                            rosdev['ipaddress'], rosdev['api_port'] or 'default'))
+        sys.stdout.flush()
+    try:
+        device.connect(rosdev['ipaddress'], port=rosdev['api_port'],
+                       username=rosdev['username'], password=rosdev['password'],
+                       use_ssl=rosdev['api_ssl'])
+    except Exception as api_error:
+        if SHELLMODE:
+            sys.exit("failed!\nAPI error: " + str(api_error))
+        safe_fail(module, device, msg=str(api_error),
+                  description='error opening api connection to %s(%s:%s)' %
+                  (rosdev['hostname'], rosdev['ipaddress'], rosdev['api_port']))
+    if SHELLMODE:
+        print "succes."
+
+def apitalk(module, device, sentences):
+    """sends API sentences at once, returns list of (records, done, trap)"""
+    try:
+        return device.talk(sentences)
+    except (ApiError, socket.error) as api_error:
+        if SHELLMODE:
+            sys.exit("API command error: " + str(api_error))
+        safe_fail(module, device, msg=str(api_error),
+                  description='API error while executing commands')
+
 def sshcmd(module, device, timeout, command):
     """executes a command on the device, returns string"""
     try:
@@ -178,21 +450,25 @@ def sshcmd(module, device, timeout, command):
     safe_fail(module, device, msg=str(ssh_error),
               description='bad command name or syntax error')
 
-def parse_terse(device, key, command):
-    """executes a command and returns list"""
-    _stdin, stdout, _stderr = device.exec_command(command)
-    vals = []
-    for line in stdout.readlines():
-        if key in line:
-            val = line.split(key+'=')[1]
-            vals.append(val.split(' ')[0])
-    return vals
+def record_match(record, match):
+    """checks record against 'enabled', 'disabled' or 'scheduled' match"""
+    if match == 'enabled':
+        return 'X' not in record['.flags']
+    if match == 'disabled':
+        return 'X' in record['.flags']
+    if match == 'scheduled':
+        return 'scheduled' in record.get('scheduled', '')
+    return True
 
-def parse_facts(device, command, pfx=""):
-    """executes a command and returns dict"""
-    _stdin, stdout, _stderr = device.exec_command(command)
+def terse_list(records, key, match=None):
+    """returns list of key values from (matching) terse records"""
+    return [record[key] for record in records
+            if key in record and record_match(record, match)]
+
+def facts_dict(lines, pfx=""):
+    """returns dict from "name: value" print lines"""
     facts = {}
-    for line in stdout.readlines():
+    for line in lines:
         if ':' in line:
             fact, value = line.partition(":")[::2]
             fact = fact.replace('-', '_')
@@ -202,6 +478,224 @@ def parse_facts(device, command, pfx=""):
                 facts[fact.strip()] = str(value.strip())
     return facts
 
+def query_lines(device, command):
+    """executes a command and returns output lines"""
+    _stdin, stdout, _stderr = device.exec_command(command)
+    return stdout.readlines()
+
+def parse_terse(device, key, command):
+    """executes a command and returns list"""
+    return terse_list(terse_records(query_lines(device, command)), key)
+
+def parse_facts(device, command, pfx=""):
+    """executes a command and returns dict"""
+    return facts_dict(query_lines(device, command), pfx)
+
+def query_all(device, commands, pool=None):
+    """executes commands (concurrently with pool), returns list of output lines"""
+    if pool:
+        return pool.map(lambda command: query_lines(device, command), commands)
+    return [query_lines(device, command) for command in commands]
+
+def parse_management(device, rosdev):
+    """returns management source ip and interface of this ssh session"""
+    mgmt = None
+    src = parse_terse(device, "address",
+            'user active print terse where name="' + rosdev['username'] + '" and via=ssh')
+    if len(src) != 1:
+        return None, None
+    con = parse_terse(device, "dst-address",
+        'ip firewall connection print terse where tcp-state=established and '
+        + 'src-address~"' + src[0] + '" and dst-address~".*:' + str(rosdev['port'])
+        + '"')
+    if len(con) == 1:
+        ifc = parse_terse(device, "interface",
+            'ip address print terse where address~"' + str(con[0]).split(":")[0] + '"')
+    else:
+        ifc = parse_terse(device, "interface",
+            'ip address print terse where address~"' + rosdev['ipaddress'] + '"')
+    if len(ifc) == 1:
+        mgmt = str(ifc[0])
+    return src[0], mgmt
+
+def script_string(command):
+    """returns command as RouterOS string literal contents"""
+    for char in ('\\', '"', '$'):
+        command = command.replace(char, '\\' + char)
+    return command
+
+def parse_batch(module, device, timeout, commands):
+    """executes commands as a single script, returns list of output lines
+
+    RouterOS parses the whole script before running it, so a menu of a
+    missing package (wireless, ipv6, ntp...) would fail all of it: every
+    command is compiled with :parse only when its turn comes, a failing
+    one just leaves its output empty.
+    """
+    script = []
+    for idx, command in enumerate(commands):
+        if command[0] not in '/:':
+            command = '/' + command
+        script.append(':put "%s%d"' % (BATCH_MARK, idx))
+        script.append(':do {:local cmd [:parse "%s"]; $cmd} on-error={}'
+                      % script_string(command))
+    response = sshcmd(module, device, timeout, '; '.join(script))
+    outputs = [[] for _command in commands]
+    section = None
+    for line in response.splitlines():
+        if line.startswith(BATCH_MARK):
+            section = int(line[len(BATCH_MARK):])
+        elif section is not None:
+            outputs[section].append(line)
+    return outputs
+
+def api_tables(module, device, tables, commands):
+    """fetches commands as pipelined API queries into tables memo, a trap
+    (e.g. menu of a missing package) gives an empty table like batch mode;
+    values get their CLI form, so facts are the same as over ssh"""
+    replies = apitalk(module, device, [cli_sentence(command) for command in commands])
+    for command, (records, _done, trap) in zip(commands, replies):
+        records = api_records(records) if not trap else []
+        lines = []
+        if records:
+            lines = ["%s: %s" % (key, cli_value(key, val))
+                     for key, val in sorted(records[0].items())
+                     if not key.startswith('.')]
+        tables[command] = {'lines': lines, 'records': records}
+
+def api_probe(module, device):
+    """returns identity, software id, boot time and change counter"""
+    replies = apitalk(module, device, [
+        ['/system/identity/print'], ['/system/license/print'],
+        ['/system/resource/print', '=.proplist=uptime'],
+        ['/system/history/print', '=count-only=']])
+    first = [records[0] if records else {} for records, _done, _trap in replies]
+    return {'identity': first[0].get('name', ''),
+            'software_id': first[1].get('software-id', ''),
+            'boot': int(time.time()) - uptime_seconds(first[2].get('uptime', '')),
+            'changes': replies[3][1].get('ret', '')}
+
+def api_management(module, device, rosdev):
+    """returns management source ip and interface of this api session"""
+    (active, _done, _trap), (addresses, _done, _trap) = apitalk(module, device, [
+        ['/user/active/print', '?name=' + rosdev['username'], '?via=api'],
+        ['/ip/address/print', '?disabled=false']])
+    src = [record['address'] for record in active if 'address' in record]
+    if len(src) != 1:
+        return None, None
+    ifc = [record['interface'] for record in addresses
+           if record.get('address', '').split('/')[0] == rosdev['ipaddress']]
+    if len(ifc) == 1:
+        return src[0], str(ifc[0])
+    return src[0], None
+
+def unique_commands(queries):
+    """returns commands of queries, each only once"""
+    commands = []
+    for query in queries:
+        if query['command'] not in commands:
+            commands.append(query['command'])
+    return commands
+
+def store_tables(tables, commands, outputs):
+    """parses fetched command outputs once into tables memo"""
+    for command, lines in zip(commands, outputs):
+        tables[command] = {'lines': lines, 'records': terse_records(lines)}
+
+def collect_fact(mtfacts, query, table):
+    """stores query results from fetched table in mtfacts"""
+    if 'fact' in query:
+        vals = terse_list(table['records'], query['key'], query.get('match'))
+        if vals or not query.get('optional'):
+            mtfacts[query['fact']] = vals
+    else:
+        mtfacts.update(facts_dict(table['lines'], query.get('prefix', "")))
+
+def parse_subset(gather_subset):
+    """returns set of fact groups selected with gather_subset or None"""
+    selected = set()
+    excluded = set()
+    for subset in gather_subset:
+        subset = subset.strip()
+        names = subset.lstrip('!')
+        if names == 'all':
+            names = FACT_GROUPS
+        elif names == 'min':
+            names = ['system']
+        elif names in FACT_GROUPS:
+            names = [names]
+        else:
+            return None
+        if subset.startswith('!'):
+            excluded.update(names)
+        else:
+            selected.update(names)
+    if not selected:
+        selected.update(FACT_GROUPS)
+    selected -= excluded
+    selected.add('system')
+    for query in FACT_QUERIES:
+        if query['group'] in selected and 'package' in query:
+            selected.add('packages')
+    return selected
+
+def named_groups(gather_subset):
+    """returns set of fact groups named in gather_subset itself (not with
+    all, min or '!'), these are gathered in full even without verbose"""
+    return set(subset.strip() for subset in gather_subset
+               if subset.strip() in FACT_GROUPS)
+
+def uptime_seconds(uptime):
+    """converts RouterOS uptime (1w2d03:04:05 or 1w2d3h4m5s) to seconds"""
+    units = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+    seconds = 0
+    for value, unit in re.findall(r'(\d+)([wdhms])', uptime):
+        seconds += int(value) * units[unit]
+    clock = re.search(r'(\d+):(\d+):(\d+)$', uptime)
+    if clock:
+        hours, minutes, secs = clock.groups()
+        seconds += int(hours) * 3600 + int(minutes) * 60 + int(secs)
+    return seconds
+
+def parse_probe(module, device, timeout):
+    """returns identity, software id, boot time and change counter"""
+    response = sshcmd(module, device, timeout, CACHE_PROBE)
+    lines = [line.strip() for line in response.splitlines()]
+    lines += [''] * (4 - len(lines))
+    return {'identity': lines[0], 'software_id': lines[1],
+            'boot': int(time.time()) - uptime_seconds(lines[2]),
+            'changes': lines[3]}
+
+def load_cache(cachefile):
+    """returns cached fact groups or empty dict"""
+    try:
+        with open(cachefile) as cached:
+            return json.load(cached)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache(cachefile, groups):
+    """atomically writes fact groups to cache file"""
+    cache_dir = os.path.dirname(cachefile)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0700)
+    tmpfd, tmpname = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(tmpfd, 'w') as tmpfile:
+        json.dump(groups, tmpfile)
+    os.rename(tmpname, cachefile)
+
+def cache_valid(entry, probe, verbose):
+    """checks if cached fact group entry is still valid"""
+    if not CACHE_TTL.get(entry['group']):
+        return False
+    if time.time() - entry['time'] > CACHE_TTL[entry['group']]:
+        return False
+    if abs(entry['boot'] - probe['boot']) > 60:
+        return False
+    if entry['group'] != 'hardware' and entry['changes'] != probe['changes']:
+        return False
+    return entry['verbose'] or not verbose
+
 def vercmp(ver1, ver2):
     """quick and dirty version comparison from stackoverflow"""
     def normalize(ver):
@@ -217,24 +711,48 @@ def main():
         module = AnsibleModule(
             argument_spec=dict(
                 verbose=dict(default=False, type='bool'),
+                gather_subset=dict(default=['all'], type='list'),
+                batch=dict(default=False, type='bool'),
+                workers=dict(default=1, type='int'),
+                cache=dict(default='bypass', choices=['use', 'refresh', 'bypass']),
+                cache_dir=dict(default='~/.ansible/mikrotik_facts', type='path'),
                 port=dict(default=22, type='int'),
+                persistent=dict(default=False, type='bool'),
+                persist_timeout=dict(default=60, type='int'),
+                persist_max=dict(default=64, type='int'),
+                timings=dict(default=False, type='bool'),
                 timeout=dict(default=30, type='float'),
                 hostname=dict(required=True),
                 key_filename=dict(default=None, type='path'),
                 username=dict(default='ansible', type='str'),
                 password=dict(default='', type='str', no_log=True),
+                transport=dict(default='ssh', choices=['ssh', 'api']),
+                api_port=dict(default=0, type='int'),
+                api_ssl=dict(default=False, type='bool'),
             ), supports_check_mode=False
         )
         if not HAS_SSHCLIENT:
             safe_fail(module, msg='There was a problem loading module: ',
                       error=str(import_error))
         verbose = module.params['verbose']
+        gather_subset = module.params['gather_subset']
+        batch = module.params['batch']
+        workers = module.params['workers']
+        cache = module.params['cache']
+        cache_dir = module.params['cache_dir']
         rosdev['hostname'] = module.params['hostname']
         rosdev['username'] = module.params['username']
         rosdev['password'] = module.params['password']
         rosdev['key_filename'] = module.params['key_filename']
         rosdev['port'] = module.params['port']
+        rosdev['persistent'] = module.params['persistent']
+        rosdev['persist_timeout'] = module.params['persist_timeout']
+        rosdev['persist_max'] = module.params['persist_max']
+        timings = module.params['timings']
         rosdev['timeout'] = module.params['timeout']
+        rosdev['transport'] = module.params['transport']
+        rosdev['api_port'] = module.params['api_port']
+        rosdev['api_ssl'] = module.params['api_ssl']
 
     else:
         if not HAS_SSHCLIENT:
@@ -244,121 +762,149 @@ def main():
         rosdev['password'] = SHELLOPTS['password']
         rosdev['key_filename'] = SHELLOPTS['key_filename']
         rosdev['port'] = SHELLOPTS['port']
-        rosdev['timeout'] = SHELLOPTS['timeout']
+        rosdev['persistent'] = SHELLOPTS['persistent']
+        rosdev['persist_timeout'] = SHELLOPTS['persist_timeout']
+        rosdev['persist_max'] = SHELLOPTS['persist_max']
+        timings = SHELLOPTS['timings']
+        rosdev['timeout'] = float(SHELLOPTS['timeout'])
+        rosdev['transport'] = SHELLOPTS['transport']
+        rosdev['api_port'] = int(SHELLOPTS['api_port'])
+        rosdev['api_ssl'] = SHELLOPTS['api_ssl']
         verbose = SHELLOPTS['verbose']
+        gather_subset = SHELLOPTS['gather_subset'].split(',')
+        batch = SHELLOPTS['batch']
+        workers = int(SHELLOPTS['workers'])
+        cache = SHELLOPTS['cache']
+        cache_dir = SHELLOPTS['cache_dir']
         module = None
 
+    subset = parse_subset(gather_subset)
+    if not subset:
+        if SHELLMODE:
+            sys.exit("Unknown gather_subset: " + ','.join(gather_subset))
+        safe_fail(module, msg='unknown gather_subset: ' + ','.join(gather_subset),
+                  description='valid subsets: all, min, ' + ', '.join(FACT_GROUPS))
+    full = set(FACT_GROUPS) if verbose else named_groups(gather_subset)
+
+    rosdev['timings'] = Timings() if timings else None
     try:
-        rosdev['ipaddress'] = socket.gethostbyname(rosdev['hostname'])
+        rosdev['ipaddress'] = resolve(rosdev['hostname'], rosdev['timings'])
     except socket.gaierror as dns_error:
         if SHELLMODE:
             sys.exit("Hostname error: " + str(dns_error))
         safe_fail(module, msg=str(dns_error),
                   description='error getting device address from hostname')
 
-    device = paramiko.SSHClient()
-    device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    device_connect(module, device, rosdev)
+    api = rosdev['transport'] == 'api'
+    if api:
+        device = timed_client(ApiClient(rosdev['timeout']), rosdev['timings'])
+        api_connect(module, device, rosdev)
+    else:
+        device = ssh_client(rosdev)
+        device_connect(module, device, rosdev)
 
-    mgmt = None
-    mtfacts['management_ip_address'] = rosdev['ipaddress']
-    identity = sshcmd(module, device, cmd_timeout, "system identity print")
-    mtfacts['identity'] = str(identity.split(": ")[1])
-    user_ssh_keys = parse_terse(device, "key-owner",
-            "user ssh-keys print terse where user=" + rosdev['username'])
-    if user_ssh_keys:
-        mtfacts['user_ssh_keys'] = user_ssh_keys
-    src = parse_terse(device, "address",
-            'user active print terse where name="' + rosdev['username'] + '" and via=ssh')
-    if len(src) == 1:
-        mtfacts['management_source_ip'] = src[0]
-        con = parse_terse(device, "dst-address",
-            'ip firewall connection print terse where tcp-state=established and '
-            + 'src-address~"' + src[0] + '" and dst-address~".*:' + str(rosdev['port'])
-            + '"')
-        if len(con) == 1:
-            ifc = parse_terse(device, "interface",
-                'ip address print terse where address~"' + str(con[0]).split(":")[0] + '"')
+    cached = {}
+    identity = None
+    if cache != 'bypass':
+        if api:
+            probe = api_probe(module, device)
         else:
-            ifc = parse_terse(device, "interface",
-                'ip address print terse where address~"' + rosdev['ipaddress'] + '"')
-        if len(ifc) == 1:
-            mgmt = str(ifc[0])
-
-    mtfacts.update(parse_facts(device, "system resource print without-paging"))
-    mtfacts.update(parse_facts(device, "system routerboard print without-paging"))
-    mtfacts.update(parse_facts(device, "system health print without-paging", "health_"))
-    mtfacts.update(parse_facts(device, "system license print without-paging", "license_"))
-    mtfacts.update(parse_facts(device, "ip cloud print without-paging", "cloud_"))
-    if " " in mtfacts['version']:
-        mtfacts['routeros_version'] = mtfacts['version'].split(" ")[0]
+            probe = parse_probe(module, device, cmd_timeout)
+        identity = probe['identity']
+        cachefile = os.path.join(os.path.expanduser(cache_dir), "%s_%s.json"
+                                 % (probe['identity'], probe['software_id']
+                                    or rosdev['ipaddress']))
+        stored = load_cache(cachefile)
+        if cache == 'use':
+            for group, entry in stored.items():
+                if group in subset and cache_valid(entry, probe, group in full):
+                    cached[group] = entry
+    cached_groups = list(cached)
+    groups = {}
+    for group in cached:
+        groups[group] = cached[group]['facts']
+    queries = [dict(query, command=query['command'] % rosdev)
+               for query in FACT_QUERIES
+               if (query['group'] in full or not query.get('verbose'))
+               and query['group'] in subset and query['group'] not in cached]
+    tables = {}
+    pool = None
+    src = mgmt = None
+    if workers > 1 and not api:
+        pool = ThreadPool(workers)
+        if 'management' in subset:
+            management = pool.apply_async(parse_management, (device, rosdev))
+    if api: # package queries too, missing package menus just trap
+        commands = unique_commands(queries)
+        api_tables(module, device, tables, ["system identity print"] + commands)
+        identity = ''.join(record.get('name', '') for record in
+                           tables.pop("system identity print")['records'])
+    elif batch:
+        commands = unique_commands(queries)
+        outputs = parse_batch(module, device, cmd_timeout,
+                              [":put [/system identity get name]"] + commands)
+        identity = ''.join(outputs.pop(0)).strip()
+        store_tables(tables, commands, outputs)
+    else:
+        if not identity:
+            identity = sshcmd(module, device, cmd_timeout, "system identity print")
+            identity = identity.split(": ")[1]
+        commands = unique_commands([query for query in queries
+                                    if 'package' not in query])
+        store_tables(tables, commands, query_all(device, commands, pool))
+    if 'management' in subset:
+        if api:
+            src, mgmt = api_management(module, device, rosdev)
+        elif pool:
+            src, mgmt = management.get()
+        else:
+            src, mgmt = parse_management(device, rosdev)
 
-    mtfacts['enabled_packages'] = parse_terse(device, "name",
-            "system package print terse without-paging where disabled=no")
-    for pkg in mtfacts['enabled_packages']:
+    for query in queries:
+        if 'package' not in query:
+            collect_fact(groups.setdefault(query['group'], {}), query,
+                         tables[query['command']])
+    for group in groups:
+        mtfacts.update(groups[group])
+    enabled_packages = mtfacts.get('enabled_packages', [])
+    for pkg in enabled_packages:
         if 'routeros' in pkg:
-            mtfacts['enabled_packages'].remove(pkg)
-    mtfacts['enabled_interfaces'] = parse_terse(device, "name",
-            "interface print terse without-paging where disabled=no")
-    if mgmt and mgmt in mtfacts['enabled_interfaces']:
+            enabled_packages.remove(pkg)
+    extra = [query for query in queries
+             if query.get('package') in enabled_packages]
+    commands = [command for command in unique_commands(extra)
+                if command not in tables]
+    store_tables(tables, commands, query_all(device, commands, pool))
+    for query in extra:
+        collect_fact(groups.setdefault(query['group'], {}), query,
+                     tables[query['command']])
+        mtfacts.update(groups[query['group']])
+    if pool:
+        pool.close()
+        pool.join()
+
+    if cache != 'bypass':
+        for group in groups:
+            if group not in cached:
+                stored[group] = {'group': group, 'time': int(time.time()),
+                                 'boot': probe['boot'], 'changes': probe['changes'],
+                                 'verbose': group in full, 'facts': groups[group]}
+        try:
+            save_cache(cachefile, stored)
+        except (IOError, OSError) as cache_error:
+            if SHELLMODE:
+                device.close()
+                sys.exit("Fact cache error: " + str(cache_error))
+            safe_fail(module, device, msg=str(cache_error),
+                      description='error writing fact cache')
+    mtfacts['identity'] = str(identity)
+    mtfacts['management_ip_address'] = rosdev['ipaddress']
+    if src:
+        mtfacts['management_source_ip'] = src
+    if " " in mtfacts['version']:
+        mtfacts['routeros_version'] = mtfacts['version'].split(" ")[0]
+    if mgmt and mgmt in mtfacts.get('enabled_interfaces', [mgmt]):
         mtfacts['management_interface'] = mgmt
-    mtfacts['ip_addresses'] = parse_terse(device, "address",
-            "ip address print terse without-paging where disabled=no")
-    mtfacts['mac_addresses'] = parse_terse(device, "mac-address",
-            "interface print terse without-paging where disabled=no")
-    mtfacts['remote_syslog'] = parse_terse(device, "remote",
-            "system logging action print terse without-paging")
-    email_server = parse_terse(device, "address", "tool e-mail export hide-sensitive")
-    if email_server:
-        mtfacts['email_server'] = email_server
-    if 'wireless' in mtfacts['enabled_packages']:
-        wifaces = parse_terse(device, "name",
-                "interface wireless print terse without-paging")
-        if wifaces:
-            mtfacts['wireless_interfaces'] = wifaces
-    if 'ipv6' in mtfacts['enabled_packages']:
-        mtfacts['ipv6_addresses'] = parse_terse(device, "address",
-                "ipv6 address print terse without-paging where disabled=no")
-
-    if verbose:
-        mtfacts.update(parse_facts(device, "ip ssh print without-paging", "ssh_"))
-        mtfacts.update(parse_facts(device, "ip settings print without-paging", "ipv4_"))
-        mtfacts.update(parse_facts(device, "system clock print without-paging", "clock_"))
-        mtfacts.update(parse_facts(device, "snmp print without-paging", "snmp_"))
-        mtfacts['disabled_packages'] = parse_terse(device, "name",
-            "system package print terse without-paging where disabled=yes")
-        mtfacts['scheduled_packages'] = parse_terse(device, "name",
-            'system package print terse without-paging where scheduled~"scheduled"')
-        mtfacts['disabled_interfaces'] = parse_terse(device, "name",
-            "interface print terse without-paging where disabled=yes")
-        mtfacts.update(parse_facts(device,
-            "interface bridge settings print without-paging", "bridge_"))
-        mtfacts.update(parse_facts(device,
-            "ip firewall connection tracking print without-paging", "conntrack_"))
-        mtfacts['users'] = parse_terse(device, "name",
-            "user print terse without-paging where disabled=no")
-        mtfacts['mac_server_interfaces'] = parse_terse(device, "interface",
-            "tool mac-server print terse without-paging where disabled=no")
-        mtfacts['mac_winbox_interfaces'] = parse_terse(device, "interface",
-            "tool mac-server mac-winbox print terse without-paging where disabled=no")
-        mtfacts['ip_services'] = parse_terse(device, "name",
-            "ip service print terse without-paging where disabled=no")
-        mtfacts['neighbor_discovery_interfaces'] = parse_terse(device, "name",
-            "ip neighbor discovery print terse without-paging where disabled=no")
-        mtfacts['ethernet_interfaces'] = parse_terse(device, "name",
-            "interface ethernet print terse without-paging")
-        mtfacts['ethernet_switch_types'] = parse_terse(device, "type",
-            "interface ethernet switch print terse without-paging")
-        mtfacts['bridge_interfaces'] = parse_terse(device, "name",
-            "interface bridge print terse without-paging")
-        mtfacts.update(parse_facts(device,
-            "system ntp client print without-paging", "ntp_client_"))
-        if 'ntp' in mtfacts['enabled_packages']:
-            mtfacts.update(parse_facts(device,
-                "system ntp server print without-paging", "ntp_server_"))
-        if 'ipv6' in mtfacts['enabled_packages']:
-            mtfacts.update(parse_facts(device, "ipv6 settings print without-paging",
-                "ipv6_"))
 
     if SHELLMODE:
         device.close()
@@ -367,9 +913,17 @@ def main():
                 print "%s: %s" % (fact, ', '.join(mtfacts[fact]))
             else:
                 print "%s: %s" % (fact, mtfacts[fact])
+        if cache == 'use':
+            print "cached_groups: %s" % ', '.join(sorted(cached_groups))
+        if timings:
+            print '\n'.join(rosdev['timings'].report())
         sys.exit(0)
 
-    safe_exit(module, device, ansible_facts=mtfacts, changed=changed)
+    extra = {}
+    if timings:
+        extra['timings'] = rosdev['timings'].result()
+    safe_exit(module, device, ansible_facts=mtfacts, changed=changed,
+              cached_groups=cached_groups, **extra)
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 or SHELLMODE:
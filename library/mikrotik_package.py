@@ -7,20 +7,28 @@ import re
 import os
 import socket
 import time
+import json
 
 HAS_SSHCLIENT = True
 SHELLMODE = False
 SHELLDEFS = {
     'username': 'admin',
-    'password': '',
+    'password': os.environ.get('MIKROTIK_PASSWORD', ''),
     'timeout': 60,
     'port': 22,
+    'persistent': False,
+    'persist_timeout': 60,
+    'persist_max': 64,
+    'timings': False,
     'repository': 'routeros',
     'packages': None,
     'version': None,
-    'reboot': False
+    'reboot': False,
+    'reboot_timeout': 300,
+    'transport': 'ssh',
+    'api_port': 0,
+    'api_ssl': False
 #   TODO:
-#   'reboot_timeout': 60,
 #   'reboot_wait': true,
 #   'default_packages': ['system', 'security', 'dhcp']
 }
@@ -41,8 +49,14 @@ return_data:
 options:
     repository:
         description:
-            - Preexisting directory with uncompressed RouterOS <version>/<architecture> package tree
+            - Preexisting directory with RouterOS <version>/<architecture> package tree,
+              packages are also taken straight from <version>/all_packages-<arch>-<version>.zip
             - Created either manually or with the included shell script (routeros/latest.sh)
+            - Uploaded packages are recorded (size, mtime, sha256) in ansible-packages.json
+              on the router, identical packages are not uploaded again
+            - If the repository has an index.json (written by the routeros/*.sh scripts
+              or module_utils/mikrotik_repo.py) packages are looked up there, missing
+              versions or packages fail before connecting to the device
         required: false
         default: 'routeros'
     packages:
@@ -61,6 +75,52 @@ options:
             - Reboot device after package provisioning and wait until it gets online
         required: false
         default: false
+    reboot_timeout:
+        description:
+            - Seconds to wait for the device to come back after reboot, it is polled with
+              backoff for open ssh port, ssh banner and a working version query
+        required: false
+        default: 300
+    transport:
+        description:
+            - Query and change packages, reboot and wait for the device over ssh or
+              over RouterOS API service (pipelined queries, structured replies),
+              package uploads always use sftp over ssh
+        required: false
+        choices: ['ssh', 'api']
+        default: ssh
+    api_port:
+        description:
+            - RouterOS API listening port (default 8728, or 8729 with api_ssl)
+        required: false
+        default: 0
+    api_ssl:
+        description:
+            - Use TLS (api-ssl service) for API transport
+        required: false
+        default: false
+    timings:
+        description:
+            - Return timings of name lookup, tcp connect, ssh handshake with
+              authentication, every command (seconds and bytes received) and
+              sftp transfers, shell mode prints the slowest commands
+        required: no
+        default: false
+    persistent:
+        description:
+            - Keep the ssh connection open in background and reuse it in later tasks
+        required: false
+        default: false
+    persist_timeout:
+        description:
+            - Seconds an unused persistent connection is kept open
+        required: false
+        default: 60
+    persist_max:
+        description:
+            - Maximum number of open persistent connections, least recently used are closed
+        required: false
+        default: 64
     port:
         description:
             - SSH listening port of the MikroTik RouterOS device
@@ -119,18 +179,65 @@ scheduled_packages:
     description: list of packages to be enabled or disabled after next reboot
     returned: always
     type: list
+upload_stats:
+    description: list of uploaded package files with bytes, seconds and rate (bytes/s),
+                 packages already on the router are marked skipped
+    returned: always
+    type: list
+upload_size:
+    description: total bytes of package files to be uploaded (before skipping
+                 packages already on the router)
+    returned: always
+    type: int
+reboot_time:
+    description: seconds from reboot command until the device answered again
+    returned: if device was rebooted
+    type: float
+timings:
+    description: seconds of dns, tcp_connect, ssh_connect (handshake), ssh_auth
+                 (or api_connect) and total run, commands list of {command,
+                 seconds, bytes} and sftp list of {operation, path, bytes,
+                 seconds, rate}
+    returned: if timings option was used
+    type: dict
 """
 SHELL_USAGE = """
 mikrotik_package.py --hostname=<hostname> --repository=<path>
                [--packages=<pkg1,pkg2...>] [--reboot[=true|false|yes|no]]
+               [--reboot_timeout=<seconds>] [--timings]
+               [--transport=ssh|api] [--api_port=<port>] [--api_ssl]
                [--port=<port>] [--username=<username>] [--password=<password>]
+(password defaults to MIKROTIK_PASSWORD environment variable)
 """
+SFTP_WINDOW = 8 * 1024 * 1024
+SFTP_PACKET = 32768 + 1024
+MANIFEST = 'ansible-packages.json'
 
 try:
     import paramiko
 except ImportError as import_error:
     HAS_SSHCLIENT = False
 
+try:
+    from ansible.module_utils.mikrotik_persist import ssh_client
+    from ansible.module_utils.mikrotik_timing import (Timings, TimedClient, resolve,
+                                                      timed_client)
+    from ansible.module_utils.mikrotik_api import (ApiClient, ApiError, api_records,
+                                                   API_PORT, API_SSL_PORT)
+    from ansible.module_utils.mikrotik_repo import (stream_sha256, load_index,
+                                                    index_package, index_missing,
+                                                    find_package, open_package)
+    from ansible.module_utils.mikrotik_terse import terse_records
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 os.pardir, 'module_utils'))
+    from mikrotik_persist import ssh_client
+    from mikrotik_timing import Timings, TimedClient, resolve, timed_client
+    from mikrotik_api import ApiClient, ApiError, api_records, API_PORT, API_SSL_PORT
+    from mikrotik_repo import (stream_sha256, load_index, index_package,
+                               index_missing, find_package, open_package)
+    from mikrotik_terse import terse_records
+
 try:
     from ansible.module_utils.basic import AnsibleModule
 except ImportError:
@@ -181,7 +288,7 @@ def parse_opts(cmdline):
 def device_connect(module, device, rosdev):
     """open ssh connection with or without ssh keys"""
     try:
-        rosdev['hostname'] = socket.gethostbyname(rosdev['hostname'])
+        rosdev['hostname'] = resolve(rosdev['hostname'], rosdev['timings'])
     except socket.gaierror as dns_error:
         if SHELLMODE:
             sys.exit("Hostname error: " + str(dns_error))
@@ -209,6 +316,167 @@ def device_connect(module, device, rosdev):
     if SHELLMODE:
         print "succes."
 
+def api_connect(module, device, rosdev):
+    """open RouterOS API (api-ssl) connection"""
+    try:
+        rosdev['hostname'] = resolve(rosdev['hostname'], rosdev['timings'])
+    except socket.gaierror as dns_error:
+        if SHELLMODE:
+            sys.exit("Hostname error: " + str(dns_error))
+        safe_fail(module, device, msg=str(dns_error),
+                  description='error getting device address from hostname')
+    if SHELLMODE:
+        sys.stdout.write("Opening API%s connection to %s:%s... "
+                         % (' TLS' if rosdev['api_ssl'] else '', rosdev['hostname'],
+                            api_port(rosdev)))
+        sys.stdout.flush()
+    try:
+        device.connect(rosdev['hostname'], port=api_port(rosdev),
+                       username=rosdev['username'], password=rosdev['password'],
+                       use_ssl=rosdev['api_ssl'])
+    except Exception as api_error:
+        if SHELLMODE:
+            sys.exit("failed!\nAPI error: " + str(api_error))
+        safe_fail(module, device, msg=str(api_error),
+                  description='error opening api connection to %s' % rosdev['hostname'])
+    if SHELLMODE:
+        print "succes."
+
+def api_port(rosdev):
+    """returns RouterOS API port, default depends on api_ssl"""
+    if rosdev['api_port']:
+        return int(rosdev['api_port'])
+    return API_SSL_PORT if rosdev['api_ssl'] else API_PORT
+
+def apicmd(module, device, sentences):
+    """sends API sentences at once, returns list of (records, done) replies"""
+    try:
+        replies = device.talk(sentences)
+    except (ApiError, socket.error) as api_error:
+        if SHELLMODE:
+            sys.exit("API command error: " + str(api_error))
+        safe_fail(module, device, msg=str(api_error),
+                  description='API error while executing command')
+    for words, (_records, _done, trap) in zip(sentences, replies):
+        if trap:
+            if SHELLMODE:
+                print "Command: " + ' '.join(words)
+                sys.exit("Error: " + trap)
+            safe_fail(module, device, msg=trap,
+                      description='API command failed: ' + ' '.join(words))
+    return [(records, done) for records, done, _trap in replies]
+
+def open_sftp(device):
+    """opens sftp session with SFTP_WINDOW/SFTP_PACKET channel settings"""
+    transport = device.get_transport()
+    if transport is None or isinstance(device, TimedClient): # persistent/timed
+        return device.open_sftp(window_size=SFTP_WINDOW,
+                                max_packet_size=SFTP_PACKET)
+    return paramiko.SFTPClient.from_transport(transport, window_size=SFTP_WINDOW,
+                                              max_packet_size=SFTP_PACKET)
+
+def read_manifest(sftp, uploaded):
+    """returns package manifest left on the router by earlier uploads"""
+    if MANIFEST not in uploaded:
+        return {}
+    try:
+        with sftp.open(MANIFEST, 'r') as manifest:
+            return json.loads(manifest.read())
+    except (IOError, ValueError):
+        return {}
+
+def write_manifest(sftp, manifest):
+    """stores package manifest on the router"""
+    with sftp.open(MANIFEST, 'w') as remote:
+        remote.write(json.dumps(manifest, sort_keys=True))
+
+def ssh_banner(hostname, port, timeout, banner=True):
+    """returns 'closed' if port is closed, 'open' without banner or 'ssh'
+    (without reading the banner if banner is False)"""
+    try:
+        sock = socket.create_connection((hostname, int(port)), timeout)
+    except (socket.error, socket.timeout):
+        return 'closed'
+    if not banner:
+        sock.close()
+        return 'open'
+    try:
+        if sock.recv(64).startswith('SSH-'):
+            return 'ssh'
+    except (socket.error, socket.timeout):
+        pass
+    finally:
+        sock.close()
+    return 'open'
+
+def wait_reboot(module, device, rosdev, timeout, reboot_timeout):
+    """waits until device went down and answers again, returns seconds
+
+    After the device stops accepting connections it is polled with backoff
+    for an open ssh port, ssh banner, login and a working version query
+    (for an open API port, API login and version query with transport api).
+    """
+    api = rosdev['transport'] == 'api'
+    started = time.time()
+    deadline = started + reboot_timeout
+    stage = 'down'
+    delay = 1
+    while time.time() < deadline:
+        if api:
+            state = ssh_banner(rosdev['hostname'], api_port(rosdev), min(timeout, 5),
+                               banner=False)
+        else:
+            state = ssh_banner(rosdev['hostname'], rosdev['port'], min(timeout, 5))
+        if stage == 'down':
+            if state == 'closed':
+                stage = 'up'
+                if SHELLMODE:
+                    print "- down after %.1fs" % (time.time() - started)
+            time.sleep(1)
+            continue
+        if state == 'open' and api:
+            try:
+                device.connect(rosdev['hostname'], port=api_port(rosdev),
+                               username=rosdev['username'],
+                               password=rosdev['password'], use_ssl=rosdev['api_ssl'])
+                records, _done = device.command('/system/resource/print',
+                                                **{'.proplist': 'version'})
+                if records and records[0].get('version'):
+                    if SHELLMODE:
+                        print "- up after %.1fs" % (time.time() - started)
+                    return time.time() - started
+            except Exception:
+                pass
+            device.close()
+        elif state == 'ssh':
+            try:
+                try:
+                    device.connect(rosdev['hostname'], username=rosdev['username'],
+                                   password=rosdev['password'], port=rosdev['port'],
+                                   timeout=rosdev['timeout'])
+                except paramiko.AuthenticationException:
+                    device.connect(rosdev['hostname'], username=rosdev['username'],
+                                   password=rosdev['password'], port=rosdev['port'],
+                                   timeout=rosdev['timeout'], allow_agent=False,
+                                   look_for_keys=False)
+                _stdin, stdout, _stderr = device.exec_command(
+                    ":put [/system resource get version]", timeout=timeout)
+                if stdout.read().strip():
+                    if SHELLMODE:
+                        print "- up after %.1fs" % (time.time() - started)
+                    return time.time() - started
+            except Exception:
+                pass
+            device.close()
+        time.sleep(max(0, min(delay, deadline - time.time())))
+        delay = min(delay * 2, 5)
+    if SHELLMODE:
+        sys.exit("Device did not come back within %d seconds (%s)" %
+                 (reboot_timeout, 'still up' if stage == 'down' else 'no answer'))
+    safe_fail(module, device, msg='reboot timeout',
+              description='device did not come back within %d seconds (%s)' %
+              (reboot_timeout, 'still up' if stage == 'down' else 'no answer'))
+
 def sshcmd(module, device, timeout, command):
     """executes a command on the device, returns string"""
     try:
@@ -229,15 +497,10 @@ def sshcmd(module, device, timeout, command):
     safe_fail(module, device, msg=str(ssh_error),
               description='bad command name or syntax error')
 
-def parse_terse(device, key, command):
-    """executes a command and returns list"""
+def parse_terse(device, command):
+    """executes a terse print command and returns list of record dicts"""
     _stdin, stdout, _stderr = device.exec_command(command)
-    vals = []
-    for line in stdout.readlines():
-        if key in line:
-            val = line.split(key+'=')[1]
-            vals.append(val.split(' ')[0])
-    return vals
+    return terse_records(stdout.readlines())
 
 def parse_facts(device, command, pfx=""):
     """executes a command and returns dict"""
@@ -265,7 +528,9 @@ def main():
     enable = []
     disable = []
     cmd_timeout = 15
-    reboot_timeout = 30
+    reboot_time = None
+    upload_stats = []
+    upload_size = 0
     default_packages = ['system', 'security']
     changed = False
     if not SHELLMODE:
@@ -275,11 +540,19 @@ def main():
                 packages=dict(default=None, type='list'),
                 version=dict(default=None, type='str'),
                 reboot=dict(default=False, type='bool'),
+                reboot_timeout=dict(default=300, type='int'),
                 hostname=dict(required=True),
                 username=dict(default='ansible', type='str'),
                 password=dict(default='', type='str', no_log=True),
                 port=dict(default=22, type='int'),
-                timeout=dict(default=30, type='float')
+                persistent=dict(default=False, type='bool'),
+                persist_timeout=dict(default=60, type='int'),
+                persist_max=dict(default=64, type='int'),
+                timings=dict(default=False, type='bool'),
+                timeout=dict(default=30, type='float'),
+                transport=dict(default='ssh', choices=['ssh', 'api']),
+                api_port=dict(default=0, type='int'),
+                api_ssl=dict(default=False, type='bool')
             ), supports_check_mode=False
         )
         if not HAS_SSHCLIENT:
@@ -289,11 +562,19 @@ def main():
         packages = module.params['packages']
         version = module.params['version']
         reboot = module.params['reboot']
-        rosdev['hostname'] = socket.gethostbyname(module.params['hostname'])
+        reboot_timeout = module.params['reboot_timeout']
+        rosdev['hostname'] = module.params['hostname']
         rosdev['username'] = module.params['username']
         rosdev['password'] = module.params['password']
         rosdev['port'] = module.params['port']
+        rosdev['persistent'] = module.params['persistent']
+        rosdev['persist_timeout'] = module.params['persist_timeout']
+        rosdev['persist_max'] = module.params['persist_max']
+        timings = module.params['timings']
         rosdev['timeout'] = module.params['timeout']
+        rosdev['transport'] = module.params['transport']
+        rosdev['api_port'] = module.params['api_port']
+        rosdev['api_ssl'] = module.params['api_ssl']
 
     else:
         if not HAS_SSHCLIENT:
@@ -302,32 +583,68 @@ def main():
         rosdev['username'] = SHELLOPTS['username']
         rosdev['password'] = SHELLOPTS['password']
         rosdev['port'] = SHELLOPTS['port']
-        rosdev['timeout'] = SHELLOPTS['timeout']
+        rosdev['persistent'] = SHELLOPTS['persistent']
+        rosdev['persist_timeout'] = SHELLOPTS['persist_timeout']
+        rosdev['persist_max'] = SHELLOPTS['persist_max']
+        timings = SHELLOPTS['timings']
+        rosdev['timeout'] = float(SHELLOPTS['timeout'])
+        rosdev['transport'] = SHELLOPTS['transport']
+        rosdev['api_port'] = SHELLOPTS['api_port']
+        rosdev['api_ssl'] = SHELLOPTS['api_ssl']
         repository = os.path.expanduser(SHELLOPTS['repository'])
         packages = None
         if SHELLOPTS['packages']:
             packages = SHELLOPTS['packages'].split(",")
         version = SHELLOPTS['version']
         reboot = SHELLOPTS['reboot']
+        reboot_timeout = int(SHELLOPTS['reboot_timeout'])
         module = None
 
-    device = paramiko.SSHClient()
-    device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    index = load_index(repository)
+    if index and version:
+        if version not in index['packages']:
+            missing = "version %s" % version
+        else:
+            missing = ', '.join(index_missing(index, version, packages or []))
+        if missing:
+            if SHELLMODE:
+                sys.exit("Not in repository index: " + missing)
+            safe_fail(module, msg=missing,
+                      description='not found in repository index')
+
+    rosdev['timings'] = Timings() if timings else None
+    api = rosdev['transport'] == 'api'
+    if api: # ssh only for sftp uploads
+        device = timed_client(ApiClient(rosdev['timeout']), rosdev['timings'])
+        sftpdev = None
+    else:
+        device = sftpdev = ssh_client(rosdev)
 
     turn = 1
     while turn:
-        if turn != 2:
+        if turn != 2 and api:
+            api_connect(module, device, rosdev)
+        elif turn != 2:
             device_connect(module, device, rosdev)
 
-        response = sshcmd(module, device, cmd_timeout,
-                          ":put [/system resource get version]")
-        device_version = str(response.split(" ")[0])
-        enabled_packages = parse_terse(device, "name",
-            "system package print terse without-paging where disabled=no")
-        disabled_packages = parse_terse(device, "name",
-            "system package print terse without-paging where disabled=yes")
-        scheduled_packages = parse_terse(device, "name",
-            'system package print terse without-paging where scheduled~"scheduled"')
+        if api:
+            (resource, _done), (installed, _done) = apicmd(module, device, [
+                ['/system/resource/print', '=.proplist=version,architecture-name'],
+                ['/system/package/print']])
+            resource = resource[0] if resource else {}
+            device_version = str(resource.get('version', '').split(" ")[0])
+            installed = api_records(installed)
+        else:
+            response = sshcmd(module, device, cmd_timeout,
+                              ":put [/system resource get version]")
+            device_version = str(response.split(" ")[0])
+            installed = parse_terse(device, "system package print terse without-paging")
+        enabled_packages = [pkg['name'] for pkg in installed
+                            if 'X' not in pkg['.flags']]
+        disabled_packages = [pkg['name'] for pkg in installed
+                             if 'X' in pkg['.flags']]
+        scheduled_packages = [pkg['name'] for pkg in installed
+                              if 'scheduled' in pkg.get('scheduled', '')]
         for pkg in enabled_packages:
             if 'routeros' in pkg:
                 enabled_packages.remove(pkg)
@@ -351,8 +668,11 @@ def main():
                         packages.remove(pkg)
                         packages.append('wireless')
                         break
-        response = sshcmd(module, device, cmd_timeout,
-                          ":put [/system resource get architecture-name]")
+        if api:
+            response = resource.get('architecture-name', '')
+        else:
+            response = sshcmd(module, device, cmd_timeout,
+                              ":put [/system resource get architecture-name]")
         arch = response.lower()
         if SHELLMODE and diff < 0:
             print "Upgrading RouterOS: %s to %s (%s)" % (device_version, version, arch)
@@ -375,33 +695,99 @@ def main():
                 disable.append(pkg)
         if SHELLMODE and upload:
             print "Uploading package(s): %s" % ', '.join(upload)
+        pkgfiles = []
         for pkg in upload:
             if arch == 'x86':
                 pkg = pkg + "-" + version + ".npk"
             else:
                 pkg = pkg + "-" + version + "-" + arch + ".npk"
-            ppath = os.path.join(repository, version, arch, pkg)
-            if not os.path.exists(ppath):
+            if index:
+                entry = index_package(index, version, arch, pkg)
+            else:
+                entry = find_package(repository, version, arch, pkg)
+            if not entry:
                 if SHELLMODE:
                     device.close()
                     sys.exit("package not found: " + str(pkg))
                 safe_fail(module, device, msg=str(pkg),
                           description='package not found')
-            else:
-                sftp = device.open_sftp()
-                uploaded = sftp.listdir()
-                if pkg in uploaded and SHELLMODE:
-                    print "- package %s found, overwritting..." % pkg
-                try:
-                    sftp.put(ppath, pkg)
-                except Exception as put_error:
+            pkgfiles.append((pkg, entry))
+            upload_size += entry['size']
+        if SHELLMODE and upload_size:
+            print "- %d bytes in %d file(s)" % (upload_size, len(pkgfiles))
+        if pkgfiles:
+            if not sftpdev:
+                sftpdev = ssh_client(rosdev)
+                device_connect(module, sftpdev, rosdev)
+            try:
+                sftp = open_sftp(sftpdev)
+                uploaded = dict((attr.filename, attr) for attr in sftp.listdir_attr())
+                manifest = read_manifest(sftp, uploaded)
+                for pkg, entry in pkgfiles:
+                    digest = entry.get('sha256')
+                    if not digest:
+                        with open_package(repository, entry) as npk:
+                            digest = stream_sha256(npk)
+                    changed = True
+                    if pkg in uploaded:
+                        remote = manifest.get(pkg, {})
+                        if remote.get('sha256') == digest and \
+                                remote.get('size') == uploaded[pkg].st_size == \
+                                entry['size'] and \
+                                remote.get('mtime') == uploaded[pkg].st_mtime:
+                            upload_stats.append({'package': pkg, 'bytes': 0,
+                                                 'seconds': 0, 'rate': 0,
+                                                 'skipped': True})
+                            if SHELLMODE:
+                                print "- package %s already uploaded, skipping" % pkg
+                            continue
+                        if SHELLMODE:
+                            print "- package %s found, overwritting..." % pkg
+                    started = time.time()
+                    with open_package(repository, entry) as npk:
+                        attr = sftp.putfo(npk, pkg, entry['size'])
+                    size = attr.st_size
+                    manifest[pkg] = {'sha256': digest, 'size': size,
+                                     'mtime': attr.st_mtime}
+                    write_manifest(sftp, manifest)
+                    seconds = max(time.time() - started, 0.001)
+                    upload_stats.append({'package': pkg, 'bytes': size,
+                                         'seconds': round(seconds, 3),
+                                         'rate': int(size / seconds)})
                     if SHELLMODE:
-                        sys.exit("Upload failed, SFTP error: " + str(put_error))
-                    safe_fail(module, device, msg=str(put_error),
-                              description='SFTP error, check disk space')
+                        print "- %s: %d bytes in %.1fs (%.1f kB/s)" % (
+                            pkg, size, seconds, size / seconds / 1024)
                 sftp.close()
+            except Exception as put_error:
+                if sftpdev is not device:
+                    sftpdev.close()
+                if SHELLMODE:
+                    device.close()
+                    sys.exit("Upload failed, SFTP error: " + str(put_error))
+                safe_fail(module, device, msg=str(put_error),
+                          description='SFTP error, check disk space')
+            if sftpdev is not device:
+                sftpdev.close()
+                sftpdev = None
+        if not upload and api:
+            sentences = []
+            if scheduled_packages and (disable or enable):
+                sentences.append(['/system/package/unschedule', '=numbers=' +
+                                  ','.join(pkg['.id'] for pkg in installed
+                                           if 'scheduled' in pkg.get('scheduled', ''))])
+            for action, names, doing in (('disable', disable, "Disabling"),
+                                         ('enable', enable, "Enabling")):
+                if SHELLMODE and names:
+                    print "%s package(s): %s" % (doing, ', '.join(names))
+                ids = [pkg['.id'] for pkg in installed
+                       for name in names if name in pkg['name']]
+                if ids:
+                    sentences.append(['/system/package/' + action,
+                                      '=numbers=' + ','.join(ids)])
+            if sentences:
+                apicmd(module, device, sentences)
                 changed = True
-        if not upload:
+        elif not upload:
             if scheduled_packages and (disable or enable):
                 _res = sshcmd(module, device, cmd_timeout,
                     'system package unschedule [find scheduled~"scheduled"]')
@@ -427,12 +813,22 @@ def main():
                 cmd = "system package downgrade"
             else:
                 cmd = "system reboot"
-            _res = sshcmd(module, device, cmd_timeout, cmd)
-            device.close()
+            if api:
+                try: # router may drop the connection before answering
+                    device.talk([['/' + cmd.replace(' ', '/')]])
+                except (ApiError, socket.error):
+                    pass
+                device.close()
+            else:
+                _res = sshcmd(module, device, cmd_timeout, cmd)
+                if rosdev['persistent']:
+                    device.terminate()
+                else:
+                    device.close()
             if SHELLMODE:
-                print "Waiting %d seconds for reboot (/%s)..." % (reboot_timeout, cmd)
-            time.sleep(reboot_timeout)
-            turn += 1
+                print "Waiting up to %d seconds for reboot (/%s)..." % (reboot_timeout, cmd)
+            reboot_time = wait_reboot(module, device, rosdev, cmd_timeout,
+                                      reboot_timeout)
         turn += 1
 
     if SHELLMODE:
@@ -443,15 +839,24 @@ def main():
             print "disabled_packages: %s" % ', '.join(disabled_packages)
         if scheduled_packages:
             print "scheduled_packages: %s" % ', '.join(scheduled_packages)
+        if reboot_time:
+            print "reboot_time: %.1f" % reboot_time
         if not changed:
             print "Nothing changed."
+        if timings:
+            print '\n'.join(rosdev['timings'].report())
         sys.exit(0)
 
+    extra = {}
+    if timings:
+        extra['timings'] = rosdev['timings'].result()
     safe_exit(module, device, changed=changed,
               routeros_version=device_version,
               enabled_packages=enabled_packages,
               disabled_packages=disabled_packages,
-              uploaded_packages=upload)
+              uploaded_packages=upload, upload_stats=upload_stats,
+              upload_size=upload_size,
+              reboot_time=reboot_time, **extra)
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 or SHELLMODE:
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""MikroTik RouterOS rolling fleet upgrade with mikrotik_package.py
+
+Hosts are upgraded in waves, canaries first, then waves growing by
+wave_growth up to max_wave hosts. Every host is handled in two phases
+by library/mikrotik_package.py: packages are uploaded (at most
+max_uploads hosts at once), then the host is rebooted into the new
+version (at most max_reboots hosts at once). A wave whose failure rate
+is above max_failures stops the rollout. Progress is kept in a state
+file, so an interrupted or stopped rollout resumes with the hosts that
+are not done yet.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+ROLLOUTDEFS = {
+    'inventory': None,
+    'version': None,
+    'packages': None,
+    'repository': 'routeros',
+    'username': 'admin',
+    'password': '',
+    'port': 22,
+    'transport': 'ssh',
+    'timeout': 60,
+    'reboot_timeout': 300,
+    'canaries': 1,
+    'wave_growth': 2.0,
+    'max_wave': 100,
+    'max_uploads': 10,
+    'max_reboots': 10,
+    'max_failures': 0.1,
+    'host_timeout': 1800,
+    'state': None,
+    'plan': False
+}
+USAGE = """
+mikrotik_rollout.py --inventory=<file> --version=<version>
+                   [--packages=<pkg1,pkg2...>] [--repository=<path>]
+                   [--canaries=<n|host1,host2...>] [--wave_growth=<factor>]
+                   [--max_wave=<n>] [--max_uploads=<n>] [--max_reboots=<n>]
+                   [--max_failures=<fraction>] [--host_timeout=<seconds>]
+                   [--reboot_timeout=<seconds>] [--state=<file>] [--plan]
+                   [--port=<port>] [--username=<username>] [--password=<password>]
+                   [--transport=ssh|api]
+
+The repository index is checked up front for --version and the listed
+--packages (plus system and security) only. Other packages enabled on a
+router (e.g. ipv6) are looked up when its upload starts, a missing one
+fails that host before anything is uploaded or rebooted.
+"""
+PACKAGE_MODULE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              'library', 'mikrotik_package.py')
+DEFAULT_PACKAGES = ['system', 'security']
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'module_utils'))
+from mikrotik_repo import load_index, index_missing
+from mikrotik_inventory import parse_inventory
+
+def parse_opts(cmdline):
+    """returns command line options as dict"""
+    options = dict(ROLLOUTDEFS)
+    for opt in cmdline:
+        if opt.startswith('--'):
+            try:
+                arg, val = opt.split("=", 1)
+            except ValueError:
+                arg = opt
+                val = True
+            else:
+                if val.lower() in ('no', 'false'):
+                    val = False
+                elif val.lower() in ('yes', 'true'):
+                    val = True
+            arg = arg[2:]
+            if arg not in options:
+                print USAGE
+                sys.exit("Unknown option: --%s" % arg)
+            if isinstance(options[arg], (int, float)) and \
+                    not isinstance(options[arg], bool) and val not in (True, False):
+                try:
+                    val = type(options[arg])(val)
+                except ValueError:
+                    if arg != 'canaries':
+                        sys.exit("Numeric value required: --%s=%s" % (arg, val))
+            options[arg] = val
+    if not options['inventory'] or not options['version']:
+        print USAGE
+        sys.exit("inventory and version are required")
+    if not options['state']:
+        options['state'] = "rollout-%s.json" % options['version']
+    return options
+
+def plan_waves(hosts, canaries, growth, max_wave):
+    """returns list of waves (lists of hosts), canaries first"""
+    if isinstance(canaries, str):
+        first = [host for host in canaries.split(',') if host in hosts]
+    else:
+        first = hosts[:int(canaries)]
+    rest = [host for host in hosts if host not in first]
+    waves = [first] if first else []
+    size = max(len(first), 1)
+    while rest:
+        size = min(max(int(size * growth), size + 1), max_wave)
+        waves.append(rest[:size])
+        rest = rest[size:]
+    return waves
+
+class Rollout(object):
+    """rollout state kept in a json file, saved after every host"""
+
+    def __init__(self, path, version, packages):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'version': version, 'packages': packages, 'hosts': {}}
+        if os.path.exists(path):
+            with open(path, 'r') as saved:
+                self.state = json.load(saved)
+            if self.state['version'] != version:
+                sys.exit("State file %s is for version %s, remove it or use --state"
+                         % (path, self.state['version']))
+
+    def done(self, host):
+        """checks if host was already upgraded"""
+        return self.state['hosts'].get(host, {}).get('status') == 'done'
+
+    def update(self, host, **result):
+        """records host result and saves state atomically"""
+        with self.lock:
+            self.state['hosts'].setdefault(host, {}).update(result)
+            tmpfd, tmppath = tempfile.mkstemp(dir=os.path.dirname(
+                os.path.abspath(self.path)), suffix='.tmp')
+            with os.fdopen(tmpfd, 'w') as saved:
+                json.dump(self.state, saved, indent=1, sort_keys=True)
+            os.rename(tmppath, self.path)
+
+def package_run(opts, options, reboot):
+    """runs mikrotik_package.py for one host, returns (ok, version, message)"""
+    cmd = [sys.executable, PACKAGE_MODULE,
+           '--hostname=%s' % opts['hostname'],
+           '--port=%s' % opts.get('port', options['port']),
+           '--username=%s' % opts.get('username', options['username']),
+           '--timeout=%s' % options['timeout'],
+           '--transport=%s' % options['transport'],
+           '--repository=%s' % options['repository'],
+           '--version=%s' % options['version'],
+           '--reboot=%s' % ('yes' if reboot else 'no'),
+           '--reboot_timeout=%s' % options['reboot_timeout']]
+    if options['packages']:
+        cmd.append('--packages=%s' % options['packages'])
+    # password in the environment, command lines are visible to all users
+    env = dict(os.environ, MIKROTIK_PASSWORD=options['password'])
+    proc = subprocess.Popen(cmd, stdin=open(os.devnull), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True, env=env)
+    timer = threading.Timer(options['host_timeout'], proc.kill)
+    timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    version = None
+    lines = [line for line in output.splitlines() if line.strip()]
+    for line in lines:
+        if line.startswith('routeros_version: '):
+            version = line.split(': ', 1)[1].strip()
+    if proc.returncode:
+        return False, version, lines[-1] if lines else "exit %s" % proc.returncode
+    return True, version, ''
+
+def upgrade_host(rollout, host, opts, options, uploads, reboots):
+    """uploads packages and reboots one host, returns True on success"""
+    started = time.time()
+    with uploads:
+        rollout.update(host, status='uploading', started=started)
+        success, version, message = package_run(opts, options, False)
+    if success and version != options['version']:
+        with reboots:
+            rollout.update(host, status='rebooting')
+            success, version, message = package_run(opts, options, True)
+        if success and version != options['version']:
+            success = False
+            message = "still running %s after reboot" % version
+    rollout.update(host, status='done' if success else 'failed',
+                   version=version, error=message,
+                   seconds=round(time.time() - started, 1))
+    print "%-24s %-7s %8.1fs %s" % (host, 'ok' if success else 'FAILED',
+                                     time.time() - started, message or version)
+    sys.stdout.flush()
+    return success
+
+def main():
+    options = parse_opts(sys.argv[1:])
+    try:
+        inventory = parse_inventory(options['inventory'])
+    except IOError as inventory_error:
+        sys.exit("Inventory error: " + str(inventory_error))
+    hostopts = dict(inventory)
+    index = load_index(os.path.expanduser(options['repository']))
+    if index:
+        if options['version'] not in index['packages']:
+            sys.exit("Version %s not in repository index" % options['version'])
+        packages = list(DEFAULT_PACKAGES)
+        if options['packages']:
+            packages += options['packages'].split(',')
+        missing = index_missing(index, options['version'], packages)
+        if missing:
+            sys.exit("Packages not in repository index: " + ', '.join(missing))
+        print "Repository %s: %s" % (options['version'], ', '.join(
+            "%s %.1f MB" % (arch, sum(pkg['size'] for pkg in files.values()) / 1048576.0)
+            for arch, files in sorted(index['packages'][options['version']].items())))
+    rollout = Rollout(options['state'], options['version'], options['packages'])
+    hosts = [host for host, _opts in inventory if not rollout.done(host)]
+    waves = plan_waves(hosts, options['canaries'], options['wave_growth'],
+                       options['max_wave'])
+    print "Rollout of RouterOS %s: %d hosts (%d done), %d waves, state in %s" % (
+        options['version'], len(inventory), len(inventory) - len(hosts),
+        len(waves), options['state'])
+    if options['plan']:
+        for number, wave in enumerate(waves):
+            print "wave %d (%d): %s" % (number, len(wave), ', '.join(wave))
+        sys.exit(0)
+    uploads = threading.Semaphore(options['max_uploads'])
+    reboots = threading.Semaphore(options['max_reboots'])
+    for number, wave in enumerate(waves):
+        print "--- wave %d: %d hosts" % (number, len(wave))
+        pool = ThreadPool(min(len(wave), options['max_uploads'] + options['max_reboots']))
+        results = pool.map(lambda host: upgrade_host(rollout, host, hostopts[host],
+                                                     options, uploads, reboots), wave)
+        pool.close()
+        pool.join()
+        failed = results.count(False)
+        limit = 0 if number == 0 and options['canaries'] else options['max_failures']
+        if failed and float(failed) / len(wave) > limit:
+            sys.exit("Rollout stopped: %d of %d hosts failed in wave %d, "
+                     "resume with the same command after fixing them"
+                     % (failed, len(wave), number))
+    failed = [host for host, _opts in inventory if not rollout.done(host)]
+    if failed:
+        sys.exit("Rollout finished, %d hosts failed: %s" % (len(failed),
+                                                         ', '.join(failed)))
+    print "Rollout finished, all hosts run RouterOS %s" % options['version']
+
+if __name__ == '__main__':
+    main()
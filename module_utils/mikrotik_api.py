@@ -0,0 +1,201 @@
+# coding: utf-8
+"""MikroTik RouterOS API client for ansible-mikrotik modules
+
+Modules using transport 'api' talk to the RouterOS API service (8728, or
+8729 with TLS) instead of scraping CLI output over ssh. Every sentence is
+sent with its own .tag, so a whole list of queries is written at once and
+the replies (which RouterOS may interleave) are sorted by tag, one round
+trip instead of one per query. Replies are records (dicts) already, CLI
+'print' commands used by the ssh code paths are translated with
+cli_sentence(), api_records() adds terse-like '.flags' to them and
+cli_value() gives values the form of CLI print (yes/no, MiB).
+"""
+
+import ssl
+import socket
+import hashlib
+import binascii
+
+API_PORT = 8728
+API_SSL_PORT = 8729
+# values the API returns in bytes, CLI prints them in MiB
+API_BYTES = ('free-memory', 'total-memory', 'free-hdd-space', 'total-hdd-space')
+
+class ApiError(Exception):
+    """trap or fatal reply from RouterOS API"""
+
+def encode_length(length):
+    """returns RouterOS API word length prefix"""
+    if length < 0x80:
+        return chr(length)
+    if length < 0x4000:
+        length |= 0x8000
+        return chr(length >> 8) + chr(length & 0xff)
+    if length < 0x200000:
+        length |= 0xc00000
+        return chr(length >> 16) + chr((length >> 8) & 0xff) + chr(length & 0xff)
+    if length < 0x10000000:
+        length |= 0xe0000000
+        return ''.join(chr((length >> shift) & 0xff) for shift in (24, 16, 8, 0))
+    return '\xf0' + ''.join(chr((length >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+def decode_length(read):
+    """reads RouterOS API word length prefix with read(n)"""
+    first = ord(read(1))
+    if first < 0x80:
+        return first
+    if first < 0xc0:
+        extra, length = 1, first & 0x3f
+    elif first < 0xe0:
+        extra, length = 2, first & 0x1f
+    elif first < 0xf0:
+        extra, length = 3, first & 0x0f
+    else:
+        extra, length = 4, 0
+    for char in read(extra):
+        length = (length << 8) | ord(char)
+    return length
+
+def encode_sentence(words):
+    """returns sentence as it is sent on the wire"""
+    return ''.join(encode_length(len(word)) + word for word in words) + '\x00'
+
+def cli_sentence(command):
+    """translates CLI print command to API sentence words, e.g.
+    'ip address print terse where disabled=no' to
+    ['/ip/address/print', '?disabled=false']"""
+    command, _where, query = command.partition(' where ')
+    path = []
+    for word in command.split():
+        if word in ('print', 'export'):
+            break
+        path.append(word)
+    words = ['/' + '/'.join(path) + '/print']
+    for cond in query.split(' and ') if query else []:
+        key, _eq, val = cond.strip().partition('=')
+        val = val.strip('"')
+        val = {'no': 'false', 'yes': 'true'}.get(val, val)
+        words.append('?%s=%s' % (key.strip(), val))
+    return words
+
+def cli_value(key, val):
+    """returns API value of key as CLI print shows it"""
+    if val in ('true', 'false'):
+        return 'yes' if val == 'true' else 'no'
+    if key in API_BYTES and val.isdigit():
+        return '%.1fMiB' % (int(val) / 1048576.0)
+    return val
+
+def api_records(records):
+    """adds terse print like '.flags' (X for disabled) to API records"""
+    for record in records:
+        record.setdefault('.flags', 'X' if record.get('disabled') == 'true' else '')
+    return records
+
+class ApiClient(object):
+    """RouterOS API connection with tagged, pipelined requests"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.tag = 0
+        self.bytes_in = 0
+
+    def connect(self, hostname, port=None, username='admin', password='',
+                use_ssl=False):
+        """opens (TLS) connection and logs in"""
+        if not port:
+            port = API_SSL_PORT if use_ssl else API_PORT
+        sock = socket.create_connection((hostname, int(port)), self.timeout)
+        if use_ssl:
+            # RouterOS api-ssl uses a self-signed or anonymous (ADH) certificate
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = ssl.CERT_NONE
+            try:
+                context.set_ciphers('ADH:ALL:@SECLEVEL=0')
+            except ssl.SSLError:
+                context.set_ciphers('ADH:ALL')
+            sock = context.wrap_socket(sock, server_hostname=hostname)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        records, done = self.command('/login', name=username, password=password)
+        if 'ret' in done: # pre 6.43 challenge-response login
+            challenge = binascii.unhexlify(done['ret'])
+            response = hashlib.md5('\x00' + password + challenge).hexdigest()
+            self.command('/login', name=username, response='00' + response)
+
+    def talk(self, sentences):
+        """sends all sentences at once, returns list of (records, done, trap)
+        tuples in sentence order, trap is None or error message"""
+        tags = []
+        data = []
+        for words in sentences:
+            self.tag += 1
+            tags.append(str(self.tag))
+            data.append(encode_sentence(list(words) + ['.tag=%d' % self.tag]))
+        self.sock.sendall(''.join(data))
+        replies = dict((tag, ([], {}, None)) for tag in tags)
+        pending = set(tags)
+        while pending:
+            reply, attrs = self.read_sentence()
+            tag = attrs.pop('.tag', None)
+            if reply == '!fatal':
+                raise ApiError(attrs.get('message', 'fatal error'))
+            if tag not in replies:
+                continue
+            records, done, trap = replies[tag]
+            if reply == '!re':
+                records.append(attrs)
+            elif reply == '!trap':
+                trap = attrs.get('message', 'unknown error')
+            elif reply == '!done':
+                done.update(attrs)
+                pending.discard(tag)
+            replies[tag] = (records, done, trap)
+        return [replies[tag] for tag in tags]
+
+    def command(self, path, *args, **attrs):
+        """runs one command with =key=value attributes (and raw words in
+        args), returns (records, done attributes), raises ApiError on trap"""
+        words = [path] + list(args)
+        words += ['=%s=%s' % (key.replace('_', '-'), val) for key, val in attrs.items()]
+        records, done, trap = self.talk([words])[0]
+        if trap:
+            raise ApiError(trap)
+        return records, done
+
+    def read_sentence(self):
+        """returns reply word and attribute dict of next sentence"""
+        words = []
+        while True:
+            length = decode_length(self.read)
+            if not length:
+                break
+            words.append(self.read(length))
+        attrs = {}
+        for word in words[1:]:
+            if word.startswith('='):
+                key, _eq, val = word[1:].partition('=')
+                attrs[key] = val
+            elif word.startswith('.tag='):
+                attrs['.tag'] = word[5:]
+        return words[0] if words else '', attrs
+
+    def read(self, size):
+        """reads exactly size bytes"""
+        data = self.reader.read(size)
+        self.bytes_in += len(data)
+        if len(data) < size:
+            raise ApiError('connection closed')
+        return data
+
+    def close(self):
+        """closes connection"""
+        if self.sock:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
@@ -0,0 +1,36 @@
+# coding: utf-8
+"""ansible (ini) inventory reader for ansible-mikrotik fleet tools
+
+mikrotik_export.py (fleet mode) and mikrotik_rollout.py run one module
+per inventory host from a single process, parse_inventory() gives them
+the hosts with their connection variables (ansible_host, ansible_port,
+ansible_user); group variables and children sections are ignored.
+"""
+
+def parse_inventory(inventory):
+    """returns list of (host, options) from ansible ini inventory file"""
+    hosts = []
+    seen = set()
+    section = ''
+    with open(inventory, 'r') as inv:
+        for line in inv:
+            line = line.split('#')[0].split(';')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                section = line.strip('[]')
+                continue
+            if ':' in section: # group vars or children
+                continue
+            fields = line.split()
+            hostvars = dict(field.split('=', 1) for field in fields[1:]
+                            if '=' in field)
+            opts = {'hostname': hostvars.get('ansible_host', fields[0])}
+            if 'ansible_port' in hostvars:
+                opts['port'] = int(hostvars['ansible_port'])
+            if 'ansible_user' in hostvars:
+                opts['username'] = hostvars['ansible_user']
+            if fields[0] not in seen:
+                seen.add(fields[0])
+                hosts.append((fields[0], opts))
+    return hosts
@@ -0,0 +1,356 @@
+# coding: utf-8
+"""MikroTik RouterOS persistent ssh connections for ansible-mikrotik modules
+
+Every module task normally opens its own paramiko.SSHClient, so each task
+pays a full key exchange and authentication. With persistent connections
+the first task for a router forks a small background process that keeps
+one authenticated transport open, later tasks (and other modules) open
+their exec and sftp channels on it through a local unix socket. Idle
+connections expire after persist_timeout seconds and at most persist_max
+of them are kept open, the least recently used ones are closed first.
+"""
+
+import os
+import json
+import glob
+import time
+import errno
+import select
+import socket
+import hmac
+import hashlib
+import tempfile
+import threading
+from StringIO import StringIO
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+try:
+    from ansible.module_utils.mikrotik_timing import timed_client
+except ImportError:
+    from mikrotik_timing import timed_client
+
+PERSIST_DIR = '~/.ansible/mikrotik_cp'
+PERSIST_TIMEOUT = 60
+PERSIST_MAX = 64
+PERSIST_KEY = '.key'
+BUFSIZE = 32768
+
+def persist_key(persist_dir):
+    """returns random key of persist_dir, creates both if missing"""
+    if not os.path.isdir(persist_dir):
+        os.makedirs(persist_dir, 0700)
+    path = os.path.join(persist_dir, PERSIST_KEY)
+    if not os.path.exists(path):
+        tmpfd, tmppath = tempfile.mkstemp(dir=persist_dir) # created 0600
+        os.write(tmpfd, os.urandom(32))
+        os.close(tmpfd)
+        try:
+            os.link(tmppath, path) # fails if another task was first
+        except OSError as link_error:
+            if link_error.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(tmppath)
+    with open(path, 'rb') as keyfile:
+        return keyfile.read()
+
+def control_path(persist_dir, hostname, port, username, password):
+    """returns unix socket path for given router and credentials, an HMAC
+    with the user's persist_key, so the name gives nothing away"""
+    ident = "%s@%s:%s/%s" % (username, hostname, port, password or '')
+    digest = hmac.new(persist_key(persist_dir), ident, hashlib.sha256).hexdigest()
+    return os.path.join(persist_dir, digest[:16] + '.sock')
+
+def ssh_client(rosdev):
+    """returns new persistent or plain ssh client for rosdev, wrapped in
+    TimedClient if rosdev collects timings"""
+    if rosdev.get('persistent'):
+        device = PersistentClient(
+            persist_timeout=rosdev.get('persist_timeout', PERSIST_TIMEOUT),
+            persist_max=rosdev.get('persist_max', PERSIST_MAX))
+    else:
+        device = paramiko.SSHClient()
+        device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return timed_client(device, rosdev.get('timings'))
+
+def _readline(sock):
+    """reads a single protocol line without buffering past it"""
+    line = ''
+    while not line.endswith('\n'):
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line.rstrip('\n')
+
+class ChannelSocket(socket.socket):
+    """unix socket standing in for a paramiko channel"""
+
+    def get_name(self):
+        """channel name used in paramiko log messages"""
+        return 'persistent'
+
+class PersistentClient(object):
+    """paramiko.SSHClient look-alike using a persistent connection"""
+
+    def __init__(self, persist_dir=PERSIST_DIR, persist_timeout=PERSIST_TIMEOUT,
+                 persist_max=PERSIST_MAX):
+        self.persist_dir = os.path.expanduser(persist_dir)
+        self.persist_timeout = int(persist_timeout)
+        self.persist_max = int(persist_max)
+        self.path = None
+        self.timeout = None
+        self.sockets = []
+
+    def connect(self, hostname, port=22, username=None, password=None,
+                timeout=None, **kwargs):
+        """attaches to (or starts) persistent connection to hostname"""
+        self.timeout = timeout
+        self.path = control_path(self.persist_dir, hostname, port,
+                                 username, password)
+        try:
+            self._request('ping').close()
+            return
+        except socket.error as ping_error:
+            if ping_error.errno == errno.ECONNREFUSED:
+                os.unlink(self.path)
+        except paramiko.SSHException:
+            pass
+        kwargs.update(hostname=hostname, port=int(port), username=username,
+                      password=password, timeout=timeout)
+        self._spawn(kwargs)
+
+    def exec_command(self, command, timeout=None):
+        """executes command on persistent transport, returns stdin, stdout, stderr"""
+        sock = self._request('exec', command=command)
+        sock.settimeout(timeout)
+        return sock.makefile('wb'), sock.makefile('rb'), StringIO('')
+
+    def open_sftp(self, window_size=None, max_packet_size=None):
+        """opens sftp session on persistent transport"""
+        sock = self._request('sftp', window_size=window_size,
+                             max_packet_size=max_packet_size)
+        sock.settimeout(None)
+        return paramiko.SFTPClient(sock)
+
+    def get_transport(self):
+        """transport lives in another process"""
+        return None
+
+    def close(self):
+        """closes local channels only, transport stays open for reuse"""
+        for sock in self.sockets:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self.sockets = []
+
+    def terminate(self):
+        """closes local channels and the persistent transport"""
+        self.close()
+        if self.path:
+            try:
+                self._request('stop').close()
+            except (socket.error, paramiko.SSHException):
+                pass
+
+    def _request(self, operation, path=None, **args):
+        """sends request to connection process, returns connected socket"""
+        args['op'] = operation
+        sock = ChannelSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path or self.path)
+            sock.sendall(json.dumps(args) + '\n')
+            reply = _readline(sock)
+        except socket.error:
+            sock.close()
+            raise
+        if reply != 'ok':
+            sock.close()
+            raise paramiko.SSHException(reply or 'persistent connection closed')
+        self.sockets.append(sock)
+        return sock
+
+    def _evict(self):
+        """stops least recently used connections above persist_max"""
+        controls = glob.glob(os.path.join(self.persist_dir, '*.sock'))
+        controls.sort(key=lambda ctl: os.stat(ctl).st_mtime)
+        while len(controls) >= self.persist_max:
+            try:
+                self._request('stop', path=controls.pop(0)).close()
+            except (socket.error, paramiko.SSHException):
+                pass
+
+    def _spawn(self, connect_args):
+        """forks connection process and waits until it is ready"""
+        self._evict()
+        status_in, status_out = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(status_in)
+            try:
+                os.setsid()
+                if os.fork() == 0:
+                    # keep nothing of the module (ansible's pipes) but status
+                    os.closerange(3, status_out)
+                    os.closerange(status_out + 1, os.sysconf('SC_OPEN_MAX'))
+                    serve(self.path, connect_args, self.persist_timeout, status_out)
+            finally:
+                os._exit(0)
+        os.close(status_out)
+        os.waitpid(pid, 0)
+        status = ''
+        while True:
+            data = os.read(status_in, 1024)
+            if not data:
+                break
+            status += data
+        os.close(status_in)
+        if status != 'ok':
+            raise paramiko.SSHException(status or 'persistent connection failed')
+
+class PersistentServer(object):
+    """serves channel requests for one authenticated ssh transport"""
+
+    def __init__(self, device, listener, path, persist_timeout):
+        self.device = device
+        self.path = path
+        self.inode = os.stat(path).st_ino
+        self.transport = device.get_transport()
+        self.listener = listener
+        self.persist_timeout = persist_timeout
+        self.active = 0
+        self.last_used = time.time()
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        """accepts requests until idle, stopped or disconnected"""
+        self.listener.settimeout(1.0)
+        while not self.stopped and self.transport.is_active():
+            try:
+                conn, _addr = self.listener.accept()
+            except socket.timeout:
+                with self.lock:
+                    if not self.active and \
+                            time.time() - self.last_used > self.persist_timeout:
+                        break
+                continue
+            with self.lock:
+                self.active += 1
+                self.last_used = time.time()
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+            worker = threading.Thread(target=self.handle, args=(conn,))
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        """stops accepting requests and releases the socket path"""
+        self.stopped = True
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def handle(self, conn):
+        """opens requested channel and relays it to the client socket"""
+        chan = None
+        try:
+            conn.settimeout(None)
+            request = json.loads(_readline(conn) or '{}')
+            operation = request.get('op')
+            if not self.transport.is_active():
+                self.stop()
+                conn.sendall('error: ssh transport closed\n')
+            elif operation == 'ping':
+                conn.sendall('ok\n')
+            elif operation == 'stop':
+                self.stop()
+                conn.sendall('ok\n')
+            elif operation == 'exec':
+                chan = self.transport.open_session()
+                chan.exec_command(request['command'])
+            elif operation == 'sftp':
+                chan = self.transport.open_session(
+                    window_size=request.get('window_size'),
+                    max_packet_size=request.get('max_packet_size'))
+                chan.invoke_subsystem('sftp')
+            else:
+                conn.sendall('error: unknown request %s\n' % operation)
+            if chan:
+                conn.sendall('ok\n')
+                relay(conn, chan)
+        except Exception as error:
+            try:
+                conn.sendall('error: %s\n' % error)
+            except socket.error:
+                pass
+        finally:
+            if chan:
+                chan.close()
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.time()
+
+def relay(conn, chan):
+    """copies data between client socket and ssh channel until either closes"""
+    while True:
+        readable = select.select([conn, chan], [], [], 1.0)[0]
+        if chan in readable:
+            data = chan.recv(BUFSIZE)
+            if not data:
+                break
+            conn.sendall(data)
+        if conn in readable:
+            data = conn.recv(BUFSIZE)
+            if not data:
+                break
+            chan.sendall(data)
+
+def serve(path, connect_args, persist_timeout, status_fd):
+    """connection process main, reports 'ok' or error on status_fd"""
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for stdio in (0, 1, 2):
+        os.dup2(devnull, stdio)
+    if devnull > 2:
+        os.close(devnull)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+    except socket.error as bind_error:
+        if bind_error.errno == errno.EADDRINUSE:
+            os.write(status_fd, 'ok')
+        else:
+            os.write(status_fd, 'error binding %s: %s' % (path, bind_error))
+        return
+    os.chmod(path, 0600)
+    listener.listen(16)
+    device = paramiko.SSHClient()
+    device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        device.connect(**connect_args)
+    except Exception as ssh_error:
+        os.unlink(path)
+        os.write(status_fd, str(ssh_error) or repr(ssh_error))
+        return
+    device.get_transport().set_keepalive(15)
+    os.write(status_fd, 'ok')
+    os.close(status_fd)
+    server = PersistentServer(device, listener, path, persist_timeout)
+    try:
+        server.run()
+    finally:
+        server.stop()
+        listener.close()
+        device.close()
@@ -0,0 +1,269 @@
+# coding: utf-8
+"""MikroTik RouterOS local package repository index for ansible-mikrotik
+
+The routeros/*.sh scripts lay packages out as <version>/<arch>/<pkg>.npk.
+The index (index.json in the repository root) maps every version, arch
+and package file to its relative path, size, mtime and sha256, so modules
+find packages with a dict lookup, know transfer sizes before connecting
+and can check a whole fleet for missing packages in one pass. Run this
+file with the repository path to (re)build the index, unchanged files
+(same size and mtime) keep their hashes from the previous index.
+
+Package contents are stored once in .blobs/<sha256[:2]>/<sha256>, the
+<version>/<arch>/<pkg> files are hardlinks to them (rsync -H keeps them
+that way on mirrors). Anything updating the repository must replace a
+file (write a new one and rename it into place, as routeros/update.py and
+the fetch() of routeros/fetch.sh do) instead of writing into it, or the
+blob and every other link change with it. Release trees seen by the updater are recorded in
+channels.json, retain_versions() deletes versions that dropped out of
+the newest N of every channel and collect_blobs() removes blobs that no
+package links to anymore.
+
+Packages can also stay inside the all_packages-<arch>-<version>.zip files
+in <version>, their index entries name the zip and the member and
+open_package() decompresses them on the fly, so a release is usable as
+soon as its zip is downloaded. Extracted files win over zip members. The
+zips are stored as blobs too, their hashes are kept under 'archives'.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import zipfile
+
+INDEX_FILE = 'index.json'
+CHANNELS_FILE = 'channels.json'
+BLOB_DIR = '.blobs'
+INDEX_FORMAT = 1
+ZIP_NAME = 'all_packages-%s-%s.zip' # arch, version
+
+def stream_sha256(data):
+    """returns sha256 hexdigest of file object contents"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: data.read(1024 * 1024), ''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path):
+    """returns sha256 hexdigest of local file"""
+    with open(path, 'rb') as data:
+        return stream_sha256(data)
+
+def load_index(repository):
+    """returns repository index dict or None if there is no (valid) index"""
+    try:
+        with open(os.path.join(repository, INDEX_FILE), 'r') as index:
+            index = json.load(index)
+    except (IOError, ValueError):
+        return None
+    if index.get('format') != INDEX_FORMAT:
+        return None
+    return index
+
+def save_json(path, data):
+    """writes json file atomically"""
+    tmpfd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(tmpfd, 'w') as tmp:
+        json.dump(data, tmp, indent=1, sort_keys=True)
+    os.chmod(tmppath, 0644)
+    os.rename(tmppath, path)
+
+def link_blob(repository, path, sha256):
+    """stores file content as blob or replaces file with link to existing blob"""
+    blob = os.path.join(repository, BLOB_DIR, sha256[:2], sha256)
+    try:
+        if not os.path.exists(blob):
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob), 0755)
+            os.link(path, blob)
+        elif not os.path.samefile(path, blob):
+            tmppath = path + '.blob'
+            os.link(blob, tmppath)
+            os.rename(tmppath, path)
+    except OSError:
+        pass # no hardlinks on this filesystem, keep plain file
+    return os.stat(path)
+
+def build_index(repository):
+    """scans repository and writes index, returns (index, hashed files)"""
+    previous = load_index(repository) or {'packages': {}}
+    packages = {}
+    archives = {}
+    hashed = 0
+    for version in sorted(os.listdir(repository)):
+        vpath = os.path.join(repository, version)
+        if version.startswith('.') or os.path.islink(vpath) or \
+                not os.path.isdir(vpath):
+            continue # release tree symlinks (bugfix, current) point to versions
+        for arch in sorted(os.listdir(vpath)):
+            apath = os.path.join(vpath, arch)
+            if os.path.islink(apath) or not os.path.isdir(apath):
+                continue
+            for pkg in sorted(os.listdir(apath)):
+                if not pkg.endswith('.npk'):
+                    continue
+                ppath = os.path.join(apath, pkg)
+                stat = os.stat(ppath)
+                entry = previous['packages'].get(version, {}).get(arch, {}).get(pkg)
+                changed = not entry or entry['size'] != stat.st_size or \
+                          entry['mtime'] != int(stat.st_mtime)
+                if changed:
+                    entry = {'path': os.path.join(version, arch, pkg),
+                             'sha256': file_sha256(ppath)}
+                    hashed += 1
+                if changed or stat.st_nlink < 2: # not linked to its blob yet
+                    stat = link_blob(repository, ppath, entry['sha256'])
+                    entry.update(size=stat.st_size, mtime=int(stat.st_mtime))
+                packages.setdefault(version, {}).setdefault(arch, {})[pkg] = entry
+        for archive in sorted(os.listdir(vpath)):
+            if not archive.startswith('all_packages-') or not archive.endswith('.zip'):
+                continue
+            arch = archive[len('all_packages-'):-len('-%s.zip' % version)]
+            zpath = os.path.join(vpath, archive)
+            if not zipfile.is_zipfile(zpath):
+                continue # incomplete or damaged zip, not usable
+            zentry = previous.get('archives', {}).get(os.path.join(version, archive))
+            stat = os.stat(zpath)
+            changed = not zentry or zentry['size'] != stat.st_size or \
+                      zentry['mtime'] != int(stat.st_mtime)
+            if changed:
+                zentry = {'sha256': file_sha256(zpath)}
+                hashed += 1
+            if changed or stat.st_nlink < 2:
+                stat = link_blob(repository, zpath, zentry['sha256'])
+                zentry.update(size=stat.st_size, mtime=int(stat.st_mtime))
+            archives[os.path.join(version, archive)] = zentry
+            mtime = zentry['mtime']
+            try:
+                with zipfile.ZipFile(zpath) as pkgs:
+                    for info in pkgs.infolist():
+                        pkg = os.path.basename(info.filename)
+                        if not pkg.endswith('.npk') or \
+                                pkg in packages.get(version, {}).get(arch, {}):
+                            continue
+                        entry = previous['packages'].get(version, {}).get(arch, {}).get(pkg)
+                        if not entry or entry.get('member') != info.filename or \
+                                entry['mtime'] != mtime or entry['size'] != info.file_size:
+                            with pkgs.open(info) as member:
+                                entry = {'path': os.path.join(version, archive),
+                                         'member': info.filename, 'mtime': mtime,
+                                         'size': info.file_size,
+                                         'sha256': stream_sha256(member)}
+                            hashed += 1
+                        packages.setdefault(version, {}).setdefault(arch, {})[pkg] = entry
+            except (zipfile.BadZipfile, IOError):
+                continue # incomplete or damaged zip, not usable
+    index = {'format': INDEX_FORMAT, 'generated': int(time.time()),
+             'packages': packages, 'archives': archives}
+    save_json(os.path.join(repository, INDEX_FILE), index)
+    return index, hashed
+
+def collect_blobs(repository):
+    """removes blobs without package links, returns (files, bytes) removed"""
+    removed = [0, 0]
+    for folder, _dirs, blobs in os.walk(os.path.join(repository, BLOB_DIR)):
+        for blob in blobs:
+            stat = os.stat(os.path.join(folder, blob))
+            if stat.st_nlink == 1:
+                os.unlink(os.path.join(folder, blob))
+                removed[0] += 1
+                removed[1] += stat.st_size
+        if folder != os.path.join(repository, BLOB_DIR) and not os.listdir(folder):
+            os.rmdir(folder)
+    return tuple(removed)
+
+def update_channels(repository, releases):
+    """records current version of every release tree, returns channels"""
+    try:
+        with open(os.path.join(repository, CHANNELS_FILE), 'r') as saved:
+            channels = json.load(saved)
+    except (IOError, ValueError):
+        channels = {}
+    for release, version in releases:
+        history = channels.setdefault(release, [])
+        if version in history:
+            history.remove(version)
+        history.insert(0, version)
+    save_json(os.path.join(repository, CHANNELS_FILE), channels)
+    return channels
+
+def retain_versions(repository, channels, retain):
+    """deletes versions no channel keeps, retain is {channel: count} with
+    optional default under '*', versions never seen in a channel are kept"""
+    keep = set()
+    seen = set()
+    for release, history in channels.items():
+        keep.update(history[:max(1, retain.get(release, retain.get('*', 1)))])
+        seen.update(history)
+    deleted = []
+    for version in sorted(seen - keep):
+        vpath = os.path.join(repository, version)
+        if os.path.isdir(vpath) and not os.path.islink(vpath):
+            shutil.rmtree(vpath)
+            deleted.append(version)
+    return deleted
+
+def index_package(index, version, arch, pkg):
+    """returns index entry of package file or None"""
+    return index['packages'].get(version, {}).get(arch, {}).get(pkg)
+
+def find_package(repository, version, arch, pkg):
+    """returns index-like entry (without sha256) of package file found in
+    repository folders or all_packages zip, None if there is none"""
+    ppath = os.path.join(version, arch, pkg)
+    if os.path.isfile(os.path.join(repository, ppath)):
+        return {'path': ppath, 'size': os.path.getsize(os.path.join(repository, ppath))}
+    zpath = os.path.join(version, ZIP_NAME % (arch, version))
+    try:
+        with zipfile.ZipFile(os.path.join(repository, zpath)) as pkgs:
+            for info in pkgs.infolist():
+                if os.path.basename(info.filename) == pkg:
+                    return {'path': zpath, 'member': info.filename,
+                            'size': info.file_size}
+    except (zipfile.BadZipfile, IOError):
+        pass
+    return None
+
+def open_package(repository, entry):
+    """opens package file or zip member for reading, checks its size"""
+    path = os.path.join(repository, entry['path'])
+    if entry.get('member'):
+        with zipfile.ZipFile(path) as pkgs:
+            info = pkgs.getinfo(entry['member'])
+            npk = pkgs.open(info)
+        size = info.file_size
+    else:
+        npk = open(path, 'rb')
+        size = os.fstat(npk.fileno()).st_size
+    if size != entry['size']:
+        npk.close()
+        raise IOError("%s changed since it was indexed, rebuild repository index" % path)
+    return npk
+
+def index_missing(index, version, packages):
+    """returns packages (names without version) not found for any arch"""
+    names = set()
+    for files in index['packages'].get(version, {}).values():
+        for pkg in files:
+            names.add(pkg.split('-' + version)[0])
+    missing = []
+    for pkg in packages:
+        if pkg in names or (pkg.startswith('wireless-') and 'wireless' in names):
+            continue # wireless-* packages are merged into wireless since 6.37
+        missing.append(pkg)
+    return missing
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not os.path.isdir(sys.argv[1]):
+        sys.exit("usage: mikrotik_repo.py <repository>")
+    INDEX, HASHED = build_index(sys.argv[1])
+    REMOVED = collect_blobs(sys.argv[1])
+    print "INDEX: %d versions, %d packages (%d hashed) in %s, %d unused blobs removed" % (
+        len(INDEX['packages']),
+        sum(len(files) for archs in INDEX['packages'].values()
+            for files in archs.values()),
+        HASHED, os.path.join(sys.argv[1], INDEX_FILE), REMOVED[0])
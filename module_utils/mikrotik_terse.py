@@ -0,0 +1,33 @@
+# coding: utf-8
+"""RouterOS 'print terse' output parser for ansible-mikrotik modules
+
+Terse print puts every item on one line: its number, flags and then
+key=value pairs, values with spaces or quotes are quoted and escaped.
+terse_records() turns such lines into dicts, the number and flags are
+kept under '.id' and '.flags' (API records get the same '.flags' from
+mikrotik_api.api_records()).
+"""
+
+import re
+
+TERSE_PAIR = re.compile(r'([\w.-]+)=("(?:[^"\\]|\\.)*"|.*?)(?=\s+[\w.-]+=|\s*$)')
+
+def terse_records(lines):
+    """returns list of record dicts from terse print lines"""
+    records = []
+    for line in lines:
+        line = line.rstrip()
+        pairs = TERSE_PAIR.search(line)
+        if not pairs:
+            continue
+        prefix = line[:pairs.start()].split()
+        record = {'.id': '', '.flags': ''}
+        if prefix and prefix[0].isdigit():
+            record['.id'] = prefix.pop(0)
+        record['.flags'] = ''.join(prefix)
+        for key, val in TERSE_PAIR.findall(line, pairs.start()):
+            if val.startswith('"') and val.endswith('"') and len(val) > 1:
+                val = re.sub(r'\\(.)', r'\1', val[1:-1])
+            record[key] = val
+        records.append(record)
+    return records
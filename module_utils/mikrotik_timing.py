@@ -0,0 +1,306 @@
+# coding: utf-8
+"""MikroTik RouterOS connection timings for ansible-mikrotik modules
+
+With the 'timings' option modules wrap their ssh (or API) client in
+TimedClient, which records how long name resolution, the tcp connect, the
+ssh handshake and the authentication took, latency and received bytes of
+every command (or API request) and throughput of every sftp transfer.
+Timings.result() is returned by modules as 'timings', shell mode prints
+Timings.report() with the slowest commands first.
+"""
+
+import os
+import time
+import socket
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+SLOW_COMMANDS = 10
+COMMAND_WIDTH = 60
+
+def resolve(hostname, timings=None):
+    """returns address of hostname, adds lookup time to timings 'dns'"""
+    if not timings:
+        return socket.gethostbyname(hostname)
+    return timings.timed('dns', socket.gethostbyname, hostname)
+
+def timed_client(device, timings=None):
+    """returns device wrapped in TimedClient if timings are collected"""
+    if not timings:
+        return device
+    return TimedClient(device, timings)
+
+class Timings(object):
+    """collected phase, command and sftp transfer timings of one module run"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.connects = 0
+        self.commands = []
+        self.transfers = []
+
+    def timed(self, phase, func, *args, **kwargs):
+        """calls func, adds its run time (even if it fails) to phase"""
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.time() - started
+
+    def command(self, command):
+        """returns new command entry, updated by its reader"""
+        entry = {'command': command, 'seconds': 0.0, 'bytes': 0}
+        self.commands.append(entry)
+        return entry
+
+    def transfer(self, operation, path):
+        """returns new sftp transfer entry"""
+        entry = {'operation': operation, 'path': path, 'seconds': 0.0, 'bytes': 0}
+        self.transfers.append(entry)
+        return entry
+
+    def result(self):
+        """returns timings as plain dict (seconds, bytes and bytes/s)"""
+        commands = [dict(entry, seconds=round(entry['seconds'], 3))
+                    for entry in self.commands]
+        transfers = []
+        for entry in self.transfers:
+            seconds = max(entry['seconds'], 0.001)
+            transfers.append(dict(entry, seconds=round(entry['seconds'], 3),
+                                  rate=int(entry['bytes'] / seconds)))
+        sftp_bytes = sum(entry['bytes'] for entry in transfers)
+        sftp_seconds = sum(entry['seconds'] for entry in self.transfers)
+        result = dict((phase, round(seconds, 3))
+                      for phase, seconds in self.phases.items())
+        result.update(total=round(time.time() - self.started, 3),
+                      connects=self.connects, commands=commands,
+                      command_seconds=round(sum(entry['seconds']
+                                                for entry in self.commands), 3),
+                      command_bytes=sum(entry['bytes'] for entry in commands),
+                      sftp=transfers, sftp_bytes=sftp_bytes,
+                      sftp_seconds=round(sftp_seconds, 3),
+                      sftp_rate=int(sftp_bytes / max(sftp_seconds, 0.001)))
+        return result
+
+    def report(self, limit=SLOW_COMMANDS):
+        """returns shell mode report lines, slowest commands first"""
+        result = self.result()
+        phases = ["%s %.3fs" % (phase, result[phase])
+                  for phase in ('dns', 'tcp_connect', 'ssh_connect', 'ssh_auth',
+                                'api_connect')
+                  if phase in result]
+        lines = ["timings: total %.3fs, %s (%d connect(s))"
+                 % (result['total'], ', '.join(phases), result['connects'])]
+        lines.append("- %d command(s): %.3fs, %d bytes received"
+                     % (len(result['commands']), result['command_seconds'],
+                        result['command_bytes']))
+        if result['sftp']:
+            lines.append("- %d sftp transfer(s): %d bytes in %.3fs (%.1f kB/s)"
+                         % (len(result['sftp']), result['sftp_bytes'],
+                            result['sftp_seconds'], result['sftp_rate'] / 1024.0))
+        slowest = sorted(result['commands'], key=lambda entry: -entry['seconds'])
+        for entry in slowest[:limit]:
+            command = ' '.join(entry['command'].split())
+            if len(command) > COMMAND_WIDTH:
+                command = command[:COMMAND_WIDTH - 3] + '...'
+            lines.append("  %8.3fs %9d B  %s" % (entry['seconds'], entry['bytes'],
+                                                 command))
+        for entry in sorted(result['sftp'], key=lambda entry: -entry['seconds']):
+            lines.append("  %8.3fs %9d B  sftp %s %s (%.1f kB/s)"
+                         % (entry['seconds'], entry['bytes'], entry['operation'],
+                            entry['path'], entry['rate'] / 1024.0))
+        return lines
+
+class TimedClient(object):
+    """ssh (paramiko.SSHClient or PersistentClient) or ApiClient wrapper
+    recording connect, command and sftp timings, other calls pass through"""
+
+    def __init__(self, device, timings):
+        self.device = device
+        self.timings = timings
+
+    def connect(self, hostname, port=22, **kwargs):
+        """connects device, a plain ssh client gets its tcp socket from here
+        so the tcp connect is told apart from the handshake (ssh_connect),
+        and its authentication (SSHClient._auth) is timed as ssh_auth"""
+        self.timings.connects += 1
+        if hasattr(self.device, 'talk'):
+            return self.timings.timed('api_connect', self.device.connect,
+                                      hostname, port, **kwargs)
+        auth = None
+        if paramiko and isinstance(self.device, paramiko.SSHClient):
+            if 'sock' not in kwargs:
+                kwargs['sock'] = self.timings.timed(
+                    'tcp_connect', socket.create_connection, (hostname, int(port)),
+                    kwargs.get('timeout'))
+            auth = getattr(self.device, '_auth', None)
+        if auth:
+            self.device._auth = lambda *args, **kwargs: self.timings.timed(
+                'ssh_auth', auth, *args, **kwargs)
+        authenticated = self.timings.phases.get('ssh_auth', 0.0)
+        try:
+            return self.timings.timed('ssh_connect', self.device.connect,
+                                      hostname, port=port, **kwargs)
+        except Exception:
+            if 'sock' in kwargs:
+                kwargs['sock'].close()
+            raise
+        finally:
+            if auth:
+                del self.device._auth
+                self.timings.phases['ssh_connect'] -= \
+                    self.timings.phases.get('ssh_auth', 0.0) - authenticated
+
+    def exec_command(self, command, *args, **kwargs):
+        """executes command, its stdout records latency and bytes read"""
+        entry = self.timings.command(command)
+        started = time.time()
+        stdin, stdout, stderr = self.device.exec_command(command, *args, **kwargs)
+        entry['seconds'] = time.time() - started
+        return stdin, TimedFile(stdout, entry, started), stderr
+
+    def talk(self, sentences):
+        """sends API sentences, records them as one request"""
+        entry = self.timings.command('; '.join(' '.join(words) for words in sentences))
+        received = self.device.bytes_in
+        started = time.time()
+        try:
+            return self.device.talk(sentences)
+        finally:
+            entry['seconds'] = time.time() - started
+            entry['bytes'] = self.device.bytes_in - received
+
+    def command(self, path, *args, **attrs):
+        """runs one API command, records it as one request"""
+        entry = self.timings.command(' '.join([path] + list(args)))
+        received = self.device.bytes_in
+        started = time.time()
+        try:
+            return self.device.command(path, *args, **attrs)
+        finally:
+            entry['seconds'] = time.time() - started
+            entry['bytes'] = self.device.bytes_in - received
+
+    def open_sftp(self, window_size=None, max_packet_size=None):
+        """opens sftp session recording its transfers"""
+        transport = self.device.get_transport()
+        if transport is None: # persistent connection
+            sftp = self.device.open_sftp(window_size=window_size,
+                                         max_packet_size=max_packet_size)
+        else:
+            sftp = paramiko.SFTPClient.from_transport(
+                transport, window_size=window_size, max_packet_size=max_packet_size)
+        return TimedSftp(sftp, self.timings)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+class TimedFile(object):
+    """command output (or sftp file) wrapper, every read or write updates
+    its entry with bytes and seconds since started"""
+
+    def __init__(self, stream, entry, started=None):
+        self.stream = stream
+        self.entry = entry
+        self.started = started or time.time()
+
+    def count(self, data):
+        """adds data to entry, returns data"""
+        self.entry['bytes'] += len(data)
+        self.entry['seconds'] = time.time() - self.started
+        return data
+
+    def read(self, *args):
+        """reads and counts data"""
+        return self.count(self.stream.read(*args))
+
+    def readline(self, *args):
+        """reads and counts a line"""
+        return self.count(self.stream.readline(*args))
+
+    def readlines(self, *args):
+        """reads and counts all lines"""
+        lines = self.stream.readlines(*args)
+        self.count(''.join(lines))
+        return lines
+
+    def write(self, data):
+        """writes and counts data"""
+        self.stream.write(data)
+        self.count(data)
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self.count(line)
+        self.count('')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """closes stream, a write is complete only now"""
+        self.stream.close()
+        self.count('')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class TimedSftp(object):
+    """paramiko.SFTPClient wrapper recording transfer bytes and seconds"""
+
+    def __init__(self, sftp, timings):
+        self.sftp = sftp
+        self.timings = timings
+
+    def transfer(self, entry, func, *args, **kwargs):
+        """runs func as sftp transfer entry, returns its result"""
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            entry['seconds'] = time.time() - started
+
+    def put(self, localpath, remotepath, *args, **kwargs):
+        """uploads local file, returns its SFTPAttributes"""
+        entry = self.timings.transfer('put', remotepath)
+        attr = self.transfer(entry, self.sftp.put, localpath, remotepath,
+                             *args, **kwargs)
+        entry['bytes'] = os.path.getsize(localpath)
+        return attr
+
+    def putfo(self, fileobj, remotepath, *args, **kwargs):
+        """uploads file object, returns its SFTPAttributes"""
+        entry = self.timings.transfer('put', remotepath)
+        attr = self.transfer(entry, self.sftp.putfo, fileobj, remotepath,
+                             *args, **kwargs)
+        entry['bytes'] = attr.st_size or 0
+        return attr
+
+    def get(self, remotepath, localpath, *args, **kwargs):
+        """downloads remote file"""
+        entry = self.timings.transfer('get', remotepath)
+        self.transfer(entry, self.sftp.get, remotepath, localpath, *args, **kwargs)
+        entry['bytes'] = os.path.getsize(localpath)
+
+    def getfo(self, remotepath, fileobj, *args, **kwargs):
+        """downloads remote file into file object, returns its size"""
+        entry = self.timings.transfer('get', remotepath)
+        entry['bytes'] = self.transfer(entry, self.sftp.getfo, remotepath, fileobj,
+                                       *args, **kwargs)
+        return entry['bytes']
+
+    def open(self, filename, mode='r', *args):
+        """opens remote file, its reads or writes are one transfer"""
+        entry = self.timings.transfer('write' if 'w' in mode or 'a' in mode
+                                      else 'read', filename)
+        return TimedFile(self.sftp.open(filename, mode, *args), entry)
+
+    def __getattr__(self, name):
+        return getattr(self.sftp, name)
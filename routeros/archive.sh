@@ -4,6 +4,8 @@ set -eu
 ros_scheme="https:"
 ros_archive="$ros_scheme//www.mikrotik.com/download/archive"
 ros_repo=.
+ros_index="$(dirname "$(readlink -f "$0")")/../module_utils/mikrotik_repo.py"
+. "$(dirname "$(readlink -f "$0")")/fetch.sh"
 
 if [ $# -eq 0 ]; then
     echo "Usage: archive.sh <routeros version>"
@@ -19,7 +21,7 @@ grep -Po "(?<=a href=\")[^\"]*/routeros/[^\"]*" |
       mkdir -p $version
       if echo $pkg | grep -q "/$version/all_packages-"; then
         arch="$(echo $pkg | grep -Po '(?<=all_packages-).*(?=-)')"
-        new=$(wget -nv -cNP $version $ros_scheme$pkg 2>&1)
+        new=$(fetch $version $ros_scheme$pkg)
         if [ "${#new}" -gt "1" ]; then
           echo "- new package $(basename $pkg) downloaded into $ros_repo/$version"
           mkdir -p $version/$arch
@@ -31,4 +33,5 @@ grep -Po "(?<=a href=\")[^\"]*/routeros/[^\"]*" |
       fi
     fi
   done
+python "$ros_index" .
 exit 0
\ No newline at end of file
@@ -0,0 +1,27 @@
+# sourced by latest.sh and archive.sh
+
+# fetch <folder> <url>: wget -N url into folder, prints wget output if the
+# file was downloaded. Repository files are hardlinked to .blobs (see
+# module_utils/mikrotik_repo.py) and wget writes through an existing file,
+# so it gets a sparse copy of the same size and mtime (for its -N check) in
+# a temporary folder and a downloaded file is renamed into place
+fetch() {
+  local folder="$1" url="$2" name tmp new
+  name="$(basename "$url")"
+  tmp="$(mktemp -d "$folder/.fetch.XXXXXX")"
+  if [ -f "$folder/$name" ]; then
+    truncate -s "$(stat -c %s "$folder/$name")" "$tmp/$name"
+    touch -r "$folder/$name" "$tmp/$name"
+  fi
+  if ! new="$(wget -nv -N -P "$tmp" "$url" 2>&1)"; then
+    rm -rf "$tmp"
+    echo "$new" >&2
+    return 1
+  fi
+  if [ "$(stat -c %s.%Y "$tmp/$name")" != \
+       "$(stat -c %s.%Y "$folder/$name" 2>/dev/null)" ]; then
+    mv -f "$tmp/$name" "$folder/$name"
+    echo "$new"
+  fi
+  rm -rf "$tmp"
+}
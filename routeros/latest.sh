@@ -4,6 +4,8 @@ set -eu
 # first run gets 1.5GB of files!
 ros_repo=routeros
 ros_latest="https://www.mikrotik.com/download"
+ros_index="$(dirname "$(readlink -f "$0")")/../module_utils/mikrotik_repo.py"
+. "$(dirname "$(readlink -f "$0")")/fetch.sh"
 
 cd $ros_repo > /dev/null 2>&1 || ros_repo=.
 wget -q -O- $ros_latest |
@@ -12,10 +14,10 @@ grep -Po "(?<=a href=\")[^\"]*/routeros/[^\"]*" |
     ver="$(echo $pkg | grep -Po '(?<=routeros/)[^/]*')"
     if echo $ver | grep -qv rc; then 
       mkdir -p $ver
-      wget -nv -cNP $ver https:$pkg
+      fetch $ver https:$pkg
       if echo $pkg | grep -q winbox; then
         wbv="$(echo $pkg | grep -Po '(?<=winbox/)[^/]*')"
-        cp -u $ver/winbox.exe $ver/winbox-$wbv.exe
+        cp -u --remove-destination $ver/winbox.exe $ver/winbox-$wbv.exe
       fi
     fi
   done
@@ -30,7 +32,8 @@ find . -maxdepth 2 -name "dude*.npk" |
   while read n; do
     ver="$(echo $n | grep -Po '(?<=/).*(?=/)')"
     arch="$(echo $n | grep -Po '(?<=-).*(?=\.)' | grep -Eo '[a-z]{3,}' || echo 'x86' )"
-    cp -u $n ./$ver/$arch/$(basename $n)
+    cp -u --remove-destination $n ./$ver/$arch/$(basename $n)
  done
+python "$ros_index" .
 #find . -maxdepth 1 -type d -ctime +90 -regex ".*[0-9]" -exec rm -rf {} \;
 exit 0
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""MikroTik RouterOS repository updater
+
+Downloads bugfix+current (all release trees found on the archive page)
+RouterOS packages from MikroTik web and creates an off-line repository
+for use with mikrotik_package.py Ansible module, the same way update.sh
+used to: all_packages zips are kept in <version> (mikrotik_package.py
+reads packages straight from them), routeros and dude npks are downloaded
+into <version>/<arch>, release trees are symlinked to their versions and
+versions.yml lists them as ansible vars.
+
+Files are downloaded concurrently (--workers) with conditional requests,
+ETag/Last-Modified of every file is kept in <file>.meta together with its
+size and sha256, so unchanged files cost one request and files damaged on
+disk are downloaded again. Downloads land in temporary files and zips are
+tested before they are used. With --extract=yes zips are extracted into
+<version>/<arch> as before, every npk is renamed into place and the zip
+is removed, its .meta remembers the extracted files instead.
+
+Packages end up as hardlinks into the content-addressed blob store of the
+repository index (module_utils/mikrotik_repo.py), only the newest --retain
+versions of every release tree are kept (e.g. --retain=2 or
+--retain=current:2,bugfix:4,*:1), versions downloaded by hand stay.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import zipfile
+import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+SCRIPT_VERSION = "v2017.07 by https://github.com/nekitamo"
+UPDATEDEFS = {
+    'url': 'https://www.mikrotik.com/download/archive',
+    'repo': 'routeros',
+    'workers': 4,
+    'timeout': 60,
+    'retain': '3',
+    'extract': False,
+    'log': 'update.log',
+    'versions': 'versions.yml'
+}
+USAGE = """
+update.py [--url=<archive page>] [--repo=<path>] [--workers=<n>]
+          [--timeout=<seconds>] [--retain=<n|channel:n,...>] [--log=<file>]
+          [--versions=<file>] [--extract=yes|no]
+"""
+CHUNK = 65536
+PAGE_ITEMS = re.compile(r'(?<=a href=")[^"]*/routeros/[^"]*|(?<=>)[^<]*release tree[^<]*')
+ROS_VERSION = re.compile(r'(?<=routeros/)[^/]*')
+ZIP_ARCH = re.compile(r'(?<=all_packages-).*(?=-)')
+NPK_ARCH = re.compile(r'(?<=routeros-).*(?=-)')
+DUDE_NPK = re.compile(r'/dude-[^/]*\.npk$')
+RETRY = 500 # skip urls before giving up version search
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             os.pardir, 'module_utils'))
+from mikrotik_repo import (build_index, file_sha256, collect_blobs,
+                          update_channels, retain_versions)
+
+def parse_opts(cmdline):
+    """returns command line options as dict"""
+    options = dict(UPDATEDEFS)
+    for opt in cmdline:
+        if not opt.startswith('--') or '=' not in opt:
+            print USAGE
+            sys.exit("Unknown option: %s" % opt)
+        arg, val = opt[2:].split("=", 1)
+        if arg not in options:
+            print USAGE
+            sys.exit("Unknown option: --%s" % arg)
+        if isinstance(options[arg], bool):
+            val = val.lower() in ('yes', 'true')
+        elif isinstance(options[arg], int):
+            try:
+                val = int(val)
+            except ValueError:
+                sys.exit("Numeric value required: --%s=%s" % (arg, val))
+        options[arg] = val
+    return options
+
+def dude_arch(url):
+    """dude npk arch from file name, x86 if there is none"""
+    arch = re.findall(r'[a-z]{3,}', re.sub(r'^.*?-(.*)\.npk$', r'\1',
+                                            os.path.basename(url)))
+    return arch[0] if arch else 'x86'
+
+def parse_archive(page, base):
+    """returns list of (release, version, [(kind, arch, url)]) from archive page"""
+    releases = []
+    retry = 0
+    for item in PAGE_ITEMS.findall(page):
+        if 'release tree' in item:
+            releases.append([item.lower().split(" ")[0], None, []])
+            retry = RETRY
+            continue
+        if not releases or not retry:
+            continue
+        release = releases[-1]
+        if release[1] is None:
+            release[1] = ROS_VERSION.findall(item)[0]
+        url = urlparse.urljoin(base, item)
+        if '/%s/' % release[1] not in item:
+            retry -= 1
+        elif '/%s/all_packages-' % release[1] in item:
+            release[2].append(('zip', ZIP_ARCH.findall(item)[0], url))
+        elif '/%s/routeros-' % release[1] in item:
+            release[2].append(('npk', NPK_ARCH.findall(item)[0], url))
+        elif DUDE_NPK.search(item):
+            release[2].append(('npk', dude_arch(item), url))
+    return [tuple(release) for release in releases if release[1]]
+
+def parse_retain(retain):
+    """returns {channel: count} from --retain value, '*' is the default"""
+    counts = {}
+    for item in str(retain).split(','):
+        channel, _sep, count = item.rpartition(':')
+        try:
+            counts[channel or '*'] = int(count)
+        except ValueError:
+            sys.exit("Numeric value required: --retain=%s" % retain)
+    return counts
+
+def write_meta(path, meta):
+    """stores download metadata of path"""
+    with open(path + '.meta', 'w') as metafile:
+        json.dump(meta, metafile, sort_keys=True)
+
+def read_meta(path):
+    """returns download metadata of path, empty if path (or files extracted
+    from it) are missing or damaged"""
+    try:
+        with open(path + '.meta', 'r') as meta:
+            meta = json.load(meta)
+    except (IOError, ValueError):
+        return {}
+    if 'files' in meta and not os.path.exists(path): # extracted zip
+        for name, size in meta['files'].items():
+            try:
+                if os.path.getsize(os.path.join(meta['target'], name)) != size:
+                    return {}
+            except OSError:
+                return {}
+        return meta
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    if stat.st_size != meta.get('size'):
+        return {}
+    if int(stat.st_mtime) != meta.get('mtime'):
+        if file_sha256(path) != meta.get('sha256'):
+            return {}
+        meta['mtime'] = int(stat.st_mtime) # relinked to an identical blob
+        write_meta(path, meta)
+    return meta
+
+def download(url, path, timeout):
+    """conditional download of url into path, returns (downloaded, meta)"""
+    meta = read_meta(path)
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as http_error:
+        if http_error.code == 304:
+            return False, meta
+        raise
+    digest = hashlib.sha256()
+    size = 0
+    tmpfd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(tmpfd, 'wb') as tmp:
+            for chunk in iter(lambda: response.read(CHUNK), ''):
+                tmp.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        length = response.info().getheader('Content-Length')
+        if length is not None and int(length) != size:
+            raise IOError("%s: got %d of %s bytes" % (url, size, length))
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(tmppath) as archive:
+                damaged = archive.testzip()
+            if damaged:
+                raise IOError("%s: bad checksum of %s" % (url, damaged))
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    meta = {'url': url, 'size': size, 'sha256': digest.hexdigest(),
+            'mtime': int(os.stat(path).st_mtime),
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified')}
+    write_meta(path, meta)
+    return True, meta
+
+def extract(archive, target):
+    """extracts zip into target folder, every file is renamed into place,
+    returns {file name: size}"""
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(target),
+                              prefix='.' + os.path.basename(target))
+    try:
+        with zipfile.ZipFile(archive) as pkgs:
+            names = [name for name in pkgs.namelist()
+                     if not name.endswith('/') and os.path.basename(name)]
+            for name in names:
+                with pkgs.open(name) as src:
+                    with open(os.path.join(tmpdir, os.path.basename(name)), 'wb') as dst:
+                        shutil.copyfileobj(src, dst, CHUNK)
+        if not os.path.isdir(target):
+            os.makedirs(target, 0775)
+        for name in names:
+            os.rename(os.path.join(tmpdir, os.path.basename(name)),
+                      os.path.join(target, os.path.basename(name)))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return dict((os.path.basename(name),
+                 os.path.getsize(os.path.join(target, os.path.basename(name))))
+                for name in names)
+
+def fetch(job):
+    """downloads (and extracts) one file, returns (changed, log lines)"""
+    kind, version, arch, url, timeout, unzip = job
+    name = os.path.basename(urlparse.urlparse(url).path)
+    folder = version if kind == 'zip' else os.path.join(version, arch)
+    try:
+        path = os.path.join(folder, name)
+        new, meta = download(url, path, timeout)
+        if not new:
+            return False, ["- package %s already in %s" % (name, folder)]
+        lines = ["- new package %s downloaded into %s" % (name, folder)]
+        if kind == 'zip' and unzip:
+            meta['target'] = os.path.join(version, arch)
+            meta['files'] = extract(path, meta['target'])
+            write_meta(path, meta)
+            os.unlink(path)
+            lines.append("  extracted %d files from %s into %s" %
+                         (len(meta['files']), name, meta['target']))
+        return True, lines
+    except Exception as fetch_error:
+        return False, ["- ERROR %s: %s" % (name, fetch_error)]
+
+def release_link(release, version):
+    """points release tree symlink to version (ln -snf)"""
+    tmplink = '.%s.%d' % (release, os.getpid())
+    try:
+        os.symlink(version, tmplink)
+        os.rename(tmplink, release) # fails if release is a real folder
+    except OSError as link_error:
+        if os.path.islink(tmplink):
+            os.unlink(tmplink)
+        sys.exit("Release link error: %s -> %s: %s" % (release, version,
+                                                       link_error.strerror))
+
+def main():
+    options = parse_opts(sys.argv[1:])
+    retain = parse_retain(options['retain'])
+    if os.path.isdir(options['repo']):
+        os.chdir(options['repo'])
+    repo = os.getcwd()
+    log = open(options['log'], 'w')
+    log.write("# MikroTik RouterOS repository script %s\n" % SCRIPT_VERSION)
+    log.write("START: %s in %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S%z'), repo))
+    try:
+        page = urllib2.urlopen(options['url'], timeout=options['timeout']).read()
+    except (urllib2.URLError, IOError) as page_error:
+        log.write("ERROR: %s: %s\n" % (options['url'], page_error))
+        sys.exit("Archive page error: %s" % page_error)
+    releases = parse_archive(page, options['url'])
+    jobs = []
+    with open(options['versions'], 'w') as versions:
+        versions.write("---\n")
+        for release, version, files in releases:
+            log.write("%s release tree: %s\n" % (release, version))
+            versions.write("routeros_%s: %s\n" % (release, version))
+            for kind, arch, url in files:
+                folder = version if kind == 'zip' else os.path.join(version, arch)
+                if not os.path.isdir(folder):
+                    os.makedirs(folder, 0775)
+                jobs.append((kind, version, arch, url, options['timeout'],
+                             options['extract']))
+            release_link(release, version)
+    started = time.time()
+    pool = ThreadPool(max(1, options['workers']))
+    results = pool.map(fetch, jobs, 1)
+    pool.close()
+    pool.join()
+    changed = False
+    for new, lines in results:
+        changed = changed or new
+        log.write('\n'.join(lines) + '\n')
+    log.write("DOWNLOAD: %d files (%d new) in %.1fs\n" % (
+        len(jobs), sum(1 for new, _lines in results if new), time.time() - started))
+    channels = update_channels(repo, [(release, version)
+                                      for release, version, _files in releases])
+    log.write("CLEANUP: keeping %s version(s) per release tree...\n" % options['retain'])
+    for version in retain_versions(repo, channels, retain):
+        log.write("- deleted %s\n" % version)
+    index, hashed = build_index(repo)
+    removed, freed = collect_blobs(repo)
+    log.write("INDEX: %d versions, %d hashed packages, %d unused blobs (%d bytes) removed\n"
+              % (len(index['packages']), hashed, removed, freed))
+    log.write("STOP: %s\n" % time.strftime('%Y-%m-%d %H:%M:%S%z'))
+    log.close()
+    print "changed=%s" % changed
+    errors = [line for _new, lines in results for line in lines if 'ERROR' in line]
+    if errors:
+        sys.exit('\n'.join(errors))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# coding: utf-8
+"""module_utils/mikrotik_api.py"""
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'module_utils'))
+from mikrotik_api import (encode_length, decode_length, encode_sentence,
+                          cli_sentence, cli_value, api_records)
+
+class LengthTest(unittest.TestCase):
+
+    def test_encoding(self):
+        self.assertEqual(encode_length(0), '\x00')
+        self.assertEqual(encode_length(0x7f), '\x7f')
+        self.assertEqual(encode_length(0x80), '\x80\x80')
+        self.assertEqual(encode_length(0x3fff), '\xbf\xff')
+        self.assertEqual(encode_length(0x4000), '\xc0\x40\x00')
+        self.assertEqual(encode_length(0x200000), '\xe0\x20\x00\x00')
+        self.assertEqual(encode_length(0x10000000), '\xf0\x10\x00\x00\x00')
+
+    def test_round_trip(self):
+        for length in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffff, 0x200000,
+                       0xfffffff, 0x10000000, 0xffffffff):
+            encoded = StringIO(encode_length(length) + 'rest')
+            self.assertEqual(decode_length(encoded.read), length)
+            self.assertEqual(encoded.read(), 'rest')
+
+    def test_sentence(self):
+        self.assertEqual(encode_sentence(['/login', '=name=admin']),
+                         '\x06/login\x0b=name=admin\x00')
+
+class CliTest(unittest.TestCase):
+
+    def test_cli_sentence(self):
+        self.assertEqual(cli_sentence('ip address print terse where disabled=no'),
+                         ['/ip/address/print', '?disabled=false'])
+        self.assertEqual(cli_sentence('system resource print without-paging'),
+                         ['/system/resource/print'])
+        self.assertEqual(cli_sentence('user ssh-keys print terse where user=admin'),
+                         ['/user/ssh-keys/print', '?user=admin'])
+        self.assertEqual(cli_sentence('user active print terse where name="admin" '
+                                      'and via=api'),
+                         ['/user/active/print', '?name=admin', '?via=api'])
+        self.assertEqual(cli_sentence('tool e-mail export hide-sensitive'),
+                         ['/tool/e-mail/print'])
+
+    def test_cli_value(self):
+        self.assertEqual(cli_value('enabled', 'true'), 'yes')
+        self.assertEqual(cli_value('ddns-enabled', 'false'), 'no')
+        self.assertEqual(cli_value('total-memory', '134217728'), '128.0MiB')
+        self.assertEqual(cli_value('free-hdd-space', '76965888'), '73.4MiB')
+        self.assertEqual(cli_value('cpu-count', '1'), '1')
+        self.assertEqual(cli_value('rp-filter', 'no'), 'no')
+
+    def test_api_records(self):
+        records = api_records([{'name': 'ether1', 'disabled': 'false'},
+                               {'name': 'ether2', 'disabled': 'true'},
+                               {'name': 'lo'}])
+        self.assertEqual([record['.flags'] for record in records], ['', 'X', ''])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# coding: utf-8
+"""mikrotik_command.py helpers"""
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'library'))
+import mikrotik_command
+
+class FakeSftp(object):
+    """sftp client storing uploads in files"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def putfo(self, fileobj, remotepath):
+        self.files[remotepath] = fileobj.read()
+
+    def close(self):
+        pass
+
+class FakeDevice(object):
+    """ssh client answering commands from outputs, records them"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.commands = []
+        self.files = {}
+
+    def exec_command(self, command, timeout=None):
+        self.commands.append(command)
+        return StringIO(), StringIO(self.outputs.get(command, '')), StringIO()
+
+    def open_sftp(self):
+        return FakeSftp(self.files)
+
+    def close(self):
+        pass
+
+class UploadImportTest(unittest.TestCase):
+
+    def setUp(self):
+        mikrotik_command.SHELLMODE = True
+
+    def test_file_removed_after_failed_import(self):
+        device = FakeDevice({'/import file-name="s.upload.rsc"':
+                             'syntax error (line 1 column 2)\r\n'})
+        with self.assertRaises(SystemExit):
+            mikrotik_command.upload_import(None, device, 10, 's', '/bad\n')
+        self.assertEqual(device.files, {'s.upload.rsc': '/bad\n'})
+        self.assertEqual(device.commands[-1], '/file remove [find name="s.upload.rsc"]')
+
+    def test_successful_import(self):
+        device = FakeDevice({'/import file-name="s.upload.rsc"':
+                             'Script file loaded and executed successfully\r\n'})
+        response = mikrotik_command.upload_import(None, device, 10, 's', '/ip dns\n')
+        self.assertIn('successfully', response)
+        self.assertEqual(len(device.commands), 2)
+
+class ConfigDiffTest(unittest.TestCase):
+
+    def test_item_key(self):
+        self.assertEqual(mikrotik_command.item_key(
+            'set [ find default-name=ether1 ] comment=wan'), 'find default-name=ether1')
+        self.assertEqual(mikrotik_command.item_key('set servers=192.168.88.254'), 'set')
+        self.assertEqual(mikrotik_command.item_key(
+            'add name=pool1 ranges=10.0.0.2-10.0.0.254'), 'name=pool1')
+        self.assertEqual(mikrotik_command.item_key(
+            'add comment="x" name="my pool" ranges=10.0.0.2'), 'name="my pool"')
+        self.assertEqual(mikrotik_command.item_key(
+            'add address=10.0.0.1/24 interface=ether2'),
+                         'add address=10.0.0.1/24 interface=ether2')
+
+    def test_config_diff(self):
+        before = {'/ip dns': ['set servers=192.168.88.254'],
+                  '/ip pool': ['add name=pool1 ranges=10.0.0.2-10.0.0.99'],
+                  '/ip address': ['add address=10.0.0.1/24 interface=ether2'],
+                  '/system identity': ['set name=R1']}
+        after = {'/ip dns': ['set servers=192.168.88.1'],
+                 '/ip pool': ['add name=pool1 ranges=10.0.0.2-10.0.0.99',
+                              'add name=pool2 ranges=10.0.1.2-10.0.1.99'],
+                 '/ip address': ['add address=10.0.1.1/24 interface=ether2'],
+                 '/system identity': ['set name=R1']}
+        changes = mikrotik_command.config_diff(before, after)
+        self.assertEqual(list(changes), ['/ip address', '/ip dns', '/ip pool'])
+        self.assertEqual(changes['/ip dns']['modified'],
+                         [{'before': 'set servers=192.168.88.254',
+                           'after': 'set servers=192.168.88.1'}])
+        self.assertEqual(changes['/ip pool']['added'],
+                         ['add name=pool2 ranges=10.0.1.2-10.0.1.99'])
+        self.assertEqual(changes['/ip address']['removed'],
+                         ['add address=10.0.0.1/24 interface=ether2'])
+        self.assertEqual(changes['/ip address']['added'],
+                         ['add address=10.0.1.1/24 interface=ether2'])
+        self.assertEqual(mikrotik_command.diff_text({'/ip dns': changes['/ip dns']}),
+                         '/ip dns\n- set servers=192.168.88.254\n'
+                         '+ set servers=192.168.88.1\n')
+
+    def test_new_and_removed_menus(self):
+        changes = mikrotik_command.config_diff({'/snmp': ['set enabled=yes']},
+                                               {'/ip cloud': ['set ddns-enabled=yes']})
+        self.assertEqual(changes['/snmp']['removed'], ['set enabled=yes'])
+        self.assertEqual(changes['/ip cloud']['added'], ['set ddns-enabled=yes'])
+
+    def test_duplicate_items(self):
+        changes = mikrotik_command.config_diff(
+            {'/ip firewall filter': ['add action=accept chain=input',
+                                     'add action=accept chain=input']},
+            {'/ip firewall filter': ['add action=accept chain=input']})
+        self.assertEqual(changes['/ip firewall filter']['removed'],
+                         ['add action=accept chain=input'])
+        self.assertEqual(changes['/ip firewall filter']['added'], [])
+
+class ChangeScopeTest(unittest.TestCase):
+
+    def setUp(self):
+        mikrotik_command.SHELLMODE = True
+
+    def test_menus(self):
+        self.assertEqual(mikrotik_command.change_scope(
+            ['/ip address add address=10.0.0.1/24 interface=ether2',
+             'ip firewall filter set 0 disabled=yes', 'ip print']),
+                         [('ip', 'address'), ('ip', 'firewall', 'filter')])
+        self.assertEqual(mikrotik_command.change_scope(['ip dns print']), [])
+
+    def test_root_import_is_change(self):
+        for command in ('import', '/import x.rsc', 'import file-name=x.rsc'):
+            self.assertEqual(mikrotik_command.command_menu(command), None)
+            self.assertEqual(mikrotik_command.change_scope(['ip dns print', command]),
+                             None)
+
+    def test_export_error(self):
+        device = FakeDevice({'/ip bad export':
+                             'bad command name bad (line 1 column 5)\r\n'})
+        with self.assertRaises(SystemExit):
+            mikrotik_command.export_digest(None, device, 10, [('ip', 'bad')])
+        device = FakeDevice({'/ip dns export': '# jan/02/1970 by RouterOS 6.40.3\r\n'
+                                               '/ip dns\r\nset servers=10.0.0.1\r\n'})
+        sections = {}
+        mikrotik_command.export_digest(None, device, 10, [('ip', 'dns')], sections)
+        self.assertEqual(sections, {'/ip dns': ['set servers=10.0.0.1']})
+
+class PipelineTest(unittest.TestCase):
+
+    def test_menu_commands_absolute(self):
+        (script, starts), = mikrotik_command.pipeline_scripts(
+            [(1, '/ip address'), (2, ':put 1'), (3, 'ip dns print;')])
+        self.assertEqual(script, ':put "#mtcmd#1"; /ip address; :put "#mtcmd#2"; '
+                         ':put 1; :put "#mtcmd#3"; /ip dns print; ')
+        self.assertEqual([start[1:] for start in starts],
+                         [(1, '/ip address'), (2, ':put 1'), (3, 'ip dns print')])
+        self.assertEqual(script[starts[2][0] - 1:].split(';')[0], '/ip dns print')
+
+    def test_indented_comments(self):
+        script = ['# dns\n', '/ip dns\n', '    # note\n', '\t\n',
+                  'set servers=10.0.0.1\n', '  #set cache-size=4096\n']
+        commands = mikrotik_command.script_commands(script)
+        self.assertEqual(commands, [(2, '/ip dns\n'), (5, 'set servers=10.0.0.1\n')])
+        (script, _starts), = mikrotik_command.pipeline_scripts(commands)
+        self.assertEqual(script, ':put "#mtcmd#2"; /ip dns; '
+                         ':put "#mtcmd#5"; /set servers=10.0.0.1; ')
+        (script, starts), = mikrotik_command.pipeline_scripts([(1, '  # note'),
+                                                               (2, 'ip dns print')])
+        self.assertEqual(script, ':put "#mtcmd#2"; /ip dns print; ')
+        self.assertEqual([start[1] for start in starts], [2])
+
+    def test_scripts_limited(self):
+        commands = [(lineno, 'ip address add address=10.0.%d.1/24 interface=ether1'
+                     % lineno) for lineno in range(1, 250)]
+        scripts = mikrotik_command.pipeline_scripts(commands)
+        self.assertTrue(len(scripts) > 1)
+        self.assertTrue(all(len(script) <= mikrotik_command.INLINE_MAX
+                            for script, _starts in scripts))
+        self.assertEqual([start[1] for _script, starts in scripts for start in starts],
+                         range(1, 250))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# coding: utf-8
+"""module runs in shell mode against the emulated CHR (emulator/ssh.py and
+emulator/api.py serve the same router)"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'emulator'))
+from ssh import SshEmulator
+from api import ApiEmulator
+
+# facts of the connecting session, not of the router
+SESSION_FACTS = ('management_ip', 'management_interface')
+
+def run_module(module, *args, **kwargs):
+    """runs library module in shell mode, returns (returncode, output),
+    password (if given) is passed in MIKROTIK_PASSWORD environment variable"""
+    cmd = [sys.executable, os.path.join(ROOT, 'library', module),
+           '--hostname=127.0.0.1', '--username=admin']
+    env = dict(os.environ)
+    env.pop('MIKROTIK_PASSWORD', None)
+    if 'password' in kwargs:
+        env['MIKROTIK_PASSWORD'] = kwargs['password']
+    else:
+        cmd.append('--password=')
+    proc = subprocess.Popen(cmd + list(args), stdin=open(os.devnull),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            close_fds=True, env=env)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+def shell_facts(output):
+    """returns facts printed by mikrotik_facts.py as dict"""
+    facts = {}
+    lines = output.splitlines()
+    for line in lines[[idx for idx, line in enumerate(lines)
+                       if line.endswith('succes.')][0] + 1:]:
+        fact, _sep, value = line.partition(': ')
+        if fact not in SESSION_FACTS:
+            facts[fact] = value.rstrip()
+    return facts
+
+class EmulatedTest(unittest.TestCase):
+    """starts both emulators once for all tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='mttest-')
+        cls.ssh = SshEmulator(0, sftp_root=cls.tmp).start()
+        cls.api = ApiEmulator(0).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        time.sleep(0.2) # let the emulators see the last disconnects
+        shutil.rmtree(cls.tmp, True)
+
+    def module(self, module, *args):
+        """returns output of a successful module run against ssh emulator"""
+        returncode, output = run_module(module, '--port=%d' % self.ssh.port, *args)
+        self.assertEqual(returncode, 0, output)
+        return output
+
+class FactsTest(EmulatedTest):
+    """mikrotik_facts.py over ssh and api"""
+
+    def test_api_facts_match_ssh(self):
+        ssh_facts = shell_facts(self.module('mikrotik_facts.py', '--verbose'))
+        api_facts = shell_facts(self.module('mikrotik_facts.py', '--verbose',
+                                            '--transport=api',
+                                            '--api_port=%d' % self.api.port))
+        self.assertEqual(api_facts, ssh_facts)
+        self.assertEqual(api_facts['total_memory'], '128.0MiB')
+        self.assertEqual(api_facts['cloud_ddns_enabled'], 'no')
+
+    def test_named_group_is_verbose(self):
+        facts = shell_facts(self.module('mikrotik_facts.py', '--gather_subset=ntp'))
+        self.assertEqual(facts['ntp_client_enabled'], 'no')
+        self.assertNotIn('snmp_enabled', facts)
+
+class ExportTest(EmulatedTest):
+    """mikrotik_export.py change detection"""
+
+    def test_changed_when_rewritten(self):
+        export_dir = tempfile.mkdtemp(dir=self.tmp)
+        export = lambda: self.module('mikrotik_export.py',
+                                     '--export_dir=' + export_dir)
+        self.assertIn('changed: True', export())
+        self.assertIn('changed: False', export())
+        os.unlink(os.path.join(export_dir, 'R1_ABCD-1234.rsc'))
+        self.assertIn('changed: True', export())
+        self.assertTrue(os.path.exists(os.path.join(export_dir, 'R1_ABCD-1234.rsc')))
+
+    def test_fleet_backups_per_host(self):
+        fleet_dir = tempfile.mkdtemp(dir=self.tmp)
+        with open(os.path.join(self.tmp, 'auto.backup'), 'wb') as backup:
+            backup.write(os.urandom(10000))
+        inventory = os.path.join(fleet_dir, 'inventory')
+        with open(inventory, 'w') as hosts:
+            hosts.write("[routers]\nr1 ansible_host=127.0.0.1 ansible_port=%d\n"
+                        "r2 ansible_host=127.0.0.1 ansible_port=%d\n"
+                        % (self.ssh.port, self.ssh.port))
+        backup_dir = os.path.join(fleet_dir, 'backup')
+        self.module('mikrotik_export.py', '--inventory=' + inventory,
+                    '--export_dir=' + os.path.join(fleet_dir, 'export'),
+                    '--backup_dir=' + backup_dir)
+        with open(os.path.join(self.tmp, 'auto.backup'), 'rb') as backup:
+            data = backup.read()
+        for host in ('r1', 'r2'):
+            with open(os.path.join(backup_dir, host, 'auto.backup'), 'rb') as backup:
+                self.assertEqual(backup.read(), data)
+
+class CommandTest(EmulatedTest):
+    """mikrotik_command.py"""
+
+    def test_command_output(self):
+        output = self.module('mikrotik_command.py', '--command=ip dns print')
+        self.assertIn(self.ssh.fixtures['ip dns print'].rstrip(), output)
+
+    def test_pipeline_like_sequential(self):
+        script = os.path.join(self.tmp, 'script.rsc')
+        with open(script, 'w') as rsc:
+            rsc.write("# test script\nip dns print\n/ip route print terse without-paging\n")
+        outputs = [self.module('mikrotik_command.py', '--execute_file=' + script,
+                               '--test_change=no', '--pipeline=' + pipeline)
+                   for pipeline in ('yes', 'no')]
+        lines = [[line.strip() for line in output.splitlines()[2:] if line.strip()]
+                 for output in outputs]
+        self.assertEqual(lines[0], lines[1])
+        self.assertIn('allow-remote-requests: yes', lines[0])
+
+class PackageTest(EmulatedTest):
+    """mikrotik_package.py uploads"""
+
+    def test_upload_once(self):
+        repository = os.path.join(self.tmp, 'repo')
+        os.makedirs(os.path.join(repository, '6.40.4', 'x86'))
+        for pkg in ('system', 'security', 'ipv6'):
+            with open(os.path.join(repository, '6.40.4', 'x86',
+                                   '%s-6.40.4.npk' % pkg), 'wb') as npk:
+                npk.write(os.urandom(20000))
+        args = ('--repository=' + repository, '--version=6.40.4',
+                '--packages=system,security,ipv6')
+        output = self.module('mikrotik_package.py', *args)
+        self.assertIn('Uploading package(s): system, security, ipv6', output)
+        with open(os.path.join(repository, '6.40.4', 'x86', 'ipv6-6.40.4.npk'),
+                  'rb') as npk:
+            with open(os.path.join(self.tmp, 'ipv6-6.40.4.npk'), 'rb') as uploaded:
+                self.assertEqual(uploaded.read(), npk.read())
+        output = self.module('mikrotik_package.py', *args)
+        self.assertEqual(output.count('already uploaded, skipping'), 3)
+
+class PasswordTest(unittest.TestCase):
+    """password from MIKROTIK_PASSWORD instead of the command line"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='mttest-')
+        cls.ssh = SshEmulator(0, sftp_root=cls.tmp, password='s3cret').start()
+
+    @classmethod
+    def tearDownClass(cls):
+        time.sleep(0.2)
+        shutil.rmtree(cls.tmp, True)
+
+    def test_environment_password(self):
+        runs = [('mikrotik_facts.py',),
+                ('mikrotik_export.py', '--export_dir=' + self.tmp),
+                ('mikrotik_command.py', '--command=ip dns print'),
+                ('mikrotik_package.py', '--repository=' + self.tmp)]
+        for args in runs:
+            port = '--port=%d' % self.ssh.port
+            self.assertEqual(run_module(args[0], port, *args[1:], password='s3cret')[0],
+                             0, args[0])
+            self.assertNotEqual(run_module(args[0], port, *args[1:],
+                                           password='wrong')[0], 0, args[0])
+
+if __name__ == '__main__':
+    unittest.main()
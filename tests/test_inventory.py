@@ -0,0 +1,54 @@
+# coding: utf-8
+"""module_utils/mikrotik_inventory.py"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'module_utils'))
+from mikrotik_inventory import parse_inventory
+
+INVENTORY = """# test routers
+[routers]
+r1 ansible_host=192.168.88.101
+r2 ansible_host=192.168.88.102 ansible_port=2222 ansible_user=ansible ; comment
+r3
+
+[core]
+r1
+c1 ansible_host=10.0.0.1 # core router
+
+[routers:vars]
+ansible_user=admin
+
+[all:children]
+routers
+"""
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='mttest-')
+        self.path = os.path.join(self.tmp, 'inventory')
+        with open(self.path, 'w') as inventory:
+            inventory.write(INVENTORY)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hosts(self):
+        self.assertEqual(parse_inventory(self.path), [
+            ('r1', {'hostname': '192.168.88.101'}),
+            ('r2', {'hostname': '192.168.88.102', 'port': 2222,
+                    'username': 'ansible'}),
+            ('r3', {'hostname': 'r3'}),
+            ('c1', {'hostname': '10.0.0.1'})])
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, parse_inventory, os.path.join(self.tmp, 'none'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+# coding: utf-8
+"""module_utils/mikrotik_repo.py index and blob store"""
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import unittest
+import threading
+import subprocess
+import BaseHTTPServer
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'module_utils'))
+from mikrotik_repo import (build_index, collect_blobs, load_index, index_missing,
+                           find_package, open_package, BLOB_DIR)
+
+SYSTEM = 'system package ' * 1000
+IPV6 = 'ipv6 package ' * 500
+
+def blob_path(repository, data):
+    """returns path of blob storing data"""
+    sha256 = hashlib.sha256(data).hexdigest()
+    return os.path.join(repository, BLOB_DIR, sha256[:2], sha256)
+
+class RepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='mttest-')
+        self.write('6.40.3/x86/system-6.40.3.npk', SYSTEM)
+        self.write('6.40.4/x86/system-6.40.4.npk', SYSTEM) # same content
+        os.mkdir(os.path.join(self.repo, '6.40.5'))
+        with zipfile.ZipFile(self.path('6.40.5/all_packages-x86-6.40.5.zip'), 'w') as zpkg:
+            zpkg.writestr('system-6.40.5.npk', SYSTEM + 'new')
+            zpkg.writestr('ipv6-6.40.5.npk', IPV6)
+        os.symlink('6.40.5', self.path('current'))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def path(self, name):
+        """returns path of name in repository"""
+        return os.path.join(self.repo, name)
+
+    def write(self, name, data):
+        """creates file name in repository"""
+        if not os.path.isdir(os.path.dirname(self.path(name))):
+            os.makedirs(os.path.dirname(self.path(name)))
+        with open(self.path(name), 'wb') as npk:
+            npk.write(data)
+
+    def test_build_index(self):
+        index, hashed = build_index(self.repo)
+        self.assertEqual(hashed, 5) # 2 npk files, a zip and its 2 members
+        self.assertEqual(load_index(self.repo), index)
+        self.assertEqual(sorted(index['packages']), ['6.40.3', '6.40.4', '6.40.5'])
+        entry = index['packages']['6.40.4']['x86']['system-6.40.4.npk']
+        self.assertEqual((entry['path'], entry['size'], entry['sha256']),
+                         ('6.40.4/x86/system-6.40.4.npk', len(SYSTEM),
+                          hashlib.sha256(SYSTEM).hexdigest()))
+        entry = index['packages']['6.40.5']['x86']['ipv6-6.40.5.npk']
+        self.assertEqual((entry['path'], entry['member']),
+                         ('6.40.5/all_packages-x86-6.40.5.zip', 'ipv6-6.40.5.npk'))
+        with open_package(self.repo, entry) as npk:
+            self.assertEqual(npk.read(), IPV6)
+        self.assertIn('6.40.5/all_packages-x86-6.40.5.zip', index['archives'])
+
+    def test_blobs(self):
+        build_index(self.repo)
+        # identical packages share one blob, the zip has its own
+        self.assertTrue(os.path.samefile(self.path('6.40.3/x86/system-6.40.3.npk'),
+                                         self.path('6.40.4/x86/system-6.40.4.npk')))
+        self.assertEqual(os.stat(blob_path(self.repo, SYSTEM)).st_nlink, 3)
+        with open(self.path('6.40.5/all_packages-x86-6.40.5.zip'), 'rb') as zpkg:
+            self.assertEqual(os.stat(blob_path(self.repo, zpkg.read())).st_nlink, 2)
+        self.assertEqual(collect_blobs(self.repo), (0, 0))
+
+    def test_rebuild(self):
+        build_index(self.repo)
+        self.assertEqual(build_index(self.repo)[1], 0) # nothing hashed again
+        self.write('6.40.4/x86/ipv6-6.40.4.npk', IPV6)
+        index, hashed = build_index(self.repo)
+        self.assertEqual(hashed, 1)
+        self.assertEqual(index_missing(index, '6.40.4', ['system', 'ipv6', 'ppp']),
+                         ['ppp'])
+
+    def test_extracted_files_win(self):
+        self.write('6.40.5/x86/ipv6-6.40.5.npk', IPV6)
+        index = build_index(self.repo)[0]
+        self.assertEqual(index['packages']['6.40.5']['x86']['ipv6-6.40.5.npk']['path'],
+                         '6.40.5/x86/ipv6-6.40.5.npk')
+        self.assertEqual(find_package(self.repo, '6.40.5', 'x86', 'system-6.40.5.npk'),
+                         {'path': '6.40.5/all_packages-x86-6.40.5.zip',
+                          'member': 'system-6.40.5.npk', 'size': len(SYSTEM) + 3})
+
+    def test_collect_blobs(self):
+        build_index(self.repo)
+        with open(self.path('6.40.5/all_packages-x86-6.40.5.zip'), 'rb') as zpkg:
+            zblob = blob_path(self.repo, zpkg.read())
+        shutil.rmtree(self.path('6.40.3'))
+        shutil.rmtree(self.path('6.40.5'))
+        index = build_index(self.repo)[0]
+        self.assertEqual(sorted(index['packages']), ['6.40.4'])
+        self.assertEqual(index['archives'], {})
+        removed = collect_blobs(self.repo)
+        self.assertEqual(removed[0], 1) # the zip, system is still linked
+        self.assertFalse(os.path.exists(zblob))
+        self.assertTrue(os.path.exists(blob_path(self.repo, SYSTEM)))
+
+    def test_damaged_zip(self):
+        with open(self.path('6.40.5/all_packages-x86-6.40.5.zip'), 'r+b') as zpkg:
+            zpkg.truncate(100)
+        index = build_index(self.repo)[0]
+        self.assertNotIn('6.40.5', index['packages'])
+        self.assertEqual(index['archives'], {})
+
+class PackageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serves server.data modified at server.mtime, honours If-Modified-Since"""
+
+    def do_GET(self):
+        since = self.headers.getheader('If-Modified-Since')
+        if since and mktime_tz(parsedate_tz(since)) >= self.server.mtime:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.send_header('Last-Modified', formatdate(self.server.mtime, usegmt=True))
+        self.end_headers()
+        self.wfile.write(self.server.data)
+
+    def log_message(self, *args):
+        pass
+
+def has_wget():
+    """True if wget is installed"""
+    return any(os.access(os.path.join(path, 'wget'), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+@unittest.skipUnless(has_wget(), 'wget is not installed')
+class FetchTest(unittest.TestCase):
+    """routeros/fetch.sh used by latest.sh and archive.sh"""
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='mttest-')
+        for version in ('6.40.3', '6.40.4'):
+            os.makedirs(self.path(version + '/x86'))
+            with open(self.path('%s/x86/system-%s.npk' % (version, version)), 'wb') as npk:
+                npk.write(SYSTEM)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PackageHandler)
+        self.server.data = SYSTEM
+        self.server.mtime = int(time.time()) - 3600
+        worker = threading.Thread(target=self.server.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.repo)
+
+    def path(self, name):
+        """returns path of name in repository"""
+        return os.path.join(self.repo, name)
+
+    def fetch(self):
+        """fetches system-6.40.4.npk into 6.40.4/x86, returns output"""
+        url = 'http://127.0.0.1:%d/system-6.40.4.npk' % self.server.server_address[1]
+        return subprocess.check_output(
+            ['bash', '-c', '. "$0"; fetch "$1" "$2"',
+             os.path.join(ROOT, 'routeros', 'fetch.sh'), self.path('6.40.4/x86'), url])
+
+    def test_rewrite_keeps_blob(self):
+        build_index(self.repo)
+        os.utime(self.path('6.40.4/x86/system-6.40.4.npk'),
+                 (self.server.mtime, self.server.mtime)) # of all links
+        linked = os.stat(self.path('6.40.4/x86/system-6.40.4.npk'))
+        self.assertEqual(self.fetch(), '') # not modified
+        self.assertEqual(os.stat(self.path('6.40.4/x86/system-6.40.4.npk')).st_ino,
+                         linked.st_ino)
+        self.server.data = SYSTEM.replace('system', 'update')
+        self.server.mtime += 60
+        self.assertIn('system-6.40.4.npk', self.fetch())
+        with open(self.path('6.40.4/x86/system-6.40.4.npk'), 'rb') as npk:
+            self.assertEqual(npk.read(), self.server.data)
+        for path in (blob_path(self.repo, SYSTEM), self.path('6.40.3/x86/system-6.40.3.npk')):
+            with open(path, 'rb') as npk:
+                self.assertEqual(npk.read(), SYSTEM)
+        self.assertEqual(os.stat(blob_path(self.repo, SYSTEM)).st_nlink, 2)
+        build_index(self.repo)
+        self.assertTrue(os.path.samefile(blob_path(self.repo, self.server.data),
+                                         self.path('6.40.4/x86/system-6.40.4.npk')))
+        self.assertEqual([name for name in os.listdir(self.path('6.40.4/x86'))],
+                         ['system-6.40.4.npk'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# coding: utf-8
+"""mikrotik_rollout.py wave planning"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(ROOT)
+from mikrotik_rollout import plan_waves, parse_opts
+
+HOSTS = ['r%d' % number for number in range(1, 21)]
+
+class PlanWavesTest(unittest.TestCase):
+
+    def test_growing_waves(self):
+        waves = plan_waves(HOSTS, 1, 2.0, 100)
+        self.assertEqual([len(wave) for wave in waves], [1, 2, 4, 8, 5])
+        self.assertEqual(sum(waves, []), HOSTS)
+
+    def test_fractional_growth_and_max_wave(self):
+        self.assertEqual([len(wave) for wave in plan_waves(HOSTS, 2, 1.5, 5)],
+                         [2, 3, 4, 5, 5, 1])
+        # growth below 2 still grows by at least one host per wave
+        self.assertEqual([len(wave) for wave in plan_waves(HOSTS[:6], 1, 1.1, 100)],
+                         [1, 2, 3])
+
+    def test_named_canaries(self):
+        waves = plan_waves(HOSTS[:5], 'r3,r5,unknown', 2.0, 100)
+        self.assertEqual(waves, [['r3', 'r5'], ['r1', 'r2', 'r4']])
+
+    def test_no_canaries(self):
+        self.assertEqual(plan_waves(HOSTS[:3], 0, 2.0, 100), [['r1', 'r2'], ['r3']])
+        self.assertEqual(plan_waves([], 1, 2.0, 100), [])
+
+    def test_wave_growth_option(self):
+        options = parse_opts(['--inventory=hosts', '--version=6.40.4',
+                              '--wave_growth=1.5', '--canaries=r1,r2'])
+        self.assertEqual(options['wave_growth'], 1.5)
+        self.assertEqual(options['canaries'], 'r1,r2')
+        self.assertEqual(options['state'], 'rollout-6.40.4.json')
+
+if __name__ == '__main__':
+    unittest.main()
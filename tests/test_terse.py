@@ -0,0 +1,53 @@
+# coding: utf-8
+"""module_utils/mikrotik_terse.py"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'module_utils'))
+from mikrotik_terse import terse_records
+
+class TerseRecordsTest(unittest.TestCase):
+
+    def test_number_and_flags(self):
+        records = terse_records([
+            ' 0  R name=ether1 type=ether mtu=1500 \r\n',
+            ' 2 X  name=ether3 type=ether \r\n',
+            ' 0 ADS  dst-address=0.0.0.0/0 distance=1 \r\n'])
+        self.assertEqual([(rec['.id'], rec['.flags'], rec['name' if 'name' in rec
+                                                         else 'dst-address'])
+                          for rec in records],
+                         [('0', 'R', 'ether1'), ('2', 'X', 'ether3'),
+                          ('0', 'ADS', '0.0.0.0/0')])
+
+    def test_quoted_values(self):
+        record = terse_records([' 2 X  name=ether3 comment="uplink \\"A\\" side" '
+                                'address="" \r\n'])[0]
+        self.assertEqual(record['comment'], 'uplink "A" side')
+        self.assertEqual(record['address'], '')
+
+    def test_values_with_spaces(self):
+        record = terse_records([
+            ' 0   name=system version=6.40.3 build-time=jul/28/2017 10:00:00 '
+            'scheduled="" \r\n'])[0]
+        self.assertEqual(record['build-time'], 'jul/28/2017 10:00:00')
+        self.assertEqual(record['scheduled'], '')
+        record = terse_records([
+            ' 0 ADS  gateway=192.168.88.254 gateway-status=192.168.88.254 reachable'
+            ' via  ether1 distance=1 \r\n'])[0]
+        self.assertEqual(record['gateway-status'], '192.168.88.254 reachable via  ether1')
+        self.assertEqual(record['distance'], '1')
+
+    def test_lines_without_pairs(self):
+        self.assertEqual(terse_records(['Flags: X - disabled, R - running \r\n',
+                                        '\r\n', '']), [])
+
+    def test_no_number(self):
+        record = terse_records(['name=admin group=full'])[0]
+        self.assertEqual((record['.id'], record['.flags']), ('', ''))
+        self.assertEqual(record['group'], 'full')
+
+if __name__ == '__main__':
+    unittest.main()
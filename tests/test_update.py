@@ -0,0 +1,236 @@
+# coding: utf-8
+"""routeros/update.py archive page parsing and downloads"""
+
+import os
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer
+from StringIO import StringIO
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(ROOT, 'routeros'))
+import update
+from update import parse_archive, parse_retain, download
+
+BASE = 'https://mikrotik.com/download/archive'
+DOWNLOAD = 'https://download.mikrotik.com/routeros/'
+PAGE = """<html><body>
+<h3>Current release tree</h3>
+<a href="%(dl)s6.40.4/routeros-mipsbe-6.40.4.npk">mipsbe</a>
+<a href="%(dl)s6.40.4/all_packages-x86-6.40.4.zip">x86</a>
+<a href="/routeros/6.40.4/routeros-x86-6.40.4.npk">x86</a>
+<a href="%(dl)s6.40.4/dude-6.40.4-tile.npk">dude</a>
+<a href="%(dl)s6.40.4/dude-6.40.4.npk">dude</a>
+<a href="%(dl)s6.40.4/CHANGELOG">changelog</a>
+<h3>Bugfix release tree</h3>
+<a href="%(dl)s6.38.7/all_packages-mipsbe-6.38.7.zip">mipsbe</a>
+<a href="%(dl)s6.38.5/all_packages-mipsbe-6.38.5.zip">older</a>
+<h3>Release candidate release tree</h3>
+</body></html>""" % {'dl': DOWNLOAD}
+
+class ParseArchiveTest(unittest.TestCase):
+
+    def test_release_trees(self):
+        releases = parse_archive(PAGE, BASE)
+        self.assertEqual([(release, version) for release, version, _files in releases],
+                         [('current', '6.40.4'), ('bugfix', '6.38.7')])
+        self.assertEqual(releases[0][2], [
+            ('npk', 'mipsbe', DOWNLOAD + '6.40.4/routeros-mipsbe-6.40.4.npk'),
+            ('zip', 'x86', DOWNLOAD + '6.40.4/all_packages-x86-6.40.4.zip'),
+            ('npk', 'x86', 'https://mikrotik.com/routeros/6.40.4/routeros-x86-6.40.4.npk'),
+            ('npk', 'tile', DOWNLOAD + '6.40.4/dude-6.40.4-tile.npk'),
+            ('npk', 'x86', DOWNLOAD + '6.40.4/dude-6.40.4.npk')])
+        self.assertEqual(releases[1][2], [
+            ('zip', 'mipsbe', DOWNLOAD + '6.38.7/all_packages-mipsbe-6.38.7.zip')])
+
+    def test_empty_page(self):
+        self.assertEqual(parse_archive('<html></html>', BASE), [])
+
+    def test_parse_retain(self):
+        self.assertEqual(parse_retain('3'), {'*': 3})
+        self.assertEqual(parse_retain('current:2,bugfix:4,*:1'),
+                         {'current': 2, 'bugfix': 4, '*': 1})
+        self.assertRaises(SystemExit, parse_retain, 'current:two')
+
+def zip_data(members):
+    """returns zip (stored, not compressed) of {name: data} as string"""
+    data = StringIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED) as archive:
+        for name, member in sorted(members.items()):
+            archive.writestr(name, member)
+    return data.getvalue()
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serves server.files {path: (data, etag)}, records (path, status) in
+    server.requests, server.truncate paths send half of their data"""
+
+    def do_GET(self):
+        server = self.server
+        if self.path not in server.files:
+            server.requests.append((self.path, 404))
+            self.send_error(404)
+            return
+        data, etag = server.files[self.path]
+        if etag and self.headers.getheader('If-None-Match') == etag:
+            server.requests.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        server.requests.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 24 Jul 2017 10:00:00 GMT')
+        self.end_headers()
+        if self.path in server.truncate:
+            data = data[:len(data) // 2]
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    """download() and main() against a local archive server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        worker = threading.Thread(target=cls.server.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.files = {}
+        self.server.requests = []
+        self.server.truncate = set()
+        self.repo = tempfile.mkdtemp(prefix='mttest-')
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.repo)
+
+    def publish(self, version):
+        """serves archive page with version as current release tree"""
+        files = {'/download/archive': ("""<h3>Current release tree</h3>
+<a href="/routeros/%(v)s/all_packages-x86-%(v)s.zip">x86</a>
+<a href="/routeros/%(v)s/routeros-mipsbe-%(v)s.npk">mipsbe</a>""" % {'v': version},
+                                       None),
+                 '/routeros/%s/all_packages-x86-%s.zip' % (version, version):
+                     (zip_data({'system-%s.npk' % version: 'system ' + version,
+                                'ipv6-%s.npk' % version: 'ipv6 ' + version}),
+                      '"zip-%s"' % version),
+                 '/routeros/%s/routeros-mipsbe-%s.npk' % (version, version):
+                     ('routeros ' + version, '"npk-%s"' % version)}
+        self.server.files.update(files)
+
+    def run_main(self, *args):
+        """runs update.py main in the repository, returns printed output"""
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv = ['update.py', '--url=%s/download/archive' % self.url,
+                    '--repo=' + self.repo] + list(args)
+        sys.stdout = StringIO()
+        try:
+            update.main()
+            return sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+            os.chdir(self.cwd)
+
+    def repo_files(self):
+        """returns {path: (inode, mtime)} of packages, metadata and blobs
+        (files in folders, the log, index and versions.yml are rewritten)"""
+        files = {}
+        for folder, _dirs, names in os.walk(self.repo):
+            for name in names if folder != self.repo else []:
+                stat = os.stat(os.path.join(folder, name))
+                files[os.path.relpath(os.path.join(folder, name), self.repo)] = (
+                    stat.st_ino, stat.st_mtime)
+        return files
+
+    def test_second_run_not_modified(self):
+        self.publish('6.40.4')
+        self.assertIn('changed=True', self.run_main())
+        self.assertEqual(os.readlink(os.path.join(self.repo, 'current')), '6.40.4')
+        with open(os.path.join(self.repo, '6.40.4', 'mipsbe',
+                               'routeros-mipsbe-6.40.4.npk')) as npk:
+            self.assertEqual(npk.read(), 'routeros 6.40.4')
+        with open(os.path.join(self.repo, '6.40.4',
+                               'all_packages-x86-6.40.4.zip.meta')) as meta:
+            self.assertEqual(json.load(meta)['etag'], '"zip-6.40.4"')
+        files = self.repo_files()
+        self.assertEqual(len(files), 6) # npk, zip, their .meta and blobs
+        del self.server.requests[:]
+        self.assertIn('changed=False', self.run_main())
+        self.assertEqual(sorted(status for path, status in self.server.requests
+                                if path.startswith('/routeros/')), [304, 304])
+        self.assertEqual(self.repo_files(), files)
+
+    def test_new_release_and_retention(self):
+        self.publish('6.40.3')
+        self.run_main('--retain=1')
+        self.publish('6.40.4')
+        self.assertIn('changed=True', self.run_main('--retain=1'))
+        self.assertEqual(os.readlink(os.path.join(self.repo, 'current')), '6.40.4')
+        self.assertFalse(os.path.exists(os.path.join(self.repo, '6.40.3')))
+        self.assertEqual([line for line in os.listdir(self.repo)
+                          if line.endswith('.part')], [])
+
+    def test_changed_file_replaced(self):
+        path = os.path.join(self.repo, 'routeros-mipsbe-6.40.4.npk')
+        self.server.files['/npk'] = ('first', '"1"')
+        self.assertEqual(download(self.url + '/npk', path, 10)[0], True)
+        inode = os.stat(path).st_ino
+        self.server.files['/npk'] = ('second', '"2"')
+        new, meta = download(self.url + '/npk', path, 10)
+        self.assertEqual((new, meta['etag'], meta['size']), (True, '"2"', 6))
+        with open(path) as npk:
+            self.assertEqual(npk.read(), 'second')
+        self.assertNotEqual(os.stat(path).st_ino, inode) # renamed into place
+        with open(path + '.meta') as saved:
+            self.assertEqual(json.load(saved), meta)
+
+    def assert_kept(self, path, data):
+        """checks that failed download left previous file and meta in place"""
+        with open(path, 'rb') as previous:
+            self.assertEqual(previous.read(), data)
+        with open(path + '.meta') as meta:
+            self.assertEqual(json.load(meta)['etag'], '"1"')
+        self.assertEqual([name for name in os.listdir(self.repo)
+                          if name.endswith('.part')], [])
+
+    def test_truncated_download(self):
+        path = os.path.join(self.repo, 'all_packages-x86-6.40.4.zip')
+        good = zip_data({'system-6.40.4.npk': 'system'})
+        self.server.files['/zip'] = (good, '"1"')
+        download(self.url + '/zip', path, 10)
+        self.server.files['/zip'] = (zip_data({'system-6.40.4.npk': 'x' * 1000}), '"2"')
+        self.server.truncate.add('/zip')
+        self.assertRaises(Exception, download, self.url + '/zip', path, 10)
+        self.assert_kept(path, good)
+
+    def test_corrupt_zip(self):
+        path = os.path.join(self.repo, 'all_packages-x86-6.40.4.zip')
+        good = zip_data({'system-6.40.4.npk': 'system'})
+        self.server.files['/zip'] = (good, '"1"')
+        download(self.url + '/zip', path, 10)
+        corrupt = zip_data({'system-6.40.4.npk': 'system 6.40.5'})
+        corrupt = corrupt.replace('system 6.40.5', 'system 6.40.X', 1)
+        self.server.files['/zip'] = (corrupt, '"2"')
+        self.assertRaises(IOError, download, self.url + '/zip', path, 10)
+        self.assert_kept(path, good)
+
+if __name__ == '__main__':
+    unittest.main()